@@ -0,0 +1,81 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark for node look up in the node cache.
+
+Usage::
+
+    $ python benchmarks/node_cache.py [number of attribute rows]
+
+Fills a temporary database with nodes having one BMC address and three
+MAC's each (so 10000 attribute rows by default) and measures latency of
+node_cache.find_node with the same arguments as the ramdisk callback uses.
+"""
+
+import random
+import sys
+import tempfile
+import time
+
+from oslo_config import cfg
+
+from ironic_discoverd import conf  # noqa
+from ironic_discoverd import node_cache
+
+
+CONF = cfg.CONF
+ATTRIBUTES_PER_NODE = 4
+LOOKUPS = 2000
+
+
+def _mac(node, nic):
+    return ':'.join('%02x' % b for b in
+                    (0x52, 0x54, node >> 16 & 0xff, node >> 8 & 0xff,
+                     node & 0xff, nic))
+
+
+def _bmc(node):
+    return '10.%d.%d.%d' % (node >> 16 & 0xff, node >> 8 & 0xff, node & 0xff)
+
+
+def main(rows=10000):
+    nodes = rows // ATTRIBUTES_PER_NODE
+    with tempfile.NamedTemporaryFile() as db_file:
+        CONF.set_override('database', db_file.name, 'discoverd')
+        node_cache.init()
+
+        start = time.time()
+        for node in range(nodes):
+            node_cache.add_node('uuid-%d' % node, bmc_address=_bmc(node),
+                                mac=[_mac(node, nic) for nic in range(3)])
+        print('Filled %d nodes (%d attribute rows) in %.2f s' %
+              (nodes, nodes * ATTRIBUTES_PER_NODE, time.time() - start))
+
+        timings = []
+        for _ in range(LOOKUPS):
+            node = random.randrange(nodes)
+            start = time.time()
+            node_cache.find_node(bmc_address=_bmc(node),
+                                 mac=[_mac(node, nic) for nic in range(3)])
+            timings.append(time.time() - start)
+
+    timings.sort()
+    print('find_node latency over %d look ups: mean %.3f ms, '
+          'median %.3f ms, 99th percentile %.3f ms' %
+          (LOOKUPS, 1000 * sum(timings) / len(timings),
+           1000 * timings[len(timings) // 2],
+           1000 * timings[int(len(timings) * 0.99)]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -13,37 +13,67 @@
 
 import logging
 import subprocess
+import time
 
+import eventlet
+from eventlet import event
 from eventlet import semaphore
 from oslo_config import cfg
 
 from ironic_discoverd.common.i18n import _LE
+from ironic_discoverd import metrics
 from ironic_discoverd import node_cache
-from ironic_discoverd import utils
+from ironic_discoverd.plugins import base as plugins_base
+from ironic_discoverd import port_cache
 
 
 LOG = logging.getLogger("ironic_discoverd.firewall")
+# Temporary chain is not used any more, but may be left over
+# from previous versions
 NEW_CHAIN = 'discovery_temp'
 CHAIN = 'discovery'
+SET = 'discovery'
+NEW_SET = 'discovery_temp'
 INTERFACE = None
+# Blacklist applied by the last update and time of the last full update
+BLACKLIST = None
+LAST_RESYNC = 0
 LOCK = semaphore.BoundedSemaphore()
+# Event sent when the next update is applied, None if no update is requested
+_PENDING = None
+# Green thread applying requested updates, None if not running
+_WORKER = None
+_LAST_UPDATE = 0
 CONF = cfg.CONF
 
 
-def _iptables(*args, **kwargs):
-    cmd = ('iptables',) + args
-    ignore = kwargs.pop('ignore', False)
-    LOG.debug('Running iptables %s', args)
-    kwargs['stderr'] = subprocess.STDOUT
-    try:
-        subprocess.check_output(cmd, **kwargs)
-    except subprocess.CalledProcessError as exc:
+def run_with_input(cmd, data, ignore=False):
+    """Run a command feeding data to its standard input.
+
+    :param cmd: command with arguments as a tuple.
+    :param data: string to pass to the command.
+    :param ignore: whether to ignore failures.
+    :raises: subprocess.CalledProcessError on failure.
+    """
+    LOG.debug('Running %(cmd)s with input:\n%(data)s',
+              {'cmd': ' '.join(cmd), 'data': data})
+    proc = subprocess.Popen(cmd,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT,
+                            universal_newlines=True)
+    output = proc.communicate(data)[0]
+    if proc.returncode:
         if ignore:
-            LOG.debug('ignoring failed iptables %s:\n%s', args, exc.output)
-        else:
-            LOG.error(_LE('iptables %(iptables)s failed:\n%(exc)s') %
-                      {'iptables': args, 'exc': exc.output})
-            raise
+            LOG.debug('ignoring failed %(cmd)s:\n%(output)s',
+                      {'cmd': cmd[0], 'output': output})
+            return
+        LOG.error(_LE('%(cmd)s failed:\n%(output)s'),
+                  {'cmd': cmd[0], 'output': output})
+        raise subprocess.CalledProcessError(proc.returncode, cmd[0], output)
+
+
+def _driver():
+    return plugins_base.firewall_driver()
 
 
 def init():
@@ -54,19 +84,10 @@ def init():
     if not CONF.discoverd.manage_firewall:
         return
 
-    global INTERFACE
+    global INTERFACE, BLACKLIST
     INTERFACE = CONF.discoverd.dnsmasq_interface
-    _clean_up(CHAIN)
-    # Not really needed, but helps to validate that we have access to iptables
-    _iptables('-N', CHAIN)
-
-
-def _clean_up(chain):
-    _iptables('-D', 'INPUT', '-i', INTERFACE, '-p', 'udp',
-              '--dport', '67', '-j', chain,
-              ignore=True)
-    _iptables('-F', chain, ignore=True)
-    _iptables('-X', chain, ignore=True)
+    BLACKLIST = None
+    _driver().init()
 
 
 def clean_up():
@@ -74,8 +95,16 @@ def clean_up():
     if not CONF.discoverd.manage_firewall:
         return
 
-    _clean_up(CHAIN)
-    _clean_up(NEW_CHAIN)
+    _driver().clean_up()
+
+
+def reset():
+    """Stop the update worker and drop requested updates."""
+    global _PENDING, _WORKER, _LAST_UPDATE
+    if _WORKER is not None:
+        _WORKER.kill()
+    _PENDING = _WORKER = None
+    _LAST_UPDATE = 0
 
 
 def update_filters(ironic=None):
@@ -83,47 +112,263 @@ def update_filters(ironic=None):
 
     Gives access to PXE boot port for any machine, except for those,
     whose MAC is registered in Ironic and is not on introspection right now.
+    Ports registered in Ironic are taken from ``port_cache``, which is
+    updated by the periodic task.
 
     This function is called from both introspection initialization code and
     from periodic task. This function is supposed to be resistant to unexpected
-    iptables state.
+    iptables state. Nothing is done if the blacklist has not changed since
+    the previous call, otherwise only the changed MAC's are added or removed.
+    Every ``firewall_resync_period`` seconds the whole chain (or the set with
+    ``firewall_use_ipset``) is replaced instead. Either way only one call to
+    ``iptables-restore`` (or ``ipset restore``) is done.
 
     ``init()`` function must be called once before any call to this function.
-    This function is using ``eventlet`` semaphore to serialize access from
-    different green threads.
+    Concurrent calls are coalesced: the caller only marks the firewall as
+    requiring an update and waits for the next update to be applied. Updates
+    are applied by one green thread at most once per
+    ``firewall_update_window`` seconds.
 
     Does nothing, if firewall management is disabled in configuration.
 
-    :param ironic: Ironic client instance, optional.
+    :param ironic: Ironic client instance, optional, only used if ports
+                   were never fetched.
+    :raises: any exception raised by the update, which is then propagated
+             to all waiting callers.
     """
     if not CONF.discoverd.manage_firewall:
         return
 
+    applied = _request_update(ironic)
+    with metrics.timed('firewall.request_wait'):
+        applied.wait()
+
+
+def request_update(ironic=None):
+    """Request a firewall update without waiting for it.
+
+    The update is applied by the same green thread as for ``update_filters``,
+    so the firewall lags behind the request by at most
+    ``firewall_update_window`` seconds plus the duration of one update.
+    Failures are only logged, the next update will retry.
+
+    Does nothing, if firewall management is disabled in configuration.
+
+    :param ironic: Ironic client instance, optional, only used if ports
+                   were never fetched.
+    """
+    if not CONF.discoverd.manage_firewall:
+        return
+
+    _request_update(ironic)
+
+
+def _request_update(ironic):
+    global _PENDING, _WORKER
     assert INTERFACE is not None
-    ironic = utils.get_client() if ironic is None else ironic
 
-    with LOCK:
-        macs_active = set(p.address for p in ironic.port.list(limit=0))
-        to_blacklist = macs_active - node_cache.active_macs()
-        LOG.debug('Blacklisting active MAC\'s %s', to_blacklist)
+    if _PENDING is None:
+        _PENDING = event.Event()
+    applied = _PENDING
+    if _WORKER is None:
+        _WORKER = eventlet.greenthread.spawn(_update_worker, ironic)
+    return applied
+
+
+def _update_worker(ironic):
+    """Apply requested updates until there are no more requests."""
+    global _PENDING, _WORKER, _LAST_UPDATE
+    try:
+        while _PENDING is not None:
+            delay = (_LAST_UPDATE + CONF.discoverd.firewall_update_window
+                     - time.time())
+            if delay > 0:
+                eventlet.greenthread.sleep(delay)
+
+            # Requests coming from now on need another update
+            applied, _PENDING = _PENDING, None
+            try:
+                _update_filters(ironic)
+            except Exception as exc:
+                LOG.exception(_LE('Failed to update the firewall'))
+                metrics.increment('firewall.failures')
+                applied.send_exception(exc)
+            else:
+                applied.send()
+            _LAST_UPDATE = time.time()
+    finally:
+        _WORKER = None
+
+
+def _update_filters(ironic=None):
+    with metrics.timed('firewall.lock_wait'):
+        LOCK.acquire()
+    try:
+        with metrics.timed('firewall.update'):
+            _do_update(ironic)
+    finally:
+        LOCK.release()
+
+
+def _do_update(ironic):
+    global BLACKLIST, LAST_RESYNC
+    macs_active = port_cache.addresses(ironic)
+    to_blacklist = macs_active - node_cache.active_macs()
+    LOG.debug('Blacklisting active MAC\'s %s', to_blacklist)
+
+    resync_period = CONF.discoverd.firewall_resync_period
+    if BLACKLIST is None or (resync_period > 0 and
+                             time.time() - LAST_RESYNC >= resync_period):
+        LOG.debug('Doing full update of the firewall')
+        BLACKLIST = None
+        _driver().update(to_blacklist)
+        LAST_RESYNC = time.time()
+        metrics.increment('firewall.full_updates')
+        metrics.gauge('firewall.changes', len(to_blacklist))
+    elif to_blacklist != BLACKLIST:
+        added = to_blacklist - BLACKLIST
+        removed = BLACKLIST - to_blacklist
+        LOG.debug('Updating the firewall: adding %(added)s, removing '
+                  '%(removed)s', {'added': added, 'removed': removed})
+        # Do a full update next time if the firewall state is unknown
+        previous, BLACKLIST = BLACKLIST, None
+        _driver().update(to_blacklist, previous)
+        metrics.increment('firewall.delta_updates')
+        metrics.gauge('firewall.changes', len(added) + len(removed))
+    else:
+        LOG.debug('Blacklist has not changed, not updating the firewall')
+        metrics.increment('firewall.skipped_updates')
+        metrics.gauge('firewall.changes', 0)
+
+    BLACKLIST = to_blacklist
+    metrics.gauge('firewall.blacklist_size', len(to_blacklist))
+
 
-        # Clean up a bit to account for possible troubles on previous run
+# iptables driver, used by default
+
+
+def _iptables(*args, **kwargs):
+    cmd = ('iptables',) + args
+    ignore = kwargs.pop('ignore', False)
+    LOG.debug('Running iptables %s', args)
+    kwargs['stderr'] = subprocess.STDOUT
+    try:
+        subprocess.check_output(cmd, **kwargs)
+    except subprocess.CalledProcessError as exc:
+        if ignore:
+            LOG.debug('ignoring failed iptables %s:\n%s', args, exc.output)
+        else:
+            LOG.error(_LE('iptables %(iptables)s failed:\n%(exc)s') %
+                      {'iptables': args, 'exc': exc.output})
+            raise
+
+
+def _iptables_restore(rules):
+    """Apply rules in iptables-restore format atomically.
+
+    Uses ``--noflush``, so only chains mentioned in the rules are flushed.
+
+    :param rules: list of lines without the table header and COMMIT.
+    """
+    run_with_input(('iptables-restore', '--noflush'),
+                   '\n'.join(['*filter'] + rules + ['COMMIT', '']))
+
+
+def _ipset_restore(commands, ignore=False):
+    """Run several ipset commands with one ``ipset restore`` call.
+
+    :param commands: list of ipset commands without the leading ``ipset``.
+    :param ignore: whether to ignore failures.
+    """
+    run_with_input(('ipset', 'restore'), '\n'.join(commands + ['']),
+                   ignore=ignore)
+
+
+def _jump_rule(chain):
+    return ['-i', INTERFACE, '-p', 'udp', '--dport', '67', '-j', chain]
+
+
+def _clean_up(chain):
+    _iptables('-D', 'INPUT', *_jump_rule(chain), ignore=True)
+    _iptables('-F', chain, ignore=True)
+    _iptables('-X', chain, ignore=True)
+
+
+def _chain_rules(to_blacklist=()):
+    """Rules for the chain, blacklisting given MAC's or the set members."""
+    if CONF.discoverd.firewall_use_ipset:
+        rules = ['-A %s -m set --match-set %s src -j DROP' % (CHAIN, SET)]
+    else:
+        rules = ['-A %s -m mac --mac-source %s -j DROP' % (CHAIN, mac)
+                 for mac in sorted(to_blacklist)]
+    # Whitelist everything else
+    rules.append('-A %s -j ACCEPT' % CHAIN)
+    return rules
+
+
+class IptablesDriver(plugins_base.FirewallDriver):
+    """Firewall driver using iptables and optionally ipset.
+
+    Packets to the DHCP port are passed to a separate chain, which either
+    drops every blacklisted MAC with a separate rule or, with
+    ``firewall_use_ipset``, drops members of an ipset of type hash:mac.
+    """
+
+    def init(self):
+        _clean_up(CHAIN)
         _clean_up(NEW_CHAIN)
-        # Operate on temporary chain
-        _iptables('-N', NEW_CHAIN)
-        # - Blacklist active macs, so that nova can boot them
-        for mac in to_blacklist:
-            _iptables('-A', NEW_CHAIN, '-m', 'mac',
-                      '--mac-source', mac, '-j', 'DROP')
-        # - Whitelist everything else
-        _iptables('-A', NEW_CHAIN, '-j', 'ACCEPT')
-
-        # Swap chains
-        _iptables('-I', 'INPUT', '-i', INTERFACE, '-p', 'udp',
-                  '--dport', '67', '-j', NEW_CHAIN)
-        _iptables('-D', 'INPUT', '-i', INTERFACE, '-p', 'udp',
-                  '--dport', '67', '-j', CHAIN,
-                  ignore=True)
-        _iptables('-F', CHAIN, ignore=True)
-        _iptables('-X', CHAIN, ignore=True)
-        _iptables('-E', NEW_CHAIN, CHAIN)
+        rules = [':%s - [0:0]' % CHAIN]
+        if CONF.discoverd.firewall_use_ipset:
+            # The chain never changes afterwards, update() replaces the set
+            # contents instead
+            _ipset_restore(['create %s hash:mac -exist' % SET,
+                            'flush %s' % SET])
+            rules.extend(_chain_rules())
+        # Otherwise the chain stays empty until update() fills it
+        rules.append(' '.join(['-I', 'INPUT'] + _jump_rule(CHAIN)))
+        _iptables_restore(rules)
+
+    def update(self, blacklist, previous=None):
+        if previous is None:
+            self._replace(blacklist)
+        else:
+            self._apply_delta(blacklist - previous, previous - blacklist)
+
+    def clean_up(self):
+        _clean_up(CHAIN)
+        _clean_up(NEW_CHAIN)
+        if CONF.discoverd.firewall_use_ipset:
+            # The set can only be destroyed when no rules
+            # reference it
+            _ipset_restore(['destroy %s' % NEW_SET], ignore=True)
+            _ipset_restore(['destroy %s' % SET], ignore=True)
+
+    def _replace(self, to_blacklist):
+        """Replace the blacklist completely."""
+        if CONF.discoverd.firewall_use_ipset:
+            # Fill in a new set and swap it with the one used by the chain
+            _ipset_restore(['create %s hash:mac -exist' % NEW_SET,
+                            'flush %s' % NEW_SET] +
+                           ['add %s %s' % (NEW_SET, mac)
+                            for mac in sorted(to_blacklist)] +
+                           ['swap %s %s' % (NEW_SET, SET),
+                            'destroy %s' % NEW_SET])
+        else:
+            # Declaring an existing chain with --noflush
+            # flushes it, the whole chain is replaced in one transaction
+            _iptables_restore([':%s - [0:0]' % CHAIN] +
+                              _chain_rules(to_blacklist))
+
+    def _apply_delta(self, added, removed):
+        """Add and remove some MAC's from the blacklist."""
+        if CONF.discoverd.firewall_use_ipset:
+            _ipset_restore(['del %s %s -exist' % (SET, mac)
+                            for mac in sorted(removed)] +
+                           ['add %s %s -exist' % (SET, mac)
+                            for mac in sorted(added)])
+        else:
+            # New rules go on top, so that they precede the final ACCEPT
+            _iptables_restore(['-D %s -m mac --mac-source %s -j DROP' %
+                               (CHAIN, mac) for mac in sorted(removed)] +
+                              ['-I %s 1 -m mac --mac-source %s -j DROP' %
+                               (CHAIN, mac) for mac in sorted(added)])
@@ -0,0 +1,128 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shared pool of keep-alive HTTP connections for Ironic and Keystone.
+
+Pool statistics are recorded as ``http.*`` metrics.
+"""
+
+import collections
+
+from eventlet import semaphore
+from oslo_config import cfg
+import requests
+from requests import adapters
+from six.moves.urllib import parse
+
+from ironic_discoverd import metrics
+
+
+CONF = cfg.CONF
+# Maximum number of per-host connection pools kept
+_MAX_HOSTS = 10
+
+_SESSION = None
+_ADAPTER = None
+
+
+class PooledAdapter(adapters.HTTPAdapter):
+    """HTTP adapter limiting the total number of connections in use.
+
+    At most ``per_host`` connections are kept open to every host, requests
+    above this limit or above ``size`` requests in total wait for a free
+    connection.
+
+    Numbers of connections are counted by the adapter itself: a host is
+    assumed to have as many open connections as it had requests running at
+    the same time (up to ``per_host``), until it is evicted from the pool
+    in favour of more recently used hosts. A connection is assumed closed
+    when a request on it fails. Connections closed by the server while idle
+    are not noticed, so the number of idle connections is an upper bound.
+    """
+
+    def __init__(self, size, per_host):
+        self._semaphore = semaphore.Semaphore(size)
+        self._per_host = per_host
+        self.in_use = 0
+        # (scheme, host, port) -> [requests running, connections open],
+        # least recently used first
+        self._hosts = collections.OrderedDict()
+        super(PooledAdapter, self).__init__(pool_connections=_MAX_HOSTS,
+                                            pool_maxsize=per_host,
+                                            pool_block=True)
+
+    def send(self, request, **kwargs):
+        key = _host_key(request.url)
+        with metrics.timed('http.pool_wait'):
+            self._semaphore.acquire()
+        self._check_out(key)
+        failed = True
+        try:
+            response = super(PooledAdapter, self).send(request, **kwargs)
+            failed = False
+            return response
+        finally:
+            self._check_in(key, failed)
+            self._semaphore.release()
+            metrics.gauge('http.in_use', self.in_use)
+            metrics.gauge('http.idle', self.idle())
+
+    def _check_out(self, key):
+        counts = self._hosts.pop(key, [0, 0])
+        # Re-insert to mark the host as the most recently used one
+        self._hosts[key] = counts
+        while len(self._hosts) > _MAX_HOSTS:
+            self._hosts.popitem(last=False)
+        counts[0] += 1
+        counts[1] = max(counts[1], min(counts[0], self._per_host))
+        self.in_use += 1
+        metrics.gauge('http.in_use', self.in_use)
+
+    def _check_in(self, key, failed=False):
+        self.in_use -= 1
+        counts = self._hosts.get(key)
+        if counts is not None:
+            counts[0] -= 1
+            if failed:
+                # urllib3 does not return broken connections to its pool
+                counts[1] = max(0, counts[1] - 1)
+
+    def idle(self):
+        """Get upper bound of number of open connections not used now."""
+        return sum(max(0, opened - min(running, self._per_host))
+                   for (running, opened) in self._hosts.values())
+
+
+def _host_key(url):
+    parsed = parse.urlsplit(url)
+    return (parsed.scheme, parsed.hostname, parsed.port)
+
+
+def get_session():
+    """Get the requests session shared by all HTTP clients."""
+    global _SESSION, _ADAPTER
+    if _SESSION is None:
+        _ADAPTER = PooledAdapter(CONF.discoverd.http_pool_size,
+                                 CONF.discoverd.http_pool_size_per_host)
+        _SESSION = requests.Session()
+        _SESSION.mount('http://', _ADAPTER)
+        _SESSION.mount('https://', _ADAPTER)
+    return _SESSION
+
+
+def reset():
+    """Close all connections and drop the pool."""
+    global _SESSION, _ADAPTER
+    if _SESSION is not None:
+        _SESSION.close()
+    _SESSION = _ADAPTER = None
@@ -65,15 +65,12 @@ def _validate_ipmi_credentials(node, new_ipmi_credentials):
     return new_username, new_password
 
 
-def introspect(uuid, new_ipmi_credentials=None):
-    """Initiate hardware properties introspection for a given node.
+def _validate(ironic, uuid, new_ipmi_credentials=None):
+    """Check that a node can be introspected.
 
-    :param uuid: node uuid
-    :param new_ipmi_credentials: tuple (new username, new password) or None
+    :returns: tuple (node, validated new_ipmi_credentials)
     :raises: Error
     """
-    ironic = utils.get_client()
-
     try:
         node = ironic.node.get(uuid)
     except exceptions.NotFound:
@@ -95,10 +92,68 @@ def introspect(uuid, new_ipmi_credentials=None):
             raise utils.Error(msg % {'node': node.uuid,
                                      'reason': validation.power['reason']})
 
-    cached_node = node_cache.add_node(node.uuid,
+    return node, new_ipmi_credentials
+
+
+def introspect(uuid, new_ipmi_credentials=None):
+    """Initiate hardware properties introspection for a given node.
+
+    :param uuid: node uuid
+    :param new_ipmi_credentials: tuple (new username, new password) or None
+    :raises: Error
+    """
+    ironic = utils.get_client()
+    node, new_ipmi_credentials = _validate(ironic, uuid, new_ipmi_credentials)
+
+    options = None
+    if new_ipmi_credentials:
+        options = {'new_ipmi_credentials': new_ipmi_credentials}
+    cached_node = node_cache.add_node(node.uuid, options=options,
                                       bmc_address=utils.get_ipmi_address(node))
-    cached_node.set_option('new_ipmi_credentials', new_ipmi_credentials)
+    _start(ironic, cached_node)
+
+
+def introspect_many(uuids):
+    """Initiate hardware properties introspection for several nodes.
+
+    All nodes are stored in the node cache at once. Failure to start
+    introspection for some nodes does not prevent starting it for others.
+
+    :param uuids: list of node uuid's
+    :raises: Error describing nodes for which introspection failed to start
+    """
+    ironic = utils.get_client()
+
+    errors = {}
+    validated = []
+    for uuid in uuids:
+        try:
+            validated.append(_validate(ironic, uuid)[0])
+        except utils.Error as exc:
+            errors[uuid] = exc
+
+    utils.resolve_ipmi_addresses(validated)
+    nodes = {}
+    for node in validated:
+        try:
+            nodes[node.uuid] = {'bmc_address': utils.get_ipmi_address(node)}
+        except utils.Error as exc:
+            errors[node.uuid] = exc
+
+    cached_nodes, failed = node_cache.add_nodes(nodes)
+    errors.update(failed)
+    for cached_node in cached_nodes.values():
+        _start(ironic, cached_node)
+
+    if len(errors) == 1:
+        raise list(errors.values())[0]
+    elif errors:
+        raise utils.Error(_('Failed to start introspection for nodes: %s') %
+                          '; '.join('%s: %s' % item
+                                    for item in sorted(errors.items())))
+
 
+def _start(ironic, cached_node):
     def _handle_exceptions():
         try:
             _background_introspect(ironic, cached_node)
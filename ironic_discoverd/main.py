@@ -28,8 +28,10 @@ from ironic_discoverd.common.i18n import _, _LC, _LE, _LI, _LW
 from ironic_discoverd import conf  # noqa
 from ironic_discoverd import firewall
 from ironic_discoverd import introspect
+from ironic_discoverd import metrics
 from ironic_discoverd import node_cache
 from ironic_discoverd.plugins import base as plugins_base
+from ironic_discoverd import port_cache
 from ironic_discoverd import process
 from ironic_discoverd import utils
 
@@ -39,6 +41,10 @@ CONF = cfg.CONF
 app = flask.Flask(__name__)
 LOG = logging.getLogger('ironic_discoverd.main')
 
+# Options that only make sense with a value of at least one
+POSITIVE_OPTIONS = ('clean_up_batch_size', 'port_update_concurrency',
+                    'processing_workers')
+
 
 def convert_exceptions(func):
     @functools.wraps(func)
@@ -57,8 +63,13 @@ def api_continue():
     data = flask.request.get_json(force=True)
     LOG.debug("/v1/continue got JSON %s", data)
 
-    res = process.process(data)
-    return json.dumps(res), 200, {'Content-Type': 'applications/json'}
+    if CONF.discoverd.process_asynchronously:
+        res = process.process_async(data)
+        code = 202
+    else:
+        res = process.process(data)
+        code = 200
+    return json.dumps(res), code, {'Content-Type': 'applications/json'}
 
 
 @app.route('/v1/introspection/<uuid>', methods=['GET', 'POST'])
@@ -90,6 +101,24 @@ def api_introspection(uuid):
                                   error=node_info.error or None)
 
 
+@app.route('/v1/introspection', methods=['GET'])
+@convert_exceptions
+def api_introspection_list():
+    utils.check_auth(flask.request)
+
+    uuids = flask.request.args.getlist('uuid') or None
+    if uuids is not None:
+        for uuid in uuids:
+            if not uuidutils.is_uuid_like(uuid):
+                raise utils.Error(_('Invalid UUID value'), code=400)
+
+    nodes = [{'uuid': node_info.uuid,
+              'finished': bool(node_info.finished_at),
+              'error': node_info.error or None}
+             for node_info in node_cache.get_nodes(uuids)]
+    return flask.json.jsonify(introspection=nodes)
+
+
 @app.route('/v1/discover', methods=['POST'])
 @convert_exceptions
 def api_discover():
@@ -102,15 +131,22 @@ def api_discover():
         if not uuidutils.is_uuid_like(uuid):
             raise utils.Error(_('Invalid UUID value'), code=400)
 
-    for uuid in data:
-        introspect.introspect(uuid)
+    introspect.introspect_many(data)
     return "", 202
 
 
+@app.route('/v1/metrics', methods=['GET'])
+@convert_exceptions
+def api_metrics():
+    utils.check_auth(flask.request)
+    return flask.json.jsonify(**metrics.snapshot())
+
+
 def periodic_update(period):  # pragma: no cover
     while True:
         LOG.debug('Running periodic update of filters')
         try:
+            port_cache.update()
             firewall.update_filters()
         except Exception:
             LOG.exception(_LE('Periodic update failed'))
@@ -155,6 +191,13 @@ def check_ironic_available():
 
 
 def init():
+    for name in POSITIVE_OPTIONS:
+        if CONF.discoverd[name] < 1:
+            LOG.critical(_LC('Configuration option discoverd.%(name)s should '
+                             'be a positive integer, got %(value)s'),
+                         {'name': name, 'value': CONF.discoverd[name]})
+            sys.exit(1)
+
     if CONF.discoverd.authenticate:
         utils.add_auth_middleware(app)
     else:
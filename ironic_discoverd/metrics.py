@@ -0,0 +1,107 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Simple in-process metrics exposed via the HTTP API.
+
+All metrics are kept in memory and are reset on restart. Green threads
+switch only on I/O, so no locking is required.
+"""
+
+import contextlib
+import time
+
+
+# Upper bounds of timer buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+_COUNTERS = {}
+_GAUGES = {}
+_TIMERS = {}
+
+
+class _Timer(object):
+    """Histogram of durations."""
+
+    __slots__ = ('count', 'sum', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[index] += 1
+                break
+
+    def to_dict(self):
+        # Buckets are cumulative, as in Prometheus
+        buckets = {}
+        total = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            total += count
+            buckets[str(bound)] = total
+        buckets['+Inf'] = self.count
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'buckets': buckets}
+
+
+def increment(name, value=1):
+    """Increment a counter."""
+    _COUNTERS[name] = _COUNTERS.get(name, 0) + value
+
+
+def gauge(name, value):
+    """Set a gauge to the current value."""
+    _GAUGES[name] = value
+
+
+def timing(name, seconds):
+    """Record a duration in seconds."""
+    timer = _TIMERS.get(name)
+    if timer is None:
+        timer = _TIMERS[name] = _Timer()
+    timer.add(seconds)
+
+
+@contextlib.contextmanager
+def timed(name):
+    """Context manager recording duration of its body.
+
+    The duration is recorded even if the body raises an exception.
+    """
+    started_at = time.time()
+    try:
+        yield
+    finally:
+        timing(name, time.time() - started_at)
+
+
+def snapshot():
+    """Get all metrics as a JSON-compatible dictionary."""
+    return {'counters': dict(_COUNTERS),
+            'gauges': dict(_GAUGES),
+            'timers': {name: timer.to_dict()
+                       for (name, timer) in _TIMERS.items()}}
+
+
+def reset():
+    """Drop all metrics."""
+    _COUNTERS.clear()
+    _GAUGES.clear()
+    _TIMERS.clear()
@@ -21,9 +21,12 @@ import sqlite3
 import sys
 import time
 
+import eventlet
+from eventlet import pools
 from oslo_config import cfg
 
-from ironic_discoverd.common.i18n import _, _LC, _LE
+from ironic_discoverd.common.i18n import _, _LC, _LE, _LI, _LW
+from ironic_discoverd.plugins import base as plugins_base
 from ironic_discoverd import utils
 
 CONF = cfg.CONF
@@ -31,6 +34,8 @@ CONF = cfg.CONF
 
 LOG = logging.getLogger("ironic_discoverd.node_cache")
 _DB_NAME = None
+_POOL = None
+_INDEX = None
 _SCHEMA = """
 create table if not exists nodes
  (uuid text primary key, started_at real, finished_at real, error text);
@@ -45,40 +50,73 @@ create table if not exists options
   primary key (uuid, name),
   foreign key (uuid) references nodes);
 """
+# Every item upgrades the schema to the next version, never
+# modify existing items, append a new one instead
+_MIGRATIONS = [
+    _SCHEMA,
+    # Version 2: indexes for deleting by node UUID and for clean up
+    """
+create index if not exists attributes_uuid_idx on attributes(uuid);
+create index if not exists nodes_started_at_idx on nodes(started_at);
+create index if not exists nodes_finished_at_idx on nodes(finished_at);
+""",
+]
 
 
 MACS_ATTRIBUTE = 'mac'
+# SQLite allows at most 999 parameters per query, leave room for a few extra
+_MAX_PARAMETERS = 500
 
 
 class NodeInfo(object):
-    """Record about a node in the cache."""
+    """Record about a node in the cache.
+
+    Options and look up attributes are only loaded from the database when
+    first accessed.
+    """
+
+    # Thousands of these may be in flight during large
+    # deployments, so avoid per-instance dictionaries
+    __slots__ = ('uuid', 'started_at', 'finished_at', 'error',
+                 '_options', '_attributes')
 
-    def __init__(self, uuid, started_at, finished_at=None, error=None):
+    def __init__(self, uuid, started_at, finished_at=None, error=None,
+                 options=None, attributes=None):
         self.uuid = uuid
         self.started_at = started_at
         self.finished_at = finished_at
         self.error = error
         self.invalidate_cache()
+        if options is not None:
+            self._options = dict(options)
+        if attributes is not None:
+            self._attributes = {name: list(values)
+                                for (name, values) in attributes.items()}
 
     @property
     def options(self):
         """Node introspection options as a dict."""
         if self._options is None:
-            rows = _db().execute('select name, value from options '
-                                 'where uuid=?', (self.uuid,))
-            self._options = {row['name']: json.loads(row['value'])
-                             for row in rows}
+            rows = _driver().get_options(self.uuid)
+            self._options = {name: json.loads(value)
+                             for (name, value) in rows.items()}
         return self._options
 
+    @property
+    def attributes(self):
+        """Node look up attributes as a dict name -> list of values."""
+        if self._attributes is None:
+            self._attributes = _driver().get_attributes(self.uuid)
+        return self._attributes
+
     def set_option(self, name, value):
-        """Set an option for a node."""
-        encoded = json.dumps(value)
-        self.options[name] = value
-        with _db() as db:
-            db.execute('delete from options where uuid=? and name=?',
-                       (self.uuid, name))
-            db.execute('insert into options(uuid, name, value) values(?,?,?)',
-                       (self.uuid, name, encoded))
+        """Set an option for a node.
+
+        Options are not loaded from the database if they are not cached yet.
+        """
+        _driver().set_option(self.uuid, name, json.dumps(value))
+        if self._options is not None:
+            self._options[name] = value
 
     def finished(self, error=None):
         """Record status for this node.
@@ -89,113 +127,105 @@ class NodeInfo(object):
         """
         self.finished_at = time.time()
         self.error = error
+        _driver().finished(self.uuid, self.finished_at, error)
+        self._options = {}
+        self._attributes = {}
 
-        with _db() as db:
-            db.execute('update nodes set finished_at=?, error=? where uuid=?',
-                       (self.finished_at, error, self.uuid))
-            db.execute("delete from attributes where uuid=?", (self.uuid,))
-            db.execute("delete from options where uuid=?", (self.uuid,))
-
-    def add_attribute(self, name, value, database=None):
+    def add_attribute(self, name, value):
         """Store look up attribute for a node in the database.
 
         :param name: attribute name
         :param value: attribute value or list of possible values
-        :param database: optional existing database connection
         :raises: Error if attributes values are already in database
         """
         if not isinstance(value, list):
             value = [value]
 
-        with _maybe_db(database) as db:
-            try:
-                db.executemany("insert into attributes(name, value, uuid) "
-                               "values(?, ?, ?)",
-                               [(name, v, self.uuid) for v in value])
-            except sqlite3.IntegrityError as exc:
-                LOG.error(_LE('Database integrity error %s during '
-                              'adding attributes'), exc)
-                raise utils.Error(_(
-                    'Some or all of %(name)s\'s %(value)s are already '
-                    'on introspection') % {'name': name, 'value': value})
+        _driver().add_attribute(self.uuid, name, value)
+        if self._attributes is not None:
+            self._attributes.setdefault(name, []).extend(value)
 
     @classmethod
     def from_row(cls, row):
         """Construct NodeInfo from a database row."""
-        fields = {key: row[key]
-                  for key in ('uuid', 'started_at', 'finished_at', 'error')}
-        return cls(**fields)
+        return cls(uuid=row['uuid'], started_at=row['started_at'],
+                   finished_at=row['finished_at'], error=row['error'])
 
     def invalidate_cache(self):
         """Clear all cached info, so that it's reloaded next time."""
         self._options = None
+        self._attributes = None
 
 
-def init():
-    """Initialize the database."""
-    global _DB_NAME
-
-    _DB_NAME = CONF.discoverd.database.strip()
-    if not _DB_NAME:
-        LOG.critical(_LC('Configuration option discoverd.database'
-                         ' should be set'))
-        sys.exit(1)
-
-    db_dir = os.path.dirname(_DB_NAME)
-    if db_dir and not os.path.exists(db_dir):
-        os.makedirs(db_dir)
-    sqlite3.connect(_DB_NAME).executescript(_SCHEMA)
-
+def _driver():
+    return plugins_base.node_cache_driver()
 
-def _db():
-    if _DB_NAME is None:
-        init()
-    conn = sqlite3.connect(_DB_NAME)
-    conn.row_factory = sqlite3.Row
-    return conn
 
-
-@contextlib.contextmanager
-def _maybe_db(db=None):
-    if db is None:
-        with _db() as db:
-            yield db
-    else:
-        yield db
+def init():
+    """Initialize the node cache storage."""
+    _driver().init()
 
 
-def add_node(uuid, **attributes):
+def add_node(uuid, options=None, **attributes):
     """Store information about a node under introspection.
 
     All existing information about this node is dropped.
     Empty values are skipped.
 
     :param uuid: Ironic node UUID
+    :param options: optional dict of options to set for this node, stored
+                    in the same transaction as the node
     :param attributes: attributes known about this node (like macs, BMC etc)
     :returns: NodeInfo
     """
     started_at = time.time()
-    with _db() as db:
-        db.execute("delete from nodes where uuid=?", (uuid,))
-        db.execute("delete from attributes where uuid=?", (uuid,))
-        db.execute("delete from options where uuid=?", (uuid,))
+    options = options or {}
+    attributes = _prepare_attributes(attributes)
+    _driver().add_node(uuid, started_at, attributes, _encode_options(options))
+    return NodeInfo(uuid=uuid, started_at=started_at, options=options,
+                    attributes=attributes)
+
+
+def add_nodes(nodes, options=None):
+    """Store information about several nodes under introspection at once.
+
+    Same as calling add_node for every node, but uses as few database
+    transactions as the driver allows. Nodes with attributes conflicting
+    with other nodes are not stored, other nodes are stored anyway.
+
+    :param nodes: dict node UUID -> dict of attributes known about this node
+                  (like macs, BMC etc)
+    :param options: optional dict node UUID -> dict of options to set
+    :returns: tuple (dict node UUID -> NodeInfo for stored nodes,
+              dict node UUID -> Error for nodes that were not stored)
+    """
+    started_at = time.time()
+    options = options or {}
+    prepared = {
+        uuid: (_prepare_attributes(attributes),
+               _encode_options(options.get(uuid, {})))
+        for (uuid, attributes) in nodes.items()
+    }
+    failed = _driver().add_nodes(started_at, prepared)
+    added = {uuid: NodeInfo(uuid=uuid, started_at=started_at,
+                            options=options.get(uuid, {}),
+                            attributes=prepared[uuid][0])
+             for uuid in nodes if uuid not in failed}
+    return added, failed
+
 
-        db.execute("insert into nodes(uuid, started_at) "
-                   "values(?, ?)", (uuid, started_at))
+def _prepare_attributes(attributes):
+    return {name: value if isinstance(value, list) else [value]
+            for (name, value) in attributes.items() if value}
 
-        node_info = NodeInfo(uuid=uuid, started_at=started_at)
-        for (name, value) in attributes.items():
-            if not value:
-                continue
-            node_info.add_attribute(name, value, database=db)
 
-    return node_info
+def _encode_options(options):
+    return {name: json.dumps(value) for (name, value) in options.items()}
 
 
 def active_macs():
     """List all MAC's that are on introspection right now."""
-    return {x[0] for x in _db().execute("select value from attributes "
-                                        "where name=?", (MACS_ATTRIBUTE,))}
+    return _driver().attribute_values(MACS_ATTRIBUTE)
 
 
 def get_node(uuid):
@@ -204,13 +234,26 @@ def get_node(uuid):
     :param uuid: node UUID.
     :returns: structure NodeInfo.
     """
-    row = _db().execute('select * from nodes where uuid=?', (uuid,)).fetchone()
+    row = _driver().get_node(uuid)
     if row is None:
         raise utils.Error(_('Could not find node %s in cache') % uuid,
                           code=404)
     return NodeInfo.from_row(row)
 
 
+def get_nodes(uuids=None):
+    """Get several nodes from cache in one go.
+
+    Unknown UUID's are silently skipped.
+
+    :param uuids: list of node UUID's, None to get all nodes.
+    :returns: list of NodeInfo objects sorted by introspection start time.
+    """
+    rows = _driver().get_nodes(uuids)
+    return [NodeInfo.from_row(row)
+            for row in sorted(rows, key=lambda row: row['started_at'])]
+
+
 def find_node(**attributes):
     """Find node in cache.
 
@@ -219,8 +262,7 @@ def find_node(**attributes):
     :raises: Error if node is not found
     """
     # NOTE(dtantsur): sorting is not required, but gives us predictability
-    found = set()
-    db = _db()
+    lookup = {}
     for (name, value) in sorted(attributes.items()):
         if not value:
             LOG.debug('Empty value for attribute %s', name)
@@ -230,12 +272,9 @@ def find_node(**attributes):
 
         LOG.debug('Trying to use %s of value %s for node look up'
                   % (name, value))
-        rows = db.execute('select distinct uuid from attributes where ' +
-                          ' OR '.join('name=? AND value=?' for _ in value),
-                          sum(([name, v] for v in value), [])).fetchall()
-        if rows:
-            found.update(item[0] for item in rows)
+        lookup[name] = value
 
+    found = _driver().lookup(lookup) if lookup else set()
     if not found:
         raise utils.Error(_(
             'Could not find a node for attributes %s') % attributes, code=404)
@@ -245,8 +284,7 @@ def find_node(**attributes):
             % {'attr': attributes, 'found': list(found)}, code=404)
 
     uuid = found.pop()
-    row = db.execute('select started_at, finished_at from nodes where uuid=?',
-                     (uuid,)).fetchone()
+    row = _driver().get_node(uuid)
     if not row:
         raise utils.Error(_(
             'Could not find node %s in introspection cache, '
@@ -266,35 +304,409 @@ def clean_up():
     * Finish introspection for timed out nodes.
     * Drop outdated node status information.
 
+    Drivers are expected to do this work in transactions of at most
+    ``clean_up_batch_size`` nodes, yielding to other green threads between
+    them.
+
     :return: list of timed out node UUID's
     """
-    status_keep_threshold = (time.time() -
+    started_at = time.time()
+    status_keep_threshold = (started_at -
                              CONF.discoverd.node_status_keep_time)
 
-    with _db() as db:
-        db.execute('delete from nodes where finished_at < ?',
-                   (status_keep_threshold,))
+    purged = _driver().delete_finished(status_keep_threshold)
 
+    uuids = []
     timeout = CONF.discoverd.timeout
-    if timeout <= 0:
-        return []
-
-    threshold = time.time() - timeout
-    with _db() as db:
-        uuids = [row[0] for row in
-                 db.execute('select uuid from nodes where '
-                            'started_at < ? and finished_at is null',
-                            (threshold,))]
-        if not uuids:
-            return []
-
-        LOG.error(_LE('Introspection for nodes %s has timed out'), uuids)
-        db.execute('update nodes set finished_at=?, error=? '
-                   'where started_at < ? and finished_at is null',
-                   (time.time(), 'Introspection timeout', threshold))
-        db.executemany('delete from attributes where uuid=?',
-                       [(u,) for u in uuids])
-        db.executemany('delete from options where uuid=?',
-                       [(u,) for u in uuids])
+    if timeout > 0:
+        threshold = time.time() - timeout
+        uuids = _driver().time_out(threshold, time.time(),
+                                   'Introspection timeout')
+        if uuids:
+            LOG.error(_LE('Introspection for nodes %s has timed out'), uuids)
+
+    if purged or uuids:
+        LOG.info(_LI('Clean up purged status of %(purged)d nodes and timed '
+                     'out %(timed_out)d nodes in %(time).2f seconds'),
+                 {'purged': purged, 'timed_out': len(uuids),
+                  'time': time.time() - started_at})
 
     return uuids
+
+
+def attributes_conflict(name, values):
+    """Create an exception for attribute values belonging to other nodes."""
+    return utils.Error(_('Some or all of %(name)s\'s %(value)s are already '
+                         'on introspection') % {'name': name, 'value': values})
+
+
+def find_conflicts(nodes, owner):
+    """Find nodes with attributes belonging to other nodes.
+
+    Helper for implementing NodeCacheDriver.add_nodes. Values belonging to
+    other nodes from the same call are also considered conflicting.
+
+    :param nodes: dict node UUID -> tuple (attributes, options)
+    :param owner: function (name, value) -> UUID of a node that currently
+                  owns the attribute value or None
+    :returns: dict node UUID -> Error for conflicting nodes
+    """
+    failed = {}
+    claimed = {}
+    # Sorting is not required, but gives us predictability
+    for (uuid, (attributes, _options)) in sorted(nodes.items()):
+        keys = []
+        for (name, values) in sorted(attributes.items()):
+            if (len(set(values)) != len(values) or
+                    any(owner(name, value) not in (None, uuid) or
+                        (name, value) in claimed for value in values)):
+                failed[uuid] = attributes_conflict(name, values)
+                break
+            keys.extend((name, value) for value in values)
+        else:
+            claimed.update((key, uuid) for key in keys)
+    return failed
+
+
+# SQLite driver, used by default
+
+
+class _AttributesIndex(object):
+    """In-memory copy of the attributes table used for look up.
+
+    The database stays the source of truth, this index is loaded from it on
+    start up and is updated after every committed change of attributes.
+    """
+
+    def __init__(self):
+        self._uuids = {}
+        self._by_uuid = {}
+        self._by_name = {}
+
+    def add(self, uuid, name, values):
+        """Add values of the attribute for a node."""
+        for value in values:
+            self._uuids[(name, value)] = uuid
+            self._by_uuid.setdefault(uuid, set()).add((name, value))
+            self._by_name.setdefault(name, set()).add(value)
+
+    def drop(self, uuid):
+        """Drop all attributes of a node."""
+        for name, value in self._by_uuid.pop(uuid, ()):
+            del self._uuids[(name, value)]
+            self._by_name[name].discard(value)
+
+    def get(self, name, value):
+        """Get UUID of a node with given attribute value or None."""
+        return self._uuids.get((name, value))
+
+    def values(self, name):
+        """Get all values of the attribute as a set."""
+        return set(self._by_name.get(name, ()))
+
+    def attributes(self, uuid):
+        """Get all attributes of a node as a dict name -> list of values."""
+        result = {}
+        for name, value in self._by_uuid.get(uuid, ()):
+            result.setdefault(name, []).append(value)
+        return result
+
+
+class _ConnectionPool(pools.Pool):
+    """Bounded pool of connections to the node cache database."""
+
+    def create(self):
+        conn = _connect()
+        # Transactions are started and finished explicitly in _db(), the
+        # implicit ones of the sqlite3 module differ between Python versions
+        conn.isolation_level = None
+        return conn
+
+
+def _init_db():
+    """Initialize the database and the connection pool."""
+    global _DB_NAME, _POOL, _INDEX
+
+    _DB_NAME = CONF.discoverd.database.strip()
+    if not _DB_NAME:
+        LOG.critical(_LC('Configuration option discoverd.database'
+                         ' should be set'))
+        sys.exit(1)
+
+    db_dir = os.path.dirname(_DB_NAME)
+    if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+    with contextlib.closing(_connect()) as conn:
+        # Journal mode is persistent, other pragmas have to
+        # be set for every connection, see _connect()
+        mode = conn.execute('pragma journal_mode=%s' %
+                            CONF.discoverd.database_journal_mode).fetchone()
+        LOG.debug('Using journal mode %s for the database', mode[0])
+        _upgrade(conn)
+
+        index = _AttributesIndex()
+        for row in conn.execute('select name, value, uuid from attributes'):
+            index.add(row['uuid'], row['name'], [row['value']])
+
+    _INDEX = index
+    _POOL = _ConnectionPool(max_size=CONF.discoverd.database_pool_size)
+
+
+def _upgrade(conn):
+    """Apply missing schema migrations."""
+    conn.execute('create table if not exists schema_version '
+                 '(version integer primary key)')
+    current = conn.execute('select max(version) from schema_version'
+                           ).fetchone()[0] or 0
+    for version in range(current + 1, len(_MIGRATIONS) + 1):
+        LOG.info(_LI('Upgrading database schema to version %d'), version)
+        # DDL is transactional in SQLite, so a failed
+        # migration does not leave the schema half-upgraded
+        conn.executescript('begin;\n%s\n'
+                           'insert into schema_version(version) values(%d);\n'
+                           'commit;' % (_MIGRATIONS[version - 1], version))
+
+
+def _connect():
+    conn = sqlite3.connect(_DB_NAME)
+    conn.row_factory = sqlite3.Row
+    conn.execute('pragma synchronous=%s' %
+                 CONF.discoverd.database_synchronous)
+    # Negative value means size in KiB rather than in pages
+    conn.execute('pragma cache_size=%d' %
+                 -CONF.discoverd.database_cache_size)
+    conn.execute('pragma mmap_size=%d' % CONF.discoverd.database_mmap_size)
+    return conn
+
+
+def _index():
+    if _POOL is None:
+        _init_db()
+    return _INDEX
+
+
+@contextlib.contextmanager
+def _db(begin='begin'):
+    """Get a connection from the pool.
+
+    The connection is returned to the pool on exit. A transaction is started
+    with the given statement, changes are committed on success and rolled
+    back on exception.
+    """
+    if _POOL is None:
+        _init_db()
+    with _POOL.item() as conn:
+        conn.execute(begin)
+        committed = False
+        try:
+            yield conn
+            conn.execute('commit')
+            committed = True
+        finally:
+            if not committed:
+                try:
+                    conn.execute('rollback')
+                except sqlite3.OperationalError:
+                    # SQLite might have rolled back the transaction already
+                    pass
+
+
+def _insert_attributes(db, uuid, name, values):
+    try:
+        db.executemany("insert into attributes(name, value, uuid) "
+                       "values(?, ?, ?)",
+                       [(name, v, uuid) for v in values])
+    except sqlite3.IntegrityError as exc:
+        LOG.error(_LE('Database integrity error %s during '
+                      'adding attributes'), exc)
+        raise attributes_conflict(name, values)
+
+
+def _batch_size():
+    return min(CONF.discoverd.clean_up_batch_size, _MAX_PARAMETERS)
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class SQLiteDriver(plugins_base.NodeCacheDriver):
+    """Node cache in a local SQLite database.
+
+    Keeps an in-memory index of attributes, thus the database must not be
+    shared between several processes.
+    """
+
+    def init(self):
+        _init_db()
+
+    def add_node(self, uuid, started_at, attributes, options=None):
+        with _db() as db:
+            db.execute("delete from nodes where uuid=?", (uuid,))
+            db.execute("delete from attributes where uuid=?", (uuid,))
+            db.execute("delete from options where uuid=?", (uuid,))
+
+            db.execute("insert into nodes(uuid, started_at) "
+                       "values(?, ?)", (uuid, started_at))
+
+            for (name, values) in attributes.items():
+                _insert_attributes(db, uuid, name, values)
+
+            if options:
+                db.executemany("insert into options(uuid, name, value) "
+                               "values(?, ?, ?)",
+                               [(uuid, name, value)
+                                for (name, value) in options.items()])
+
+        index = _index()
+        index.drop(uuid)
+        for (name, values) in attributes.items():
+            index.add(uuid, name, values)
+
+    def add_nodes(self, started_at, nodes):
+        try:
+            return self._add_nodes(started_at, nodes)
+        except sqlite3.IntegrityError as exc:
+            # The index does not reflect changes made since the conflicts
+            # were checked, let the database detect conflicts for every
+            # node separately
+            LOG.warning(_LW('Database integrity error %s during adding '
+                            'nodes, retrying one by one'), exc)
+            return super(SQLiteDriver, self).add_nodes(started_at, nodes)
+
+    def _add_nodes(self, started_at, nodes):
+        index = _index()
+        failed = find_conflicts(nodes, index.get)
+        added = [(uuid,) for uuid in nodes if uuid not in failed]
+
+        with _db() as db:
+            db.executemany("delete from nodes where uuid=?", added)
+            db.executemany("delete from attributes where uuid=?", added)
+            db.executemany("delete from options where uuid=?", added)
+
+            db.executemany("insert into nodes(uuid, started_at) "
+                           "values(?, ?)",
+                           [(uuid, started_at) for (uuid,) in added])
+            db.executemany("insert into attributes(name, value, uuid) "
+                           "values(?, ?, ?)",
+                           [(name, value, uuid) for (uuid,) in added
+                            for (name, values) in nodes[uuid][0].items()
+                            for value in values])
+            db.executemany("insert into options(uuid, name, value) "
+                           "values(?, ?, ?)",
+                           [(uuid, name, value) for (uuid,) in added
+                            for (name, value) in nodes[uuid][1].items()])
+
+        for (uuid,) in added:
+            index.drop(uuid)
+            for (name, values) in nodes[uuid][0].items():
+                index.add(uuid, name, values)
+
+        return failed
+
+    def add_attribute(self, uuid, name, values):
+        with _db() as db:
+            _insert_attributes(db, uuid, name, values)
+        _index().add(uuid, name, values)
+
+    def attribute_values(self, name):
+        return _index().values(name)
+
+    def lookup(self, attributes):
+        index = _index()
+        return {uuid for uuid in (index.get(name, value)
+                                  for (name, values) in attributes.items()
+                                  for value in values)
+                if uuid is not None}
+
+    def get_attributes(self, uuid):
+        return _index().attributes(uuid)
+
+    def get_node(self, uuid):
+        with _db() as db:
+            return db.execute('select * from nodes where uuid=?',
+                              (uuid,)).fetchone()
+
+    def get_nodes(self, uuids=None):
+        with _db() as db:
+            if uuids is None:
+                return db.execute('select * from nodes').fetchall()
+
+            rows = []
+            # SQLite limits the number of query parameters
+            for chunk in _chunks(list(uuids), _MAX_PARAMETERS):
+                rows.extend(db.execute('select * from nodes where uuid in '
+                                       '(%s)' % ','.join('?' * len(chunk)),
+                                       chunk))
+            return rows
+
+    def finished(self, uuid, finished_at, error):
+        with _db() as db:
+            db.execute('update nodes set finished_at=?, error=? where uuid=?',
+                       (finished_at, error, uuid))
+            db.execute("delete from attributes where uuid=?", (uuid,))
+            db.execute("delete from options where uuid=?", (uuid,))
+        _index().drop(uuid)
+
+    def get_options(self, uuid):
+        with _db() as db:
+            rows = db.execute('select name, value from options '
+                              'where uuid=?', (uuid,))
+            return {row['name']: row['value'] for row in rows}
+
+    def set_option(self, uuid, name, value):
+        with _db() as db:
+            db.execute('insert or replace into options(uuid, name, value) '
+                       'values(?, ?, ?)', (uuid, name, value))
+
+    def delete_finished(self, finished_before):
+        batch_size = _batch_size()
+        purged = 0
+        while True:
+            with _db() as db:
+                count = db.execute(
+                    'delete from nodes where uuid in '
+                    '(select uuid from nodes where finished_at < ? limit ?)',
+                    (finished_before, batch_size)).rowcount
+            purged += count
+            if count < batch_size:
+                return purged
+            # Give other green threads a chance to use the database
+            eventlet.greenthread.sleep(0)
+
+    def time_out(self, started_before, finished_at, error):
+        with _db() as db:
+            uuids = [row[0] for row in
+                     db.execute('select uuid from nodes where '
+                                'started_at < ? and finished_at is null',
+                                (started_before,))]
+
+        timed_out = []
+        for chunk in _chunks(uuids, _batch_size()):
+            # Nodes may have been restarted or finished since the select
+            # above, so check them again with the write lock held
+            with _db('begin immediate') as db:
+                placeholders = ','.join('?' * len(chunk))
+                chunk = [row[0] for row in
+                         db.execute('select uuid from nodes where '
+                                    'started_at < ? and finished_at is null '
+                                    'and uuid in (%s)' % placeholders,
+                                    [started_before] + chunk)]
+                if chunk:
+                    placeholders = ','.join('?' * len(chunk))
+                    db.execute('update nodes set finished_at=?, error=? '
+                               'where uuid in (%s)' % placeholders,
+                               [finished_at, error] + chunk)
+                    db.execute('delete from attributes where uuid in (%s)'
+                               % placeholders, chunk)
+                    db.execute('delete from options where uuid in (%s)'
+                               % placeholders, chunk)
+
+            index = _index()
+            for uuid in chunk:
+                index.drop(uuid)
+            timed_out.extend(chunk)
+            eventlet.greenthread.sleep(0)
+
+        return timed_out
@@ -17,8 +17,11 @@ import abc
 
 from oslo_config import cfg
 import six
+from stevedore import driver
 from stevedore import named
 
+from ironic_discoverd import utils
+
 
 CONF = cfg.CONF
 
@@ -63,7 +66,157 @@ class ProcessingHook(object):  # pragma: no cover
         """
 
 
+@six.add_metaclass(abc.ABCMeta)
+class NodeCacheDriver(object):  # pragma: no cover
+    """Abstract base class for node cache storage drivers.
+
+    Drivers only store data, all logic and error reporting (except for
+    attribute conflicts) is done in ``ironic_discoverd.node_cache``.
+    Node records are dictionaries with keys ``uuid``, ``started_at``,
+    ``finished_at`` and ``error``. Option values are JSON-encoded strings.
+    """
+
+    def init(self):
+        """Initialize the storage, called once on start up."""
+
+    @abc.abstractmethod
+    def add_node(self, uuid, started_at, attributes, options=None):
+        """Store a node dropping all existing information about it.
+
+        Must be atomic: nothing is changed if an error is raised.
+
+        :param uuid: node UUID.
+        :param started_at: introspection start time.
+        :param attributes: dict attribute name -> list of values.
+        :param options: optional dict option name -> encoded value.
+        :raises: utils.Error if some attribute values belong to other nodes.
+        """
+
+    def add_nodes(self, started_at, nodes):
+        """Store several nodes dropping all existing information about them.
+
+        Nodes with attributes conflicting with other nodes are skipped.
+        The default implementation calls add_node for every node, drivers
+        should override it to use one transaction.
+
+        :param started_at: introspection start time.
+        :param nodes: dict node UUID -> tuple (attributes, options), where
+                      attributes are as for add_node and options is a dict
+                      name -> encoded value.
+        :returns: dict node UUID -> utils.Error for skipped nodes.
+        """
+        failed = {}
+        for (uuid, (attributes, options)) in nodes.items():
+            try:
+                self.add_node(uuid, started_at, attributes, options)
+            except utils.Error as exc:
+                failed[uuid] = exc
+        return failed
+
+    @abc.abstractmethod
+    def add_attribute(self, uuid, name, values):
+        """Store look up attribute values for a node.
+
+        :param uuid: node UUID.
+        :param name: attribute name.
+        :param values: list of values.
+        :raises: utils.Error if some values belong to other nodes.
+        """
+
+    @abc.abstractmethod
+    def attribute_values(self, name):
+        """Get all stored values of an attribute as a set."""
+
+    @abc.abstractmethod
+    def lookup(self, attributes):
+        """Find nodes having any of the given attribute values.
+
+        :param attributes: dict attribute name -> list of values.
+        :returns: set of node UUID's.
+        """
+
+    @abc.abstractmethod
+    def get_attributes(self, uuid):
+        """Get attributes of a node as a dict name -> list of values."""
+
+    @abc.abstractmethod
+    def get_node(self, uuid):
+        """Get a node record or None if not found."""
+
+    @abc.abstractmethod
+    def get_nodes(self, uuids=None):
+        """Get several node records in one query.
+
+        :param uuids: list of node UUID's, None to get all nodes.
+        :returns: list of node records in any order, unknown UUID's are
+                  skipped.
+        """
+
+    @abc.abstractmethod
+    def finished(self, uuid, finished_at, error):
+        """Mark node as finished and drop its attributes and options."""
+
+    @abc.abstractmethod
+    def get_options(self, uuid):
+        """Get options of a node as a dict name -> encoded value."""
+
+    @abc.abstractmethod
+    def set_option(self, uuid, name, value):
+        """Set an encoded option value for a node.
+
+        Replaces an existing value, if any.
+        """
+
+    @abc.abstractmethod
+    def delete_finished(self, finished_before):
+        """Delete status of nodes finished before given time.
+
+        :returns: number of deleted nodes.
+        """
+
+    @abc.abstractmethod
+    def time_out(self, started_before, finished_at, error):
+        """Finish nodes that were started before given time and not finished.
+
+        :returns: list of UUID's of timed out nodes.
+        """
+
+
+@six.add_metaclass(abc.ABCMeta)
+class FirewallDriver(object):  # pragma: no cover
+    """Abstract base class for firewall drivers.
+
+    Drivers only apply the rules, the blacklist is calculated in
+    ``ironic_discoverd.firewall``, which also serializes calls to drivers.
+    Drivers should raise an exception if rules were not applied.
+    """
+
+    @abc.abstractmethod
+    def init(self):
+        """Set up rules allowing access to the DHCP port for everyone.
+
+        Called on start up, should drop everything left over from previous
+        runs.
+        """
+
+    @abc.abstractmethod
+    def update(self, blacklist, previous=None):
+        """Block access to the DHCP port for given MAC addresses.
+
+        :param blacklist: set of MAC addresses to block.
+        :param previous: set of MAC addresses blocked by the previous call or
+                         None to replace the blacklist completely. If set,
+                         the driver may only apply the difference.
+        """
+
+    @abc.abstractmethod
+    def clean_up(self):
+        """Remove all rules, called on exit."""
+
+
 _HOOKS_MGR = None
+_NODE_CACHE_DRIVER = None
+_FIREWALL_DRIVER = None
 
 
 def processing_hooks_manager(*args):
@@ -82,3 +235,25 @@ def processing_hooks_manager(*args):
                                                  invoke_args=args,
                                                  name_order=True)
     return _HOOKS_MGR
+
+
+def node_cache_driver():
+    """Get the node cache driver configured by ``node_cache_driver``."""
+    global _NODE_CACHE_DRIVER
+    if _NODE_CACHE_DRIVER is None:
+        _NODE_CACHE_DRIVER = driver.DriverManager(
+            'ironic_discoverd.node_cache',
+            name=CONF.discoverd.node_cache_driver,
+            invoke_on_load=True).driver
+    return _NODE_CACHE_DRIVER
+
+
+def firewall_driver():
+    """Get the firewall driver configured by ``firewall_driver``."""
+    global _FIREWALL_DRIVER
+    if _FIREWALL_DRIVER is None:
+        _FIREWALL_DRIVER = driver.DriverManager(
+            'ironic_discoverd.firewall',
+            name=CONF.discoverd.firewall_driver,
+            invoke_on_load=True).driver
+    return _FIREWALL_DRIVER
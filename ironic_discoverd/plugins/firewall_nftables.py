@@ -0,0 +1,75 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Firewall driver using nftables.
+
+Creates a separate table with a named set of blacklisted MAC addresses and a
+chain dropping DHCP requests from them. All changes are applied atomically
+with one ``nft -f`` call.
+
+Unlike the iptables driver, it cannot override rules from other tables, so
+DHCP requests still have to be allowed by the rest of the firewall.
+"""
+
+from oslo_config import cfg
+
+from ironic_discoverd import firewall
+from ironic_discoverd.plugins import base
+
+
+CONF = cfg.CONF
+TABLE = 'inet ironic_discoverd'
+SET = 'blacklist'
+CHAIN = 'discovery'
+
+
+def _nft(commands):
+    firewall.run_with_input(('nft', '-f', '-'), '\n'.join(commands + ['']))
+
+
+def _elements(command, macs):
+    if not macs:
+        return []
+    return ['%s element %s %s { %s }' % (command, TABLE, SET,
+                                         ', '.join(sorted(macs)))]
+
+
+class NftablesDriver(base.FirewallDriver):
+    """Firewall driver using nftables with a named set of MAC's."""
+
+    def init(self):
+        # Declaring the table first makes deleting it work
+        # even if it does not exist yet
+        _nft(['table %s' % TABLE,
+              'delete table %s' % TABLE,
+              'table %s {' % TABLE,
+              '    set %s { type ether_addr; }' % SET,
+              '    chain %s {' % CHAIN,
+              '        type filter hook input priority 0; policy accept;',
+              '        iifname "%s" udp dport 67 ether saddr @%s drop' %
+              (CONF.discoverd.dnsmasq_interface, SET),
+              '    }',
+              '}'])
+
+    def update(self, blacklist, previous=None):
+        if previous is None:
+            commands = ['flush set %s %s' % (TABLE, SET)]
+            commands.extend(_elements('add', blacklist))
+        else:
+            commands = (_elements('delete', previous - blacklist) +
+                        _elements('add', blacklist - previous))
+        _nft(commands)
+
+    def clean_up(self):
+        _nft(['table %s' % TABLE,
+              'delete table %s' % TABLE])
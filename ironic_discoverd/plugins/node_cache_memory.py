@@ -0,0 +1,125 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Node cache driver keeping everything in memory.
+
+Nothing survives a restart, so this driver is only suitable for tests and
+experiments.
+"""
+
+from ironic_discoverd import node_cache
+from ironic_discoverd.plugins import base
+
+
+class MemoryDriver(base.NodeCacheDriver):
+    """Node cache in plain Python dictionaries."""
+
+    def __init__(self):
+        self.init()
+
+    def init(self):
+        self._nodes = {}
+        self._attributes = {}
+        self._options = {}
+
+    def _drop(self, uuid):
+        self._attributes = {key: value
+                            for (key, value) in self._attributes.items()
+                            if value != uuid}
+        self._options.pop(uuid, None)
+
+    def _check_attributes(self, uuid, name, values):
+        if (len(set(values)) != len(values) or
+                any(self._attributes.get((name, value), uuid) != uuid
+                    for value in values)):
+            raise node_cache.attributes_conflict(name, values)
+
+    def add_node(self, uuid, started_at, attributes, options=None):
+        for (name, values) in attributes.items():
+            self._check_attributes(uuid, name, values)
+
+        self._drop(uuid)
+        self._nodes[uuid] = {'uuid': uuid, 'started_at': started_at,
+                             'finished_at': None, 'error': None}
+        for (name, values) in attributes.items():
+            for value in values:
+                self._attributes[(name, value)] = uuid
+        if options:
+            self._options[uuid] = dict(options)
+
+    def add_nodes(self, started_at, nodes):
+        failed = node_cache.find_conflicts(
+            nodes, lambda name, value: self._attributes.get((name, value)))
+        for (uuid, (attributes, options)) in nodes.items():
+            if uuid not in failed:
+                self.add_node(uuid, started_at, attributes, options)
+        return failed
+
+    def add_attribute(self, uuid, name, values):
+        # Unlike add_node, existing values of the same node also conflict
+        self._check_attributes(None, name, values)
+        for value in values:
+            self._attributes[(name, value)] = uuid
+
+    def attribute_values(self, name):
+        return {value for (attr, value) in self._attributes if attr == name}
+
+    def lookup(self, attributes):
+        return {self._attributes[(name, value)]
+                for (name, values) in attributes.items()
+                for value in values
+                if (name, value) in self._attributes}
+
+    def get_attributes(self, uuid):
+        result = {}
+        for ((name, value), owner) in self._attributes.items():
+            if owner == uuid:
+                result.setdefault(name, []).append(value)
+        return result
+
+    def get_node(self, uuid):
+        node = self._nodes.get(uuid)
+        return dict(node) if node is not None else None
+
+    def get_nodes(self, uuids=None):
+        if uuids is None:
+            uuids = self._nodes
+        return [dict(self._nodes[uuid]) for uuid in uuids
+                if uuid in self._nodes]
+
+    def finished(self, uuid, finished_at, error):
+        if uuid in self._nodes:
+            self._nodes[uuid].update(finished_at=finished_at, error=error)
+        self._drop(uuid)
+
+    def get_options(self, uuid):
+        return dict(self._options.get(uuid, {}))
+
+    def set_option(self, uuid, name, value):
+        self._options.setdefault(uuid, {})[name] = value
+
+    def delete_finished(self, finished_before):
+        old = [uuid for (uuid, node) in self._nodes.items()
+               if node['finished_at'] is not None
+               and node['finished_at'] < finished_before]
+        for uuid in old:
+            del self._nodes[uuid]
+        return len(old)
+
+    def time_out(self, started_before, finished_at, error):
+        uuids = [uuid for (uuid, node) in self._nodes.items()
+                 if node['finished_at'] is None
+                 and node['started_at'] < started_before]
+        for uuid in uuids:
+            self.finished(uuid, finished_at, error)
+        return uuids
@@ -0,0 +1,279 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Node cache driver storing data in any database supported by SQLAlchemy.
+
+Unlike the default SQLite driver, it keeps no state in the process, so
+several **ironic-discoverd** instances can share the same database.
+Requires SQLAlchemy, see plugin-requirements.txt.
+"""
+
+import logging
+import sys
+
+import eventlet
+from oslo_config import cfg
+import sqlalchemy as sa
+from sqlalchemy import exc as sa_exc
+
+from ironic_discoverd.common.i18n import _LC, _LE, _LW
+from ironic_discoverd import node_cache
+from ironic_discoverd.plugins import base
+
+
+CONF = cfg.CONF
+LOG = logging.getLogger('ironic_discoverd.plugins.node_cache_sqlalchemy')
+
+METADATA = sa.MetaData()
+NODES = sa.Table(
+    'nodes', METADATA,
+    sa.Column('uuid', sa.String(36), primary_key=True),
+    # Plain Float is single precision on MySQL, which is
+    # not enough for time stamps
+    sa.Column('started_at', sa.Float(precision=53), index=True),
+    sa.Column('finished_at', sa.Float(precision=53), index=True),
+    sa.Column('error', sa.Text))
+ATTRIBUTES = sa.Table(
+    'attributes', METADATA,
+    sa.Column('name', sa.String(255), primary_key=True),
+    sa.Column('value', sa.String(255), primary_key=True),
+    sa.Column('uuid', sa.String(36), sa.ForeignKey('nodes.uuid'),
+              index=True))
+OPTIONS = sa.Table(
+    'options', METADATA,
+    sa.Column('uuid', sa.String(36), sa.ForeignKey('nodes.uuid'),
+              primary_key=True),
+    sa.Column('name', sa.String(255), primary_key=True),
+    sa.Column('value', sa.Text))
+
+
+def _insert_attributes(conn, uuid, name, values):
+    try:
+        conn.execute(ATTRIBUTES.insert(),
+                     [{'name': name, 'value': value, 'uuid': uuid}
+                      for value in values])
+    except sa_exc.IntegrityError as exc:
+        LOG.error(_LE('Database integrity error %s during '
+                      'adding attributes'), exc)
+        raise node_cache.attributes_conflict(name, values)
+
+
+class SQLAlchemyDriver(base.NodeCacheDriver):
+    """Node cache in a database configured by ``database_connection``."""
+
+    def __init__(self):
+        self._engine = None
+
+    def init(self):
+        url = CONF.discoverd.database_connection
+        if not url:
+            LOG.critical(_LC('Configuration option '
+                             'discoverd.database_connection should be set'))
+            sys.exit(1)
+
+        kwargs = {}
+        if sa.engine.url.make_url(url).get_backend_name() != 'sqlite':
+            kwargs['pool_size'] = CONF.discoverd.database_pool_size
+        self._engine = sa.create_engine(url, **kwargs)
+        METADATA.create_all(self._engine)
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self.init()
+        return self._engine
+
+    def _drop(self, conn, uuid):
+        # Mind the order, nodes are referenced by other tables
+        conn.execute(ATTRIBUTES.delete().where(ATTRIBUTES.c.uuid == uuid))
+        conn.execute(OPTIONS.delete().where(OPTIONS.c.uuid == uuid))
+
+    def add_node(self, uuid, started_at, attributes, options=None):
+        with self.engine.begin() as conn:
+            self._drop(conn, uuid)
+            conn.execute(NODES.delete().where(NODES.c.uuid == uuid))
+            conn.execute(NODES.insert().values(uuid=uuid,
+                                               started_at=started_at))
+            for (name, values) in attributes.items():
+                _insert_attributes(conn, uuid, name, values)
+            if options:
+                conn.execute(OPTIONS.insert(),
+                             [{'uuid': uuid, 'name': name, 'value': value}
+                              for (name, value) in options.items()])
+
+    def add_nodes(self, started_at, nodes):
+        try:
+            return self._add_nodes(started_at, nodes)
+        except sa_exc.IntegrityError as exc:
+            # Another instance has changed attributes concurrently, let
+            # the database detect conflicts for every node separately
+            LOG.warning(_LW('Database integrity error %s during adding '
+                            'nodes, retrying one by one'), exc)
+            return super(SQLAlchemyDriver, self).add_nodes(started_at, nodes)
+
+    def _add_nodes(self, started_at, nodes):
+        keys = [(name, value) for (attributes, _options) in nodes.values()
+                for (name, values) in attributes.items()
+                for value in values]
+        with self.engine.begin() as conn:
+            owners = {}
+            if keys:
+                condition = sa.or_(*[sa.and_(ATTRIBUTES.c.name == name,
+                                             ATTRIBUTES.c.value == value)
+                                     for (name, value) in keys])
+                owners = {(row.name, row.value): row.uuid
+                          for row in conn.execute(ATTRIBUTES.select().where(
+                              condition))}
+
+            failed = node_cache.find_conflicts(
+                nodes, lambda name, value: owners.get((name, value)))
+            added = [uuid for uuid in nodes if uuid not in failed]
+            if not added:
+                return failed
+
+            for table in (ATTRIBUTES, OPTIONS, NODES):
+                conn.execute(table.delete().where(table.c.uuid.in_(added)))
+
+            conn.execute(NODES.insert(), [{'uuid': uuid,
+                                           'started_at': started_at}
+                                          for uuid in added])
+            attributes = [{'name': name, 'value': value, 'uuid': uuid}
+                          for uuid in added
+                          for (name, values) in nodes[uuid][0].items()
+                          for value in values]
+            if attributes:
+                conn.execute(ATTRIBUTES.insert(), attributes)
+            options = [{'uuid': uuid, 'name': name, 'value': value}
+                       for uuid in added
+                       for (name, value) in nodes[uuid][1].items()]
+            if options:
+                conn.execute(OPTIONS.insert(), options)
+
+        return failed
+
+    def add_attribute(self, uuid, name, values):
+        with self.engine.begin() as conn:
+            _insert_attributes(conn, uuid, name, values)
+
+    def attribute_values(self, name):
+        with self.engine.connect() as conn:
+            return {row[0] for row in conn.execute(
+                sa.select([ATTRIBUTES.c.value]).where(
+                    ATTRIBUTES.c.name == name))}
+
+    def lookup(self, attributes):
+        condition = sa.or_(*[sa.and_(ATTRIBUTES.c.name == name,
+                                     ATTRIBUTES.c.value == value)
+                             for (name, values) in attributes.items()
+                             for value in values])
+        with self.engine.connect() as conn:
+            return {row[0] for row in conn.execute(
+                sa.select([ATTRIBUTES.c.uuid]).where(condition).distinct())}
+
+    def get_attributes(self, uuid):
+        result = {}
+        with self.engine.connect() as conn:
+            for row in conn.execute(sa.select(
+                    [ATTRIBUTES.c.name, ATTRIBUTES.c.value]).where(
+                        ATTRIBUTES.c.uuid == uuid)):
+                result.setdefault(row.name, []).append(row.value)
+        return result
+
+    def get_node(self, uuid):
+        with self.engine.connect() as conn:
+            row = conn.execute(NODES.select().where(
+                NODES.c.uuid == uuid)).fetchone()
+        return dict(row) if row is not None else None
+
+    def get_nodes(self, uuids=None):
+        query = NODES.select()
+        if uuids is not None:
+            query = query.where(NODES.c.uuid.in_(list(uuids)))
+        with self.engine.connect() as conn:
+            return [dict(row) for row in conn.execute(query)]
+
+    def finished(self, uuid, finished_at, error):
+        with self.engine.begin() as conn:
+            conn.execute(NODES.update().where(NODES.c.uuid == uuid).values(
+                finished_at=finished_at, error=error))
+            self._drop(conn, uuid)
+
+    def get_options(self, uuid):
+        with self.engine.connect() as conn:
+            return {row.name: row.value for row in conn.execute(
+                sa.select([OPTIONS.c.name, OPTIONS.c.value]).where(
+                    OPTIONS.c.uuid == uuid))}
+
+    def set_option(self, uuid, name, value):
+        # There is no portable upsert, but an update is
+        # enough in the common case of an existing option
+        with self.engine.begin() as conn:
+            updated = conn.execute(OPTIONS.update().where(sa.and_(
+                OPTIONS.c.uuid == uuid,
+                OPTIONS.c.name == name)).values(value=value)).rowcount
+            if not updated:
+                conn.execute(OPTIONS.insert().values(uuid=uuid, name=name,
+                                                     value=value))
+
+    def delete_finished(self, finished_before):
+        batch_size = CONF.discoverd.clean_up_batch_size
+        purged = 0
+        while True:
+            # Not every database supports LIMIT in
+            # sub-queries, so fetch UUID's first
+            with self.engine.begin() as conn:
+                uuids = [row[0] for row in conn.execute(
+                    sa.select([NODES.c.uuid]).where(
+                        NODES.c.finished_at < finished_before).limit(
+                            batch_size))]
+                if uuids:
+                    conn.execute(NODES.delete().where(
+                        NODES.c.uuid.in_(uuids)))
+            purged += len(uuids)
+            if len(uuids) < batch_size:
+                return purged
+            eventlet.greenthread.sleep(0)
+
+    def time_out(self, started_before, finished_at, error):
+        with self.engine.connect() as conn:
+            uuids = [row[0] for row in conn.execute(
+                sa.select([NODES.c.uuid]).where(sa.and_(
+                    NODES.c.started_at < started_before,
+                    NODES.c.finished_at.is_(None))))]
+
+        timed_out = []
+        batch_size = CONF.discoverd.clean_up_batch_size
+        for start in range(0, len(uuids), batch_size):
+            chunk = uuids[start:start + batch_size]
+            with self.engine.begin() as conn:
+                # Nodes may have been restarted since the
+                # select above, possibly by another process; lock the ones
+                # that were not, so that they cannot be restarted until
+                # the end of the transaction
+                chunk = [row[0] for row in conn.execute(
+                    sa.select([NODES.c.uuid]).where(sa.and_(
+                        NODES.c.uuid.in_(chunk),
+                        NODES.c.started_at < started_before,
+                        NODES.c.finished_at.is_(None))).with_for_update())]
+                if chunk:
+                    conn.execute(NODES.update().where(
+                        NODES.c.uuid.in_(chunk)).values(
+                            finished_at=finished_at, error=error))
+                    conn.execute(ATTRIBUTES.delete().where(
+                        ATTRIBUTES.c.uuid.in_(chunk)))
+                    conn.execute(OPTIONS.delete().where(
+                        OPTIONS.c.uuid.in_(chunk)))
+            timed_out.extend(chunk)
+            eventlet.greenthread.sleep(0)
+
+        return timed_out
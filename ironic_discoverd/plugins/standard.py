@@ -24,6 +24,7 @@ from oslo_config import cfg
 from ironic_discoverd.common.i18n import _, _LC, _LI, _LW
 from ironic_discoverd import conf
 from ironic_discoverd.plugins import base
+from ironic_discoverd import port_cache
 from ironic_discoverd import utils
 
 CONF = cfg.CONF
@@ -158,6 +159,7 @@ class ValidateInterfacesHook(base.ProcessingHook):
                           'expected': list(sorted(expected_macs)),
                           'node': node.uuid})
                 ironic.port.delete(port.uuid)
+                port_cache.remove(port.uuid)
 
 
 class RamdiskErrorHook(base.ProcessingHook):
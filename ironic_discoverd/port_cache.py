@@ -0,0 +1,156 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cache of MAC addresses of all Ironic ports."""
+
+import logging
+import time
+
+from eventlet import semaphore
+from ironicclient import exceptions
+from oslo_config import cfg
+
+from ironic_discoverd.common.i18n import _LW
+from ironic_discoverd import utils
+
+
+CONF = cfg.CONF
+LOG = logging.getLogger("ironic_discoverd.port_cache")
+# Port UUID -> MAC address
+_PORTS = None
+# UUID of the most recently created port seen
+_MARKER = None
+_LAST_RESYNC = 0
+# Changes made by add and remove while ports are being fetched, list of
+# tuples (port UUID, MAC address or None for removed ports)
+_PENDING = None
+LOCK = semaphore.BoundedSemaphore()
+
+
+def reset():
+    """Drop all cached information."""
+    global _PORTS, _MARKER, _PENDING
+    _PORTS = None
+    _MARKER = None
+    _PENDING = None
+
+
+def addresses(ironic=None):
+    """Get MAC addresses of all ports as a set.
+
+    Ports are fetched from Ironic only if the cache was never filled, the
+    result may miss ports deleted or changed in Ironic within the last
+    ``port_cache_resync_period`` seconds.
+
+    :param ironic: Ironic client instance, optional.
+    """
+    if _PORTS is None:
+        with LOCK:
+            # Another thread may have filled the cache while we waited
+            if _PORTS is None:
+                _update(utils.get_client() if ironic is None else ironic)
+    return set(_PORTS.values())
+
+
+def update(ironic=None):
+    """Fetch ports created since the last update.
+
+    Ports are sorted by creation time, so only ports created after the last
+    seen one are fetched. Deleted ports and changed addresses cannot be
+    detected this way, thus they are only picked up every
+    ``port_cache_resync_period`` seconds, when all ports are fetched instead.
+    The cached ports stay available while ports are fetched.
+
+    :param ironic: Ironic client instance, optional.
+    """
+    ironic = utils.get_client() if ironic is None else ironic
+    with LOCK:
+        _update(ironic)
+
+
+def _update(ironic):
+    global _PORTS, _MARKER, _LAST_RESYNC, _PENDING
+    resync_period = CONF.discoverd.port_cache_resync_period
+    resync = _PORTS is None or (resync_period > 0 and
+                                time.time() - _LAST_RESYNC >= resync_period)
+
+    _PENDING = []
+    try:
+        if not resync and _MARKER is not None:
+            try:
+                ports = _list(ironic, marker=_MARKER)
+            except (exceptions.BadRequest, exceptions.NotFound) as exc:
+                # Most likely the marker port was deleted
+                LOG.warning(_LW('Cannot fetch new ports after %(marker)s, '
+                                'fetching all ports: %(exc)s'),
+                            {'marker': _MARKER, 'exc': exc})
+                resync = True
+            else:
+                _store(_PORTS, ports)
+                _apply(_PORTS, _PENDING)
+                return
+
+        ports = _list(ironic)
+        LOG.debug('Fetched all %d ports', len(ports))
+        # Build the new cache aside, so that the old one can
+        # still be used while ports are fetched
+        new_ports = {}
+        _MARKER = None
+        _store(new_ports, ports)
+        _apply(new_ports, _PENDING)
+        _PORTS = new_ports
+        _LAST_RESYNC = time.time()
+    finally:
+        _PENDING = None
+
+
+def _list(ironic, **kwargs):
+    return list(ironic.port.list(limit=0, sort_key='created_at',
+                                 sort_dir='asc', **kwargs))
+
+
+def _store(target, ports):
+    global _MARKER
+    target.update((port.uuid, port.address) for port in ports)
+    if ports:
+        _MARKER = ports[-1].uuid
+
+
+def _apply(target, changes):
+    for (uuid, address) in changes:
+        if address is None:
+            target.pop(uuid, None)
+        else:
+            target[uuid] = address
+
+
+def add(ports):
+    """Store ports created by this service without fetching them.
+
+    Does nothing if the cache was never filled and is not being filled.
+
+    :param ports: list of port objects
+    """
+    changes = [(port.uuid, port.address) for port in ports]
+    if _PENDING is not None:
+        _PENDING.extend(changes)
+    if _PORTS is not None:
+        _apply(_PORTS, changes)
+
+
+def remove(uuid):
+    """Forget a port deleted by this service."""
+    if _PENDING is not None:
+        _PENDING.append((uuid, None))
+    if _PORTS is not None:
+        _PORTS.pop(uuid, None)
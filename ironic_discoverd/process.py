@@ -17,18 +17,24 @@ import logging
 
 import eventlet
 from ironicclient import exceptions
+from oslo_config import cfg
 
 from ironic_discoverd.common.i18n import _, _LE, _LI, _LW
 from ironic_discoverd import firewall
 from ironic_discoverd import node_cache
 from ironic_discoverd.plugins import base as plugins_base
+from ironic_discoverd import port_cache
 from ironic_discoverd import utils
 
 
+CONF = cfg.CONF
 LOG = logging.getLogger("ironic_discoverd.process")
 
 _CREDENTIALS_WAIT_RETRIES = 10
 _CREDENTIALS_WAIT_PERIOD = 3
+# Queue of data to process in background and green threads processing it
+_QUEUE = None
+_WORKERS = []
 
 
 def process(node_info):
@@ -36,6 +42,68 @@ def process(node_info):
 
     This function heavily relies on the hooks to do the actual data processing.
     """
+    ironic, node, cached_node = _look_up(node_info)
+    return _process_node_with_errors(ironic, node, node_info, cached_node)
+
+
+def process_async(node_info):
+    """Look up the node and process data from the ramdisk in background.
+
+    Pre-processing hooks and the node look up are run synchronously, the rest
+    is queued for one of ``processing_workers`` green threads, so this call
+    never waits for a free worker. The result of processing can be checked
+    via the introspection status.
+
+    :returns: the same response as ``process`` would return, i.e. new IPMI
+              credentials if their setting was requested.
+    :raises: Error if pre-processing or look up failed.
+    """
+    ironic, node, cached_node = _look_up(node_info)
+    result = _credentials_response(cached_node)
+    _processing_queue().put_nowait((ironic, node, node_info, cached_node))
+    return result
+
+
+def _processing_queue():
+    global _QUEUE
+    if _QUEUE is None:
+        _QUEUE = eventlet.queue.Queue()
+        for _i in range(CONF.discoverd.processing_workers):
+            _WORKERS.append(eventlet.greenthread.spawn(_worker, _QUEUE))
+    return _QUEUE
+
+
+def _worker(queue):
+    while True:
+        ironic, node, node_info, cached_node = queue.get()
+        try:
+            _background_process(ironic, node, node_info, cached_node)
+        except Exception:
+            LOG.exception(_LE('Unexpected exception during processing data '
+                              'for node %s'), cached_node.uuid)
+        finally:
+            queue.task_done()
+
+
+def _background_process(ironic, node, node_info, cached_node):
+    try:
+        _process_node_with_errors(ironic, node, node_info, cached_node)
+    except utils.Error as exc:
+        # Error is already stored in the node cache
+        LOG.error(_LE('Processing data for node %(node)s failed: %(exc)s'),
+                  {'node': cached_node.uuid, 'exc': exc})
+
+
+def reset():
+    """Stop background processing and drop queued data."""
+    global _QUEUE
+    for worker in _WORKERS:
+        worker.kill()
+    del _WORKERS[:]
+    _QUEUE = None
+
+
+def _look_up(node_info):
     hooks = plugins_base.processing_hooks_manager()
     failures = []
     for hook_ext in hooks:
@@ -91,6 +159,10 @@ def process(node_info):
         cached_node.finished(error=msg)
         raise utils.Error(msg, code=404)
 
+    return ironic, node, cached_node
+
+
+def _process_node_with_errors(ironic, node, node_info, cached_node):
     try:
         return _process_node(ironic, node, node_info, cached_node)
     except utils.Error as exc:
@@ -128,47 +200,79 @@ def _process_node(ironic, node, node_info, cached_node):
     # NOTE(dtantsur): repeat the check in case something changed
     utils.check_provision_state(node)
 
-    ports = {}
-    for mac in (node_info.get('macs') or ()):
-        try:
-            port = ironic.port.create(node_uuid=node.uuid, address=mac)
-            ports[mac] = port
-        except exceptions.Conflict:
-            LOG.warning(_LW('MAC %(mac)s appeared in introspection data for '
-                            'node %(node)s, but already exists in '
-                            'database - skipping') %
-                        {'mac': mac, 'node': node.uuid})
+    pool = eventlet.greenpool.GreenPool(CONF.discoverd.port_update_concurrency)
+    macs = node_info.get('macs') or ()
+    created = _run_concurrently(pool, _create_port,
+                                [(ironic, node, mac) for mac in macs])
+    ports = {mac: port for (mac, port) in zip(macs, created)
+             if port is not None}
+
+    port_cache.add(ports.values())
 
     node_patches, port_patches = _run_post_hooks(node, ports, node_info)
     # Invalidate cache in case of hooks modifying options
     cached_node.invalidate_cache()
 
-    node = utils.retry_on_conflict(ironic.node.update, node.uuid, node_patches)
-    for mac, patches in port_patches.items():
-        utils.retry_on_conflict(ironic.port.update, ports[mac].uuid, patches)
-
-    LOG.debug('Node %s was updated with data from introspection process, '
-              'patches %s, port patches %s',
-              node.uuid, node_patches, port_patches)
+    new_credentials = cached_node.options.get('new_ipmi_credentials')
+    node_patches = utils.PatchAccumulator(node_patches)
+    if new_credentials:
+        # Credentials are validated after this update, so
+        # they can be sent together with the patches from hooks
+        node_patches.add(_credentials_patch(node, node_info,
+                                            *new_credentials))
+    LOG.debug('Updating node %(node)s with data from introspection '
+              'process, patches %(patches)s, port patches %(port_patches)s',
+              {'node': node.uuid, 'patches': node_patches.patches(),
+               'port_patches': port_patches})
+    node = node_patches.flush(ironic.node.update, node.uuid) or node
+    _run_concurrently(pool, _update_port,
+                      [(ironic, ports[mac], patches)
+                       for (mac, patches) in port_patches.items()])
+
+    firewall.request_update(ironic)
+
+    if new_credentials:
+        eventlet.greenthread.spawn_n(_finish_set_ipmi_credentials,
+                                     ironic, cached_node)
+    else:
+        eventlet.greenthread.spawn_n(_finish, ironic, cached_node)
+    return _credentials_response(cached_node)
 
-    firewall.update_filters(ironic)
 
+def _credentials_response(cached_node):
     if cached_node.options.get('new_ipmi_credentials'):
         new_username, new_password = (
             cached_node.options.get('new_ipmi_credentials'))
-        eventlet.greenthread.spawn_n(_finish_set_ipmi_credentials,
-                                     ironic, node, cached_node, node_info,
-                                     new_username, new_password)
         return {'ipmi_setup_credentials': True,
                 'ipmi_username': new_username,
                 'ipmi_password': new_password}
     else:
-        eventlet.greenthread.spawn_n(_finish, ironic, cached_node)
         return {}
 
 
-def _finish_set_ipmi_credentials(ironic, node, cached_node, node_info,
-                                 new_username, new_password):
+def _run_concurrently(pool, func, args_list):
+    """Call func for all arguments in args_list using green threads.
+
+    Waits for all calls to finish before re-raising the first failure.
+
+    :returns: list of results in the same order as args_list
+    """
+    threads = [pool.spawn(func, *args) for args in args_list]
+    pool.waitall()
+    return [thread.wait() for thread in threads]
+
+
+def _create_port(ironic, node, mac):
+    try:
+        return ironic.port.create(node_uuid=node.uuid, address=mac)
+    except exceptions.Conflict:
+        LOG.warning(_LW('MAC %(mac)s appeared in introspection data for '
+                        'node %(node)s, but already exists in '
+                        'database - skipping') %
+                    {'mac': mac, 'node': node.uuid})
+
+
+def _credentials_patch(node, node_info, new_username, new_password):
     patch = [{'op': 'add', 'path': '/driver_info/ipmi_username',
               'value': new_username},
              {'op': 'add', 'path': '/driver_info/ipmi_password',
@@ -176,8 +280,14 @@ def _finish_set_ipmi_credentials(ironic, node, cached_node, node_info,
     if not utils.get_ipmi_address(node) and node_info.get('ipmi_address'):
         patch.append({'op': 'add', 'path': '/driver_info/ipmi_address',
                       'value': node_info['ipmi_address']})
-    utils.retry_on_conflict(ironic.node.update, cached_node.uuid, patch)
+    return patch
+
+
+def _update_port(ironic, port, patches):
+    utils.PatchAccumulator(patches).flush(ironic.port.update, port.uuid)
+
 
+def _finish_set_ipmi_credentials(ironic, cached_node):
     for attempt in range(_CREDENTIALS_WAIT_RETRIES):
         try:
             # We use this call because it requires valid credentials.
@@ -20,8 +20,14 @@ from oslo_config import cfg
 from ironic_discoverd.common import i18n
 # Import configuration options
 from ironic_discoverd import conf  # noqa
+from ironic_discoverd import firewall
+from ironic_discoverd import http_pool
+from ironic_discoverd import metrics
 from ironic_discoverd import node_cache
 from ironic_discoverd.plugins import base as plugins_base
+from ironic_discoverd import port_cache
+from ironic_discoverd import process
+from ironic_discoverd import utils
 
 CONF = cfg.CONF
 
@@ -41,6 +47,16 @@ def init_test_conf():
     else:
         db_file = None
     node_cache._DB_NAME = None
+    node_cache._POOL = None
+    plugins_base._NODE_CACHE_DRIVER = None
+    plugins_base._FIREWALL_DRIVER = None
+    port_cache.reset()
+    firewall.reset()
+    metrics.reset()
+    process.reset()
+    utils.reset_client()
+    utils.reset_dns_cache()
+    http_pool.reset()
     return db_file
 
 
@@ -48,10 +64,13 @@ class BaseTest(unittest.TestCase):
     def setUp(self):
         super(BaseTest, self).setUp()
         self.db_file = init_test_conf()
-        self.db = node_cache._db()
+        node_cache.init()
+        self.db = node_cache._connect()
+        self.addCleanup(self.db.close)
         if self.db_file:
             self.addCleanup(lambda: self.db_file.close())
         plugins_base._HOOKS_MGR = None
+        plugins_base._NODE_CACHE_DRIVER = None
         for name in ('_', '_LI', '_LW', '_LE', '_LC'):
             patch = mock.patch.object(i18n, name, lambda s: s)
             patch.start()
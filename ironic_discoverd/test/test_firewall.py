@@ -13,12 +13,18 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import subprocess
+import time
+
+import eventlet
 import mock
 
 from oslo_config import cfg
 
 from ironic_discoverd import firewall
+from ironic_discoverd import metrics
 from ironic_discoverd import node_cache
+from ironic_discoverd import port_cache
 from ironic_discoverd.test import base as test_base
 from ironic_discoverd import utils
 
@@ -26,136 +32,396 @@ from ironic_discoverd import utils
 CONF = cfg.CONF
 
 
+@mock.patch.object(firewall, '_iptables_restore')
 @mock.patch.object(firewall, '_iptables')
 @mock.patch.object(utils, 'get_client')
 class TestFirewall(test_base.NodeTest):
     def test_update_filters_without_manage_firewall(self, mock_get_client,
-                                                    mock_iptables):
+                                                    mock_iptables,
+                                                    mock_restore):
         CONF.set_override('manage_firewall', False, 'discoverd')
         firewall.update_filters()
         self.assertEqual(0, mock_iptables.call_count)
+        self.assertEqual(0, mock_restore.call_count)
 
-    def test_init_args(self, mock_get_client, mock_iptables):
+    def test_init_args(self, mock_get_client, mock_iptables, mock_restore):
         firewall.init()
         init_expected_args = [
             ('-D', 'INPUT', '-i', 'br-ctlplane', '-p', 'udp', '--dport', '67',
              '-j', 'discovery'),
             ('-F', 'discovery'),
             ('-X', 'discovery'),
-            ('-N', 'discovery')]
-
-        call_args_list = mock_iptables.call_args_list
-
-        for (args, call) in zip(init_expected_args, call_args_list):
-            self.assertEqual(args, call[0])
-
-    def test_init_kwargs(self, mock_get_client, mock_iptables):
-        firewall.init()
-        init_expected_kwargs = [
-            {'ignore': True},
-            {'ignore': True},
-            {'ignore': True}]
+            ('-D', 'INPUT', '-i', 'br-ctlplane', '-p', 'udp', '--dport', '67',
+             '-j', 'discovery_temp'),
+            ('-F', 'discovery_temp'),
+            ('-X', 'discovery_temp')]
 
         call_args_list = mock_iptables.call_args_list
 
-        for (kwargs, call) in zip(init_expected_kwargs, call_args_list):
-            self.assertEqual(kwargs, call[1])
+        self.assertEqual(init_expected_args,
+                         [call[0] for call in call_args_list])
+        mock_restore.assert_called_once_with([
+            ':discovery - [0:0]',
+            '-I INPUT -i br-ctlplane -p udp --dport 67 -j discovery'])
 
-    def test_update_filters_args(self, mock_get_client, mock_iptables):
+    def test_init_kwargs(self, mock_get_client, mock_iptables, mock_restore):
         firewall.init()
+        init_expected_kwargs = [{'ignore': True}] * 6
 
-        update_filters_expected_args = [
-            ('-D', 'INPUT', '-i', 'br-ctlplane', '-p', 'udp', '--dport',
-             '67', '-j', 'discovery'),
-            ('-F', 'discovery'),
-            ('-X', 'discovery'),
-            ('-N', 'discovery'),
-            ('-D', 'INPUT', '-i', 'br-ctlplane', '-p', 'udp', '--dport',
-             '67', '-j', 'discovery_temp'),
-            ('-F', 'discovery_temp'),
-            ('-X', 'discovery_temp'),
-            ('-N', 'discovery_temp'),
-            ('-A', 'discovery_temp', '-j', 'ACCEPT'),
-            ('-I', 'INPUT', '-i', 'br-ctlplane', '-p', 'udp', '--dport',
-             '67', '-j', 'discovery_temp'),
-            ('-D', 'INPUT', '-i', 'br-ctlplane', '-p', 'udp', '--dport',
-             '67', '-j', 'discovery'),
-            ('-F', 'discovery'),
-            ('-X', 'discovery'),
-            ('-E', 'discovery_temp', 'discovery')
-        ]
-
-        firewall.update_filters()
         call_args_list = mock_iptables.call_args_list
 
-        for (args, call) in zip(update_filters_expected_args,
-                                call_args_list):
-            self.assertEqual(args, call[0])
+        self.assertEqual(init_expected_kwargs,
+                         [call[1] for call in call_args_list])
 
-    def test_update_filters_kwargs(self, mock_get_client, mock_iptables):
+    def test_update_filters(self, mock_get_client, mock_iptables,
+                            mock_restore):
         firewall.init()
-
-        update_filters_expected_kwargs = [
-            {'ignore': True},
-            {'ignore': True},
-            {'ignore': True},
-            {},
-            {'ignore': True},
-            {'ignore': True},
-            {'ignore': True},
-            {},
-            {},
-            {},
-            {'ignore': True},
-            {'ignore': True},
-            {'ignore': True}
-        ]
+        mock_iptables.reset_mock()
+        mock_restore.reset_mock()
 
         firewall.update_filters()
-        call_args_list = mock_iptables.call_args_list
 
-        for (kwargs, call) in zip(update_filters_expected_kwargs,
-                                  call_args_list):
-            self.assertEqual(kwargs, call[1])
+        self.assertFalse(mock_iptables.called)
+        mock_restore.assert_called_once_with([
+            ':discovery - [0:0]',
+            '-A discovery -j ACCEPT'])
 
     def test_update_filters_with_blacklist(self, mock_get_client,
-                                           mock_iptables):
+                                           mock_iptables, mock_restore):
         active_macs = ['11:22:33:44:55:66', '66:55:44:33:22:11']
-        inactive_mac = ['AA:BB:CC:DD:EE:FF']
-        self.macs = active_macs + inactive_mac
+        inactive_macs = ['AA:BB:CC:DD:EE:FF', '00:BB:CC:DD:EE:FF']
+        self.macs = active_macs + inactive_macs
         self.ports = [mock.Mock(address=m) for m in self.macs]
         mock_get_client.port.list.return_value = self.ports
         node_cache.add_node(self.node.uuid, mac=active_macs,
                             bmc_address='1.2.3.4', foo=None)
         firewall.init()
+        mock_restore.reset_mock()
 
-        update_filters_expected_args = [
-            ('-D', 'INPUT', '-i', 'br-ctlplane', '-p', 'udp', '--dport',
-             '67', '-j', 'discovery'),
-            ('-F', 'discovery'),
-            ('-X', 'discovery'),
-            ('-N', 'discovery'),
-            ('-D', 'INPUT', '-i', 'br-ctlplane', '-p', 'udp', '--dport',
-             '67', '-j', 'discovery_temp'),
-            ('-F', 'discovery_temp'),
-            ('-X', 'discovery_temp'),
-            ('-N', 'discovery_temp'),
-            # Blacklist
-            ('-A', 'discovery_temp', '-m', 'mac', '--mac-source',
-             inactive_mac[0], '-j', 'DROP'),
-            ('-A', 'discovery_temp', '-j', 'ACCEPT'),
-            ('-I', 'INPUT', '-i', 'br-ctlplane', '-p', 'udp', '--dport',
-             '67', '-j', 'discovery_temp'),
-            ('-D', 'INPUT', '-i', 'br-ctlplane', '-p', 'udp', '--dport',
-             '67', '-j', 'discovery'),
-            ('-F', 'discovery'),
-            ('-X', 'discovery'),
-            ('-E', 'discovery_temp', 'discovery')
-        ]
+        firewall.update_filters(mock_get_client)
+
+        mock_restore.assert_called_once_with([
+            ':discovery - [0:0]',
+            '-A discovery -m mac --mac-source 00:BB:CC:DD:EE:FF -j DROP',
+            '-A discovery -m mac --mac-source AA:BB:CC:DD:EE:FF -j DROP',
+            '-A discovery -j ACCEPT'])
+
+
+@mock.patch.object(firewall, '_ipset_restore')
+@mock.patch.object(firewall, '_iptables_restore')
+@mock.patch.object(firewall, '_iptables')
+class TestFirewallIncremental(test_base.NodeTest):
+    def setUp(self):
+        super(TestFirewallIncremental, self).setUp()
+        CONF.set_override('firewall_update_window', 0, 'discoverd')
+        self.ironic = mock.Mock()
+        self._set_macs(['11:22:33:44:55:66', 'AA:BB:CC:DD:EE:FF'])
+        with mock.patch.object(firewall, '_iptables'), \
+                mock.patch.object(firewall, '_iptables_restore'):
+            firewall.init()
+            firewall.update_filters(self.ironic)
+        metrics.reset()
+
+    def _set_macs(self, macs):
+        self.ironic.port.list.return_value = [mock.Mock(address=m)
+                                              for m in macs]
+        port_cache.reset()
+
+    def test_not_changed(self, mock_iptables, mock_restore, mock_ipset):
+        firewall.update_filters(self.ironic)
+
+        self.assertFalse(mock_restore.called)
+        self.assertFalse(mock_ipset.called)
+        snapshot = metrics.snapshot()
+        self.assertEqual({'firewall.skipped_updates': 1},
+                         snapshot['counters'])
+        self.assertEqual({'firewall.changes': 0,
+                          'firewall.blacklist_size': 2},
+                         snapshot['gauges'])
+
+    def test_delta(self, mock_iptables, mock_restore, mock_ipset):
+        self._set_macs(['11:22:33:44:55:66', '00:BB:CC:DD:EE:FF'])
+
+        firewall.update_filters(self.ironic)
+
+        mock_restore.assert_called_once_with([
+            '-D discovery -m mac --mac-source AA:BB:CC:DD:EE:FF -j DROP',
+            '-I discovery 1 -m mac --mac-source 00:BB:CC:DD:EE:FF -j DROP'])
+        self.assertFalse(mock_iptables.called)
+        self.assertFalse(mock_ipset.called)
+        snapshot = metrics.snapshot()
+        self.assertEqual({'firewall.delta_updates': 1},
+                         snapshot['counters'])
+        self.assertEqual({'firewall.changes': 2,
+                          'firewall.blacklist_size': 2},
+                         snapshot['gauges'])
+        for name in ('firewall.request_wait', 'firewall.lock_wait',
+                     'firewall.update'):
+            self.assertEqual(1, snapshot['timers'][name]['count'])
+
+    def test_delta_ipset(self, mock_iptables, mock_restore, mock_ipset):
+        CONF.set_override('firewall_use_ipset', True, 'discoverd')
+        self._set_macs(['11:22:33:44:55:66', '00:BB:CC:DD:EE:FF'])
+
+        firewall.update_filters(self.ironic)
+
+        mock_ipset.assert_called_once_with([
+            'del discovery AA:BB:CC:DD:EE:FF -exist',
+            'add discovery 00:BB:CC:DD:EE:FF -exist'])
+        self.assertFalse(mock_restore.called)
+
+    def test_node_on_introspection(self, mock_iptables, mock_restore,
+                                   mock_ipset):
+        node_cache.add_node(self.uuid, mac=['AA:BB:CC:DD:EE:FF'])
+
+        firewall.update_filters(self.ironic)
+
+        mock_restore.assert_called_once_with([
+            '-D discovery -m mac --mac-source AA:BB:CC:DD:EE:FF -j DROP'])
+
+    def test_resync(self, mock_iptables, mock_restore, mock_ipset):
+        CONF.set_override('firewall_resync_period', 10, 'discoverd')
+        firewall.LAST_RESYNC = time.time() - 11
+
+        firewall.update_filters(self.ironic)
+
+        mock_restore.assert_called_once_with([
+            ':discovery - [0:0]',
+            '-A discovery -m mac --mac-source 11:22:33:44:55:66 -j DROP',
+            '-A discovery -m mac --mac-source AA:BB:CC:DD:EE:FF -j DROP',
+            '-A discovery -j ACCEPT'])
+        self.assertTrue(firewall.LAST_RESYNC > time.time() - 10)
+
+    def test_resync_disabled(self, mock_iptables, mock_restore, mock_ipset):
+        CONF.set_override('firewall_resync_period', 0, 'discoverd')
+        firewall.LAST_RESYNC = 0
+
+        firewall.update_filters(self.ironic)
+
+        self.assertFalse(mock_restore.called)
+
+    def test_full_update_after_failure(self, mock_iptables, mock_restore,
+                                       mock_ipset):
+        self._set_macs(['11:22:33:44:55:66'])
+        mock_restore.side_effect = subprocess.CalledProcessError(1, 'boom')
+
+        self.assertRaises(subprocess.CalledProcessError,
+                          firewall.update_filters, self.ironic)
+
+        mock_restore.reset_mock()
+        mock_restore.side_effect = None
+        firewall.update_filters(self.ironic)
+
+        mock_restore.assert_called_once_with([
+            ':discovery - [0:0]',
+            '-A discovery -m mac --mac-source 11:22:33:44:55:66 -j DROP',
+            '-A discovery -j ACCEPT'])
+
+
+@mock.patch.object(firewall, '_ipset_restore')
+@mock.patch.object(firewall, '_iptables_restore')
+@mock.patch.object(firewall, '_iptables')
+@mock.patch.object(utils, 'get_client')
+class TestFirewallIpset(test_base.NodeTest):
+    def setUp(self):
+        super(TestFirewallIpset, self).setUp()
+        CONF.set_override('firewall_use_ipset', True, 'discoverd')
+
+    def test_init(self, mock_get_client, mock_iptables, mock_restore,
+                  mock_ipset):
+        firewall.init()
+
+        mock_ipset.assert_called_once_with(['create discovery hash:mac -exist',
+                                            'flush discovery'])
+        mock_restore.assert_called_once_with([
+            ':discovery - [0:0]',
+            '-A discovery -m set --match-set discovery src -j DROP',
+            '-A discovery -j ACCEPT',
+            '-I INPUT -i br-ctlplane -p udp --dport 67 -j discovery'])
+
+    def test_update_filters(self, mock_get_client, mock_iptables,
+                            mock_restore, mock_ipset):
+        active_macs = ['11:22:33:44:55:66']
+        inactive_macs = ['AA:BB:CC:DD:EE:FF', '00:BB:CC:DD:EE:FF']
+        mock_get_client.port.list.return_value = [
+            mock.Mock(address=m) for m in active_macs + inactive_macs]
+        node_cache.add_node(self.node.uuid, mac=active_macs)
+        firewall.init()
+        mock_iptables.reset_mock()
+        mock_restore.reset_mock()
+        mock_ipset.reset_mock()
 
         firewall.update_filters(mock_get_client)
-        call_args_list = mock_iptables.call_args_list
 
-        for (args, call) in zip(update_filters_expected_args,
-                                call_args_list):
-            self.assertEqual(args, call[0])
+        self.assertFalse(mock_iptables.called)
+        self.assertFalse(mock_restore.called)
+        mock_ipset.assert_called_once_with([
+            'create discovery_temp hash:mac -exist',
+            'flush discovery_temp',
+            'add discovery_temp 00:BB:CC:DD:EE:FF',
+            'add discovery_temp AA:BB:CC:DD:EE:FF',
+            'swap discovery_temp discovery',
+            'destroy discovery_temp'])
+
+    def test_clean_up(self, mock_get_client, mock_iptables, mock_restore,
+                      mock_ipset):
+        firewall.clean_up()
+
+        self.assertEqual(6, mock_iptables.call_count)
+        self.assertEqual([mock.call(['destroy discovery_temp'], ignore=True),
+                          mock.call(['destroy discovery'], ignore=True)],
+                         mock_ipset.call_args_list)
+
+
+@mock.patch.object(firewall, '_update_filters')
+class TestFirewallCoalescing(test_base.BaseTest):
+    def setUp(self):
+        super(TestFirewallCoalescing, self).setUp()
+        CONF.set_override('firewall_update_window', 0, 'discoverd')
+        firewall.INTERFACE = 'br-ctlplane'
+        self.addCleanup(setattr, firewall, 'INTERFACE', None)
+
+    def test_coalesce(self, update_mock):
+        threads = [eventlet.greenthread.spawn(firewall.update_filters)
+                   for _ in range(10)]
+        for thread in threads:
+            thread.wait()
+
+        # All requests came before the worker started
+        self.assertEqual(1, update_mock.call_count)
+        self.assertIsNone(firewall._WORKER)
+        self.assertIsNone(firewall._PENDING)
+
+    def test_request_during_update(self, update_mock):
+        results = []
+
+        def _update(ironic):
+            # This caller has to wait for one more update
+            results.append(eventlet.greenthread.spawn(
+                firewall.update_filters))
+            update_mock.side_effect = None
+
+        update_mock.side_effect = _update
+        firewall.update_filters()
+        results[0].wait()
+
+        self.assertEqual(2, update_mock.call_count)
+
+    @mock.patch.object(eventlet.greenthread, 'sleep', autospec=True)
+    def test_window(self, sleep_mock, update_mock):
+        CONF.set_override('firewall_update_window', 10, 'discoverd')
+        firewall.update_filters()
+        self.assertFalse(sleep_mock.called)
+
+        firewall.update_filters()
+        self.assertEqual(1, sleep_mock.call_count)
+        self.assertTrue(9 < sleep_mock.call_args[0][0] <= 10)
+        self.assertEqual(2, update_mock.call_count)
+
+    def test_failure(self, update_mock):
+        update_mock.side_effect = RuntimeError('boom')
+        threads = [eventlet.greenthread.spawn(firewall.update_filters)
+                   for _ in range(2)]
+        for thread in threads:
+            self.assertRaises(RuntimeError, thread.wait)
+
+        update_mock.side_effect = None
+        firewall.update_filters()
+        self.assertIsNone(firewall._WORKER)
+        self.assertEqual({'firewall.failures': 1},
+                         metrics.snapshot()['counters'])
+
+    def test_disabled(self, update_mock):
+        CONF.set_override('manage_firewall', False, 'discoverd')
+        firewall.update_filters()
+        self.assertFalse(update_mock.called)
+
+    def test_request_update(self, update_mock):
+        firewall.request_update()
+        self.assertFalse(update_mock.called)
+        self.assertIsNotNone(firewall._WORKER)
+
+        # Synchronous callers share the same update
+        firewall.update_filters()
+        update_mock.assert_called_once_with(None)
+        self.assertIsNone(firewall._WORKER)
+
+    @mock.patch.object(eventlet.greenthread, 'sleep', autospec=True)
+    def test_request_update_window(self, sleep_mock, update_mock):
+        CONF.set_override('firewall_update_window', 10, 'discoverd')
+        firewall.update_filters()
+
+        firewall.request_update()
+        firewall._WORKER.wait()
+
+        self.assertEqual(1, sleep_mock.call_count)
+        self.assertTrue(9 < sleep_mock.call_args[0][0] <= 10)
+        self.assertEqual(2, update_mock.call_count)
+
+    def test_request_update_failure(self, update_mock):
+        update_mock.side_effect = RuntimeError('boom')
+        firewall.request_update()
+        firewall._WORKER.wait()
+
+        self.assertEqual(1, update_mock.call_count)
+        self.assertEqual({'firewall.failures': 1},
+                         metrics.snapshot()['counters'])
+
+    def test_request_update_disabled(self, update_mock):
+        CONF.set_override('manage_firewall', False, 'discoverd')
+        firewall.request_update()
+        self.assertIsNone(firewall._WORKER)
+
+    @mock.patch.object(eventlet.greenthread, 'sleep', autospec=True)
+    def test_reset(self, sleep_mock, update_mock):
+        CONF.set_override('firewall_update_window', 10, 'discoverd')
+        firewall.update_filters()
+        firewall.request_update()
+        worker = firewall._WORKER
+        self.assertIsNotNone(firewall._PENDING)
+
+        firewall.reset()
+
+        self.assertTrue(worker.dead)
+        self.assertIsNone(firewall._WORKER)
+        self.assertIsNone(firewall._PENDING)
+        self.assertEqual(0, firewall._LAST_UPDATE)
+        self.assertEqual(1, update_mock.call_count)
+
+
+@mock.patch.object(subprocess, 'Popen')
+class TestIptablesRestore(test_base.BaseTest):
+    def test_ok(self, popen_mock):
+        proc = popen_mock.return_value
+        proc.communicate.return_value = ('', None)
+        proc.returncode = 0
+
+        firewall._iptables_restore([':discovery - [0:0]'])
+
+        popen_mock.assert_called_once_with(
+            ('iptables-restore', '--noflush'), stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True)
+        proc.communicate.assert_called_once_with(
+            '*filter\n:discovery - [0:0]\nCOMMIT\n')
+
+    def test_failure(self, popen_mock):
+        proc = popen_mock.return_value
+        proc.communicate.return_value = ('boom', None)
+        proc.returncode = 1
+
+        self.assertRaises(subprocess.CalledProcessError,
+                          firewall._iptables_restore, [])
+
+    def test_ipset(self, popen_mock):
+        proc = popen_mock.return_value
+        proc.communicate.return_value = ('boom', None)
+        proc.returncode = 1
+
+        firewall._ipset_restore(['destroy discovery'], ignore=True)
+
+        popen_mock.assert_called_once_with(
+            ('ipset', 'restore'), stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True)
+        proc.communicate.assert_called_once_with('destroy discovery\n')
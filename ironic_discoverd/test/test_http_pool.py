@@ -0,0 +1,176 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import eventlet
+from ironicclient import client
+from keystoneclient.auth import token_endpoint
+from keystoneclient import session as ks_session
+import mock
+from oslo_config import cfg
+import requests
+from requests import adapters
+
+from ironic_discoverd import http_pool
+from ironic_discoverd import metrics
+from ironic_discoverd.test import base as test_base
+
+
+CONF = cfg.CONF
+
+
+def _request(url='http://127.0.0.1:6385/v1/nodes'):
+    return mock.Mock(url=url)
+
+
+@mock.patch.object(adapters.HTTPAdapter, 'send', autospec=True)
+class TestPooledAdapter(test_base.BaseTest):
+    def test_session(self, send_mock):
+        CONF.set_override('http_pool_size_per_host', 5, 'discoverd')
+        session = http_pool.get_session()
+
+        self.assertIs(session, http_pool.get_session())
+        adapter = session.get_adapter('http://127.0.0.1:6385')
+        self.assertIsInstance(adapter, http_pool.PooledAdapter)
+        self.assertIs(adapter, session.get_adapter('https://127.0.0.1'))
+        self.assertEqual(5, adapter._pool_maxsize)
+        self.assertTrue(adapter._pool_block)
+
+    def test_send(self, send_mock):
+        adapter = http_pool.PooledAdapter(2, 2)
+        send_mock.return_value = 'response'
+        request = _request()
+
+        self.assertEqual('response', adapter.send(request, timeout=1))
+
+        send_mock.assert_called_once_with(adapter, request, timeout=1)
+        self.assertEqual(0, adapter.in_use)
+        snapshot = metrics.snapshot()
+        self.assertEqual({'http.in_use': 0, 'http.idle': 1},
+                         snapshot['gauges'])
+        self.assertEqual(1, snapshot['timers']['http.pool_wait']['count'])
+
+    def test_size_limit(self, send_mock):
+        adapter = http_pool.PooledAdapter(2, 2)
+        running = []
+        max_running = []
+
+        def _send(self, request, **kwargs):
+            running.append(request)
+            max_running.append(self.in_use)
+            eventlet.greenthread.sleep(0.01)
+            running.remove(request)
+
+        send_mock.side_effect = _send
+        threads = [eventlet.greenthread.spawn(adapter.send, _request())
+                   for i in range(5)]
+        for thread in threads:
+            thread.wait()
+
+        self.assertEqual(5, send_mock.call_count)
+        self.assertEqual(2, max(max_running))
+        self.assertEqual(0, adapter.in_use)
+
+    def test_failure(self, send_mock):
+        adapter = http_pool.PooledAdapter(1, 1)
+        send_mock.side_effect = RuntimeError('boom')
+
+        self.assertRaises(RuntimeError, adapter.send, _request())
+        self.assertRaises(RuntimeError, adapter.send, _request())
+        self.assertEqual(0, adapter.in_use)
+
+    def test_idle(self, send_mock):
+        adapter = http_pool.PooledAdapter(10, 2)
+        idle = []
+
+        def _send(self, request, **kwargs):
+            idle.append(self.idle())
+            eventlet.greenthread.sleep(0.01)
+
+        send_mock.side_effect = _send
+        self.assertEqual(0, adapter.idle())
+        urls = ['http://127.0.0.1:6385/v1/nodes'] * 3 + [
+            'https://127.0.0.1:6385/v1/ports', 'http://127.0.0.1:5000/v2.0']
+        threads = [eventlet.greenthread.spawn(adapter.send, _request(url))
+                   for url in urls]
+        for thread in threads:
+            thread.wait()
+
+        self.assertEqual([0] * 5, idle)
+        # At most 2 connections are open per host
+        self.assertEqual(4, adapter.idle())
+        self.assertEqual(4, metrics.snapshot()['gauges']['http.idle'])
+
+    def test_idle_after_failure(self, send_mock):
+        adapter = http_pool.PooledAdapter(10, 2)
+
+        def _send(self, request, **kwargs):
+            eventlet.greenthread.sleep(0.01)
+
+        send_mock.side_effect = _send
+        threads = [eventlet.greenthread.spawn(adapter.send, _request())
+                   for _ in range(2)]
+        for thread in threads:
+            thread.wait()
+        self.assertEqual(2, adapter.idle())
+
+        send_mock.side_effect = requests.ConnectionError()
+        for _ in range(3):
+            self.assertRaises(requests.ConnectionError,
+                              adapter.send, _request())
+        self.assertEqual(0, adapter.idle())
+        self.assertEqual(0, metrics.snapshot()['gauges']['http.idle'])
+
+        send_mock.side_effect = None
+        adapter.send(_request())
+        self.assertEqual(1, adapter.idle())
+
+    def test_idle_hosts_evicted(self, send_mock):
+        adapter = http_pool.PooledAdapter(2, 2)
+        for port in range(http_pool._MAX_HOSTS + 5):
+            adapter.send(_request('http://127.0.0.1:%d' % port))
+        self.assertEqual(http_pool._MAX_HOSTS, adapter.idle())
+
+    def test_reset(self, send_mock):
+        session = http_pool.get_session()
+        with mock.patch.object(session, 'close', autospec=True) as close:
+            http_pool.reset()
+            close.assert_called_once_with()
+        self.assertIsNot(session, http_pool.get_session())
+
+
+@mock.patch.object(adapters.HTTPAdapter, 'send', autospec=True)
+class TestIronicClientSession(test_base.BaseTest):
+    def test_requests_use_pool(self, send_mock):
+        def _send(self, request, **kwargs):
+            response = requests.Response()
+            response.status_code = 200
+            response.headers['Content-Type'] = 'application/json'
+            response._content = b'{"nodes": []}'
+            response.request = request
+            response.url = request.url
+            return response
+
+        send_mock.side_effect = _send
+        auth = token_endpoint.Token('http://127.0.0.1:6385', 'token1')
+        sess = ks_session.Session(auth=auth,
+                                  session=http_pool.get_session())
+        cli = client.Client(1, 'http://127.0.0.1:6385', session=sess)
+
+        self.assertEqual([], list(cli.node.list()))
+
+        self.assertEqual(1, send_mock.call_count)
+        adapter, request = send_mock.call_args[0]
+        self.assertIsInstance(adapter, http_pool.PooledAdapter)
+        self.assertTrue(request.url.startswith(
+            'http://127.0.0.1:6385/v1/nodes'))
+        self.assertEqual('token1', request.headers['X-Auth-Token'])
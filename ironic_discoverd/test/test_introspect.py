@@ -11,6 +11,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import socket
+
 import eventlet
 from ironicclient import exceptions
 import mock
@@ -69,7 +71,8 @@ class TestIntrospect(BaseTest):
 
         cli.node.update.assert_called_once_with(self.uuid, self.patch)
         add_mock.assert_called_once_with(self.uuid,
-                                         bmc_address=self.bmc_address)
+                                         bmc_address=self.bmc_address,
+                                         options=None)
         self.cached_node.add_attribute.assert_called_once_with('mac',
                                                                self.macs)
         filters_mock.assert_called_with(cli)
@@ -78,8 +81,7 @@ class TestIntrospect(BaseTest):
                                                          persistent=False)
         cli.node.set_power_state.assert_called_once_with(self.uuid,
                                                          'reboot')
-        add_mock.return_value.set_option.assert_called_once_with(
-            'new_ipmi_credentials', None)
+        self.assertFalse(add_mock.return_value.set_option.called)
 
     def test_ok_ilo_and_drac(self, client_mock, add_mock, filters_mock):
         self._prepare(client_mock)
@@ -90,7 +92,8 @@ class TestIntrospect(BaseTest):
             introspect.introspect(self.node.uuid)
 
         add_mock.assert_called_with(self.uuid,
-                                    bmc_address=self.bmc_address)
+                                    bmc_address=self.bmc_address,
+                                    options=None)
 
     def test_retries(self, client_mock, add_mock, filters_mock):
         cli = self._prepare(client_mock)
@@ -113,7 +116,8 @@ class TestIntrospect(BaseTest):
 
         cli.node.update.assert_called_with(self.uuid, self.patch)
         add_mock.assert_called_once_with(self.uuid,
-                                         bmc_address=self.bmc_address)
+                                         bmc_address=self.bmc_address,
+                                         options=None)
         filters_mock.assert_called_with(cli)
         cli.node.set_boot_device.assert_called_with(self.uuid,
                                                     'pxe',
@@ -133,7 +137,8 @@ class TestIntrospect(BaseTest):
 
         cli.node.update.assert_called_once_with(self.uuid, self.patch)
         add_mock.assert_called_once_with(self.uuid,
-                                         bmc_address=self.bmc_address)
+                                         bmc_address=self.bmc_address,
+                                         options=None)
         cli.node.set_boot_device.assert_called_once_with(self.uuid,
                                                          'pxe',
                                                          persistent=False)
@@ -153,7 +158,8 @@ class TestIntrospect(BaseTest):
 
         cli.node.update.assert_called_once_with(self.uuid, self.patch)
         add_mock.assert_called_once_with(self.uuid,
-                                         bmc_address=self.bmc_address)
+                                         bmc_address=self.bmc_address,
+                                         options=None)
         self.assertFalse(cli.node.set_boot_device.called)
         add_mock.return_value.finished.assert_called_once_with(
             error=mock.ANY)
@@ -176,7 +182,8 @@ class TestIntrospect(BaseTest):
         cli.node.update.assert_called_once_with(self.node_compat.uuid,
                                                 self.patch)
         add_mock.assert_called_once_with(self.node_compat.uuid,
-                                         bmc_address=None)
+                                         bmc_address=None,
+                                         options=None)
         add_mock.return_value.add_attribute.assert_called_once_with('mac',
                                                                     self.macs)
         filters_mock.assert_called_with(cli)
@@ -197,7 +204,8 @@ class TestIntrospect(BaseTest):
 
         cli.node.update.assert_called_once_with(self.uuid, self.patch)
         add_mock.assert_called_once_with(self.uuid,
-                                         bmc_address=self.bmc_address)
+                                         bmc_address=self.bmc_address,
+                                         options=None)
         self.assertFalse(self.cached_node.add_attribute.called)
         self.assertFalse(filters_mock.called)
         cli.node.set_boot_device.assert_called_once_with(self.uuid,
@@ -260,6 +268,88 @@ class TestIntrospect(BaseTest):
         self.assertFalse(add_mock.called)
 
 
+@mock.patch.object(eventlet.greenthread, 'spawn_n',
+                   lambda f, *a, **kw: f(*a, **kw) and None)
+@mock.patch.object(firewall, 'update_filters', autospec=True)
+@mock.patch.object(node_cache, 'add_nodes', autospec=True)
+@mock.patch.object(utils, 'get_client', autospec=True)
+class TestIntrospectMany(BaseTest):
+    def setUp(self):
+        super(TestIntrospectMany, self).setUp()
+        self.node2 = mock.Mock(driver='pxe_ipmitool',
+                               driver_info={'ipmi_address': '1.2.3.5'},
+                               uuid='uuid2',
+                               provision_state='inspecting',
+                               maintenance=False)
+        self.cached_node2 = mock.Mock(uuid='uuid2', options={})
+
+    def _prepare(self, client_mock):
+        cli = super(TestIntrospectMany, self)._prepare(client_mock)
+        nodes = {self.uuid: self.node, 'uuid2': self.node2}
+        cli.node.get.side_effect = lambda uuid: nodes[uuid]
+        return cli
+
+    def test_ok(self, client_mock, add_mock, filters_mock):
+        cli = self._prepare(client_mock)
+        add_mock.return_value = ({self.uuid: self.cached_node,
+                                  'uuid2': self.cached_node2}, {})
+
+        introspect.introspect_many([self.uuid, 'uuid2'])
+
+        add_mock.assert_called_once_with(
+            {self.uuid: {'bmc_address': self.bmc_address},
+             'uuid2': {'bmc_address': '1.2.3.5'}})
+        self.assertEqual(2, cli.node.validate.call_count)
+        cli.node.update.assert_any_call(self.uuid, self.patch)
+        cli.node.update.assert_any_call('uuid2', self.patch)
+        cli.node.set_power_state.assert_any_call(self.uuid, 'reboot')
+        cli.node.set_power_state.assert_any_call('uuid2', 'reboot')
+
+    @mock.patch.object(socket, 'gethostbyname', autospec=True)
+    def test_hostname_resolved_once(self, resolve_mock, client_mock,
+                                    add_mock, filters_mock):
+        self._prepare(client_mock)
+        self.node.driver_info['ipmi_address'] = 'bmc.example.com'
+        self.node2.driver_info['ipmi_address'] = 'bmc.example.com'
+        resolve_mock.return_value = '1.2.3.6'
+        add_mock.return_value = ({self.uuid: self.cached_node,
+                                  'uuid2': self.cached_node2}, {})
+
+        introspect.introspect_many([self.uuid, 'uuid2'])
+
+        add_mock.assert_called_once_with(
+            {self.uuid: {'bmc_address': '1.2.3.6'},
+             'uuid2': {'bmc_address': '1.2.3.6'}})
+        resolve_mock.assert_called_once_with('bmc.example.com')
+
+    def test_one_failed_validation(self, client_mock, add_mock,
+                                   filters_mock):
+        cli = self._prepare(client_mock)
+        self.node2.provision_state = 'active'
+        add_mock.return_value = ({self.uuid: self.cached_node}, {})
+
+        self.assertRaisesRegexp(utils.Error, 'provision state "active"',
+                                introspect.introspect_many,
+                                [self.uuid, 'uuid2'])
+
+        add_mock.assert_called_once_with(
+            {self.uuid: {'bmc_address': self.bmc_address}})
+        cli.node.set_power_state.assert_called_once_with(self.uuid,
+                                                         'reboot')
+
+    def test_several_failed(self, client_mock, add_mock, filters_mock):
+        cli = self._prepare(client_mock)
+        self.node2.provision_state = 'active'
+        add_mock.return_value = ({}, {self.uuid: utils.Error('conflict')})
+
+        self.assertRaisesRegexp(utils.Error,
+                                '%s: conflict; uuid2: .*"active"' % self.uuid,
+                                introspect.introspect_many,
+                                [self.uuid, 'uuid2'])
+
+        self.assertFalse(cli.node.set_power_state.called)
+
+
 @mock.patch.object(eventlet.greenthread, 'spawn_n',
                    lambda f, *a, **kw: f(*a, **kw) and None)
 @mock.patch.object(firewall, 'update_filters', autospec=True)
@@ -280,14 +370,14 @@ class TestSetIpmiCredentials(BaseTest):
         introspect.introspect(self.uuid, new_ipmi_credentials=self.new_creds)
 
         cli.node.update.assert_called_once_with(self.uuid, self.patch)
-        add_mock.assert_called_once_with(self.uuid,
-                                         bmc_address=self.bmc_address)
+        add_mock.assert_called_once_with(
+            self.uuid, bmc_address=self.bmc_address,
+            options={'new_ipmi_credentials': self.new_creds})
         filters_mock.assert_called_with(cli)
         self.assertFalse(cli.node.validate.called)
         self.assertFalse(cli.node.set_boot_device.called)
         self.assertFalse(cli.node.set_power_state.called)
-        add_mock.return_value.set_option.assert_called_once_with(
-            'new_ipmi_credentials', self.new_creds)
+        self.assertFalse(add_mock.return_value.set_option.called)
 
     def test_disabled(self, client_mock, add_mock, filters_mock):
         CONF.set_override('enable_setting_ipmi_credentials', False,
@@ -313,14 +403,14 @@ class TestSetIpmiCredentials(BaseTest):
                               new_ipmi_credentials=(None, self.new_creds[1]))
 
         cli.node.update.assert_called_once_with(self.uuid, self.patch)
-        add_mock.assert_called_once_with(self.uuid,
-                                         bmc_address=self.bmc_address)
+        add_mock.assert_called_once_with(
+            self.uuid, bmc_address=self.bmc_address,
+            options={'new_ipmi_credentials': self.new_creds})
         filters_mock.assert_called_with(cli)
         self.assertFalse(cli.node.validate.called)
         self.assertFalse(cli.node.set_boot_device.called)
         self.assertFalse(cli.node.set_power_state.called)
-        add_mock.return_value.set_option.assert_called_once_with(
-            'new_ipmi_credentials', self.new_creds)
+        self.assertFalse(add_mock.return_value.set_option.called)
 
     def test_wrong_letters(self, client_mock, add_mock, filters_mock):
         self.new_creds = ('user', 'p ssw@rd')
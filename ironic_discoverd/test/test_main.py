@@ -21,6 +21,7 @@ from oslo_utils import uuidutils
 from ironic_discoverd import firewall
 from ironic_discoverd import introspect
 from ironic_discoverd import main
+from ironic_discoverd import metrics
 from ironic_discoverd import node_cache
 from ironic_discoverd.plugins import base as plugins_base
 from ironic_discoverd.plugins import example as example_plugin
@@ -95,17 +96,25 @@ class TestApi(test_base.BaseTest):
         res = self.app.post('/v1/introspection/%s' % uuid_dummy)
         self.assertEqual(400, res.status_code)
 
-    @mock.patch.object(introspect, 'introspect', autospec=True)
+    @mock.patch.object(introspect, 'introspect_many', autospec=True)
     def test_discover(self, discover_mock):
         res = self.app.post('/v1/discover', data='["%s"]' % self.uuid)
         self.assertEqual(202, res.status_code)
-        discover_mock.assert_called_once_with(self.uuid)
+        discover_mock.assert_called_once_with([self.uuid])
 
-    @mock.patch.object(introspect, 'introspect', autospec=True)
+    @mock.patch.object(introspect, 'introspect_many', autospec=True)
     def test_discover_invalid_uuid(self, discover_mock):
         uuid_dummy = 'uuid1'
         res = self.app.post('/v1/discover', data='["%s"]' % uuid_dummy)
         self.assertEqual(400, res.status_code)
+        self.assertFalse(discover_mock.called)
+
+    @mock.patch.object(introspect, 'introspect_many', autospec=True)
+    def test_discover_failed(self, discover_mock):
+        discover_mock.side_effect = utils.Error("boom", code=404)
+        res = self.app.post('/v1/discover', data='["%s"]' % self.uuid)
+        self.assertEqual(404, res.status_code)
+        self.assertEqual(b"boom", res.data)
 
     @mock.patch.object(process, 'process', autospec=True)
     def test_continue(self, process_mock):
@@ -117,6 +126,23 @@ class TestApi(test_base.BaseTest):
         process_mock.assert_called_once_with("JSON")
         self.assertEqual(b'[42]', res.data)
 
+    @mock.patch.object(process, 'process_async', autospec=True)
+    def test_continue_async(self, process_mock):
+        CONF.set_override('process_asynchronously', True, 'discoverd')
+        process_mock.return_value = {}
+        res = self.app.post('/v1/continue', data='"JSON"')
+        self.assertEqual(202, res.status_code)
+        process_mock.assert_called_once_with("JSON")
+        self.assertEqual(b'{}', res.data)
+
+    @mock.patch.object(process, 'process_async', autospec=True)
+    def test_continue_async_failed(self, process_mock):
+        CONF.set_override('process_asynchronously', True, 'discoverd')
+        process_mock.side_effect = utils.Error("boom", code=404)
+        res = self.app.post('/v1/continue', data='"JSON"')
+        self.assertEqual(404, res.status_code)
+        self.assertEqual(b'boom', res.data)
+
     @mock.patch.object(process, 'process', autospec=True)
     def test_continue_failed(self, process_mock):
         process_mock.side_effect = utils.Error("boom")
@@ -145,6 +171,54 @@ class TestApi(test_base.BaseTest):
         self.assertEqual({'finished': True, 'error': 'boom'},
                          json.loads(res.data.decode('utf-8')))
 
+    @mock.patch.object(node_cache, 'get_nodes', autospec=True)
+    def test_list_introspection(self, get_mock):
+        uuid2 = uuidutils.generate_uuid()
+        get_mock.return_value = [
+            node_cache.NodeInfo(uuid=self.uuid, started_at=42.0),
+            node_cache.NodeInfo(uuid=uuid2, started_at=43.0,
+                                finished_at=100.1, error='boom')]
+        res = self.app.get('/v1/introspection')
+        self.assertEqual(200, res.status_code)
+        self.assertEqual({'introspection': [
+            {'uuid': self.uuid, 'finished': False, 'error': None},
+            {'uuid': uuid2, 'finished': True, 'error': 'boom'}]},
+            json.loads(res.data.decode('utf-8')))
+        get_mock.assert_called_once_with(None)
+
+    @mock.patch.object(node_cache, 'get_nodes', autospec=True)
+    def test_list_introspection_uuids(self, get_mock):
+        uuid2 = uuidutils.generate_uuid()
+        get_mock.return_value = []
+        res = self.app.get('/v1/introspection?uuid=%s&uuid=%s' %
+                           (self.uuid, uuid2))
+        self.assertEqual(200, res.status_code)
+        self.assertEqual({'introspection': []},
+                         json.loads(res.data.decode('utf-8')))
+        get_mock.assert_called_once_with([self.uuid, uuid2])
+
+    @mock.patch.object(node_cache, 'get_nodes', autospec=True)
+    def test_list_introspection_invalid_uuid(self, get_mock):
+        res = self.app.get('/v1/introspection?uuid=foo')
+        self.assertEqual(400, res.status_code)
+        self.assertFalse(get_mock.called)
+
+    def test_get_metrics(self):
+        metrics.increment('test.counter')
+        metrics.gauge('test.gauge', 42)
+        res = self.app.get('/v1/metrics')
+        self.assertEqual(200, res.status_code)
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual({'test.counter': 1}, data['counters'])
+        self.assertEqual({'test.gauge': 42}, data['gauges'])
+        self.assertEqual({}, data['timers'])
+
+    @mock.patch.object(utils, 'check_auth', autospec=True)
+    def test_get_metrics_failed_authentication(self, auth_mock):
+        auth_mock.side_effect = utils.Error('Boom', code=403)
+        res = self.app.get('/v1/metrics')
+        self.assertEqual(403, res.status_code)
+
 
 @mock.patch.object(eventlet.greenthread, 'sleep', autospec=True)
 @mock.patch.object(utils, 'get_client')
@@ -245,6 +319,19 @@ class TestInit(test_base.BaseTest):
                                 spawn_n_call_args_list):
             self.assertEqual(args, call[0])
 
+    @mock.patch.object(main.LOG, 'critical')
+    def test_init_non_positive_option(self, mock_log, mock_node_cache,
+                                      mock_get_client, mock_auth,
+                                      mock_firewall, mock_spawn_n):
+        for name in main.POSITIVE_OPTIONS:
+            for value in (0, -1):
+                CONF.set_override(name, value, 'discoverd')
+                self.assertRaises(SystemExit, main.init)
+                mock_log.assert_called_with(mock.ANY, {'name': name,
+                                                       'value': value})
+            CONF.clear_override(name, 'discoverd')
+        self.assertFalse(mock_node_cache.called)
+
     @mock.patch.object(main.LOG, 'critical')
     def test_init_failed_processing_hook(self, mock_log, mock_node_cache,
                                          mock_get_client, mock_auth,
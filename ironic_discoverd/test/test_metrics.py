@@ -0,0 +1,68 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import mock
+
+from ironic_discoverd import metrics
+from ironic_discoverd.test import base as test_base
+
+
+class TestMetrics(test_base.BaseTest):
+    def test_counters_and_gauges(self):
+        metrics.increment('counter')
+        metrics.increment('counter', 2)
+        metrics.gauge('gauge', 1)
+        metrics.gauge('gauge', 5)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual({'counter': 3}, snapshot['counters'])
+        self.assertEqual({'gauge': 5}, snapshot['gauges'])
+
+    def test_timing(self):
+        metrics.timing('timer', 0.003)
+        metrics.timing('timer', 0.2)
+        metrics.timing('timer', 100)
+
+        timer = metrics.snapshot()['timers']['timer']
+        self.assertEqual(3, timer['count'])
+        self.assertAlmostEqual(100.203, timer['sum'])
+        self.assertEqual(100, timer['max'])
+        self.assertEqual(0, timer['buckets']['0.001'])
+        self.assertEqual(1, timer['buckets']['0.005'])
+        self.assertEqual(1, timer['buckets']['0.1'])
+        self.assertEqual(2, timer['buckets']['0.5'])
+        self.assertEqual(2, timer['buckets']['10'])
+        self.assertEqual(3, timer['buckets']['+Inf'])
+
+    @mock.patch.object(time, 'time', autospec=True)
+    def test_timed(self, time_mock):
+        time_mock.side_effect = [1.0, 1.5]
+
+        self.assertRaises(RuntimeError, self._timed_failure)
+
+        timer = metrics.snapshot()['timers']['timer']
+        self.assertEqual(1, timer['count'])
+        self.assertEqual(0.5, timer['sum'])
+
+    def _timed_failure(self):
+        with metrics.timed('timer'):
+            raise RuntimeError('boom')
+
+    def test_reset(self):
+        metrics.increment('counter')
+        metrics.timing('timer', 1)
+        metrics.reset()
+        self.assertEqual({'counters': {}, 'gauges': {}, 'timers': {}},
+                         metrics.snapshot())
@@ -12,10 +12,12 @@
 # limitations under the License.
 
 import os
+import sqlite3
 import tempfile
 import time
 import unittest
 
+import eventlet
 import mock
 from oslo_config import cfg
 
@@ -55,6 +57,22 @@ class TestNodeCache(test_base.NodeTest):
                           ('mac', self.macs[1], self.uuid)],
                          [tuple(row) for row in res])
 
+    def test_add_node_options(self):
+        res = node_cache.add_node(self.node.uuid, mac=self.macs,
+                                  options={'foo': ['bar', 42]})
+
+        self.assertEqual({'foo': ['bar', 42]}, res.options)
+        rows = self.db.execute("select uuid, name, value from "
+                               "options").fetchall()
+        self.assertEqual([(self.uuid, 'foo', '["bar", 42]')],
+                         [tuple(row) for row in rows])
+
+    @mock.patch.object(node_cache.SQLiteDriver, 'get_options')
+    def test_add_node_options_cached(self, get_mock):
+        res = node_cache.add_node(self.node.uuid, mac=self.macs)
+        self.assertEqual({}, res.options)
+        self.assertFalse(get_mock.called)
+
     def test_add_node_duplicate_mac(self):
         with self.db:
             self.db.execute("insert into nodes(uuid) values(?)",
@@ -75,9 +93,18 @@ class TestNodeCache(test_base.NodeTest):
                                 "values(?, ?, ?)",
                                 [('mac', '11:22:11:22:11:22', self.uuid),
                                  ('mac', '22:11:22:11:22:11', self.uuid)])
+        # Look up index is loaded from the database on start up
+        node_cache.init()
         self.assertEqual({'11:22:11:22:11:22', '22:11:22:11:22:11'},
                          node_cache.active_macs())
 
+    def test_active_macs_updated(self):
+        node_cache.add_node(self.node.uuid, mac=self.macs)
+        self.assertEqual(set(self.macs), node_cache.active_macs())
+
+        node_cache.NodeInfo(uuid=self.uuid, started_at=42).finished()
+        self.assertEqual(set(), node_cache.active_macs())
+
     def test_add_attribute(self):
         with self.db:
             self.db.execute("insert into nodes(uuid) values(?)",
@@ -90,6 +117,68 @@ class TestNodeCache(test_base.NodeTest):
                          [tuple(row) for row in res])
         self.assertRaises(utils.Error, node_info.add_attribute,
                           'key', 'value')
+        self.assertEqual(self.uuid, node_cache._index().get('key', 'value'))
+
+    def test_add_node_failed_keeps_index(self):
+        node_cache.add_node(self.node.uuid, mac=self.macs)
+        node_cache.add_node('uuid2', mac=['00:00:00:00:00:00'])
+
+        self.assertRaises(utils.Error, node_cache.add_node,
+                          'uuid2', bmc_address='1.2.3.4', mac=self.macs)
+
+        self.assertEqual(self.uuid, node_cache.find_node(mac=self.macs).uuid)
+        self.assertEqual('uuid2', node_cache.find_node(
+            mac=['00:00:00:00:00:00']).uuid)
+        self.assertRaises(utils.Error, node_cache.find_node,
+                          bmc_address='1.2.3.4')
+
+
+class TestNodeCacheAddNodes(test_base.NodeTest):
+    def test_ok(self):
+        added, failed = node_cache.add_nodes(
+            {self.uuid: {'mac': self.macs, 'bmc_address': '1.2.3.4'},
+             'uuid2': {'mac': ['00:00:00:00:00:00'], 'bmc_address': None}},
+            options={'uuid2': {'foo': {'bar': 42}}})
+
+        self.assertEqual({}, failed)
+        self.assertEqual({self.uuid, 'uuid2'}, set(added))
+        self.assertEqual(added[self.uuid].started_at,
+                         added['uuid2'].started_at)
+        res = self.db.execute("select name, value, uuid from attributes "
+                              "order by name, value").fetchall()
+        self.assertEqual([('bmc_address', '1.2.3.4', self.uuid),
+                          ('mac', '00:00:00:00:00:00', 'uuid2'),
+                          ('mac', self.macs[0], self.uuid),
+                          ('mac', self.macs[1], self.uuid)],
+                         [tuple(row) for row in res])
+        self.assertEqual({'foo': {'bar': 42}},
+                         node_cache.get_node('uuid2').options)
+        self.assertEqual('uuid2', node_cache.find_node(
+            mac=['00:00:00:00:00:00']).uuid)
+
+    def test_replaces_existing(self):
+        node_cache.add_node(self.uuid, mac=self.macs).set_option('foo', 1)
+
+        added, failed = node_cache.add_nodes({self.uuid: {'mac': self.macs}})
+
+        self.assertEqual({}, failed)
+        self.assertEqual({}, node_cache.get_node(self.uuid).options)
+        self.assertEqual(set(self.macs), node_cache.active_macs())
+
+    def test_conflicts(self):
+        node_cache.add_node('uuid0', mac=[self.macs[0]])
+
+        added, failed = node_cache.add_nodes(
+            {self.uuid: {'mac': self.macs},
+             'uuid2': {'mac': ['00:00:00:00:00:00']},
+             'uuid3': {'mac': ['00:00:00:00:00:00']}})
+
+        self.assertEqual(['uuid2'], list(added))
+        self.assertEqual({self.uuid, 'uuid3'}, set(failed))
+        self.assertIsInstance(failed[self.uuid], utils.Error)
+        self.assertRaises(utils.Error, node_cache.get_node, self.uuid)
+        self.assertEqual({self.macs[0], '00:00:00:00:00:00'},
+                         node_cache.active_macs())
 
 
 class TestNodeCacheFind(test_base.NodeTest):
@@ -136,6 +225,11 @@ class TestNodeCacheFind(test_base.NodeTest):
         self.assertRaises(utils.Error, node_cache.find_node,
                           bmc_address='1.2.3.4')
 
+    def test_finished(self):
+        node_cache.NodeInfo(uuid=self.uuid, started_at=42).finished()
+        self.assertRaises(utils.Error, node_cache.find_node,
+                          bmc_address='1.2.3.4')
+
     def test_already_finished(self):
         with self.db:
             self.db.execute('update nodes set finished_at=42.0 where uuid=?',
@@ -156,6 +250,8 @@ class TestNodeCacheCleanUp(test_base.NodeTest):
                                 [('mac', v, self.uuid) for v in self.macs])
             self.db.execute('insert into options(uuid, name, value) '
                             'values(?, ?, ?)', (self.uuid, 'foo', 'bar'))
+        # Reload look up index
+        node_cache.init()
 
     def test_no_timeout(self):
         CONF.set_override('timeout', 0, 'discoverd')
@@ -169,6 +265,7 @@ class TestNodeCacheCleanUp(test_base.NodeTest):
             'select * from attributes').fetchall()))
         self.assertEqual(1, len(self.db.execute(
             'select * from options').fetchall()))
+        self.assertEqual(set(self.macs), node_cache.active_macs())
 
     @mock.patch.object(time, 'time')
     def test_ok(self, time_mock):
@@ -206,6 +303,7 @@ class TestNodeCacheCleanUp(test_base.NodeTest):
             'select * from attributes').fetchall())
         self.assertEqual([], self.db.execute(
             'select * from options').fetchall())
+        self.assertEqual(set(), node_cache.active_macs())
 
     def test_old_status(self):
         CONF.set_override('node_status_keep_time', 42, 'discoverd')
@@ -218,6 +316,116 @@ class TestNodeCacheCleanUp(test_base.NodeTest):
         self.assertEqual([], self.db.execute(
             'select * from nodes').fetchall())
 
+    @mock.patch.object(eventlet.greenthread, 'sleep', autospec=True)
+    def test_old_status_batches(self, sleep_mock):
+        CONF.set_override('node_status_keep_time', 42, 'discoverd')
+        CONF.set_override('clean_up_batch_size', 2, 'discoverd')
+        CONF.set_override('timeout', 0, 'discoverd')
+        with self.db:
+            self.db.executemany('insert into nodes(uuid, finished_at) '
+                                'values(?, ?)',
+                                [('uuid%d' % i, time.time() - 100)
+                                 for i in range(4)])
+            self.db.execute('insert into nodes(uuid, finished_at) '
+                            'values(?, ?)', ('recent', time.time()))
+
+        self.assertEqual([], node_cache.clean_up())
+
+        self.assertEqual([self.uuid, 'recent'], [row[0] for row in
+                                                 self.db.execute(
+            'select uuid from nodes order by uuid').fetchall()])
+        # 2 full batches, the last one is empty
+        self.assertEqual(2, sleep_mock.call_count)
+
+    @mock.patch.object(eventlet.greenthread, 'sleep', autospec=True)
+    @mock.patch.object(time, 'time')
+    def test_timeout_batches(self, time_mock, sleep_mock):
+        uuids = [self.uuid] + ['uuid%d' % i for i in range(4)]
+        with self.db:
+            self.db.executemany('insert into nodes(uuid, started_at) '
+                                'values(?, ?)',
+                                [(u, self.started_at) for u in uuids[1:]])
+        CONF.set_override('timeout', 99, 'discoverd')
+        CONF.set_override('clean_up_batch_size', 2, 'discoverd')
+        time_mock.return_value = self.started_at + 100
+
+        self.assertEqual(sorted(uuids), sorted(node_cache.clean_up()))
+
+        self.assertEqual([(self.started_at + 100, 'Introspection timeout')] *
+                         5,
+                         [tuple(row) for row in self.db.execute(
+                             'select finished_at, error from nodes')])
+        self.assertEqual([], self.db.execute(
+            'select * from attributes').fetchall())
+        self.assertEqual(3, sleep_mock.call_count)
+
+    @mock.patch.object(eventlet.greenthread, 'sleep', autospec=True)
+    @mock.patch.object(time, 'time')
+    def test_timeout_batch_size_above_parameters_limit(self, time_mock,
+                                                       sleep_mock):
+        uuids = [self.uuid] + ['uuid%d' % i for i in range(1200)]
+        with self.db:
+            self.db.executemany('insert into nodes(uuid, started_at) '
+                                'values(?, ?)',
+                                [(u, self.started_at) for u in uuids[1:]])
+        CONF.set_override('timeout', 99, 'discoverd')
+        CONF.set_override('clean_up_batch_size', 2000, 'discoverd')
+        time_mock.return_value = self.started_at + 100
+
+        self.assertEqual(sorted(uuids), sorted(node_cache.clean_up()))
+
+        self.assertEqual([], self.db.execute(
+            'select * from nodes where finished_at is null').fetchall())
+        self.assertEqual(3, sleep_mock.call_count)
+
+    @mock.patch.object(eventlet.greenthread, 'sleep', autospec=True)
+    def test_old_status_batch_size_above_parameters_limit(self, sleep_mock):
+        CONF.set_override('node_status_keep_time', 42, 'discoverd')
+        CONF.set_override('clean_up_batch_size', 2000, 'discoverd')
+        CONF.set_override('timeout', 0, 'discoverd')
+        with self.db:
+            self.db.executemany('insert into nodes(uuid, finished_at) '
+                                'values(?, ?)',
+                                [('uuid%d' % i, time.time() - 100)
+                                 for i in range(1200)])
+
+        self.assertEqual([], node_cache.clean_up())
+
+        self.assertEqual([self.uuid], [row[0] for row in self.db.execute(
+            'select uuid from nodes').fetchall()])
+        self.assertEqual(2, sleep_mock.call_count)
+
+    @mock.patch.object(eventlet.greenthread, 'sleep', autospec=True)
+    @mock.patch.object(time, 'time')
+    def test_timeout_node_restarted(self, time_mock, sleep_mock):
+        with self.db:
+            self.db.execute('insert into nodes(uuid, started_at) '
+                            'values(?, ?)', ('uuid2', self.started_at))
+        CONF.set_override('timeout', 99, 'discoverd')
+        CONF.set_override('clean_up_batch_size', 1, 'discoverd')
+        time_mock.return_value = self.started_at + 100
+        restarted = []
+
+        def _restart(_delay):
+            # Restart introspection for the node from the next batch
+            if not restarted:
+                uuid = self.db.execute('select uuid from nodes where '
+                                       'finished_at is null').fetchone()[0]
+                node_cache.add_node(uuid, mac=['aa:bb:cc:dd:ee:ff'])
+                restarted.append(uuid)
+
+        sleep_mock.side_effect = _restart
+
+        timed_out = node_cache.clean_up()
+
+        self.assertEqual(1, len(timed_out))
+        self.assertNotIn(restarted[0], timed_out)
+        node = node_cache.get_node(restarted[0])
+        self.assertIsNone(node.finished_at)
+        self.assertIsNone(node.error)
+        self.assertEqual({'aa:bb:cc:dd:ee:ff'}, node_cache.active_macs())
+        self.assertEqual({'mac': ['aa:bb:cc:dd:ee:ff']}, node.attributes)
+
 
 class TestNodeCacheGetNode(test_base.NodeTest):
     def test_ok(self):
@@ -235,6 +443,51 @@ class TestNodeCacheGetNode(test_base.NodeTest):
     def test_not_found(self):
         self.assertRaises(utils.Error, node_cache.get_node, 'foo')
 
+    def test_lazy(self):
+        node_cache.add_node(self.uuid, mac=self.macs)
+        node_info = node_cache.get_node(self.uuid)
+        with mock.patch.object(node_cache.SQLiteDriver,
+                               'get_options') as get_mock:
+            get_mock.return_value = {}
+            self.assertEqual(sorted(self.macs),
+                             sorted(node_info.attributes['mac']))
+            self.assertFalse(get_mock.called)
+            self.assertEqual({}, node_info.options)
+            get_mock.assert_called_once_with(self.uuid)
+
+    def test_slots(self):
+        node_info = node_cache.NodeInfo(uuid=self.uuid, started_at=42)
+        self.assertFalse(hasattr(node_info, '__dict__'))
+
+
+class TestNodeCacheGetNodes(test_base.NodeTest):
+    def setUp(self):
+        super(TestNodeCacheGetNodes, self).setUp()
+        with self.db:
+            self.db.executemany('insert into nodes(uuid, started_at, '
+                                'finished_at, error) values(?, ?, ?, ?)',
+                                [('uuid1', 2.0, None, None),
+                                 ('uuid2', 1.0, 3.0, 'boom'),
+                                 ('uuid3', 3.0, None, None)])
+
+    def test_all(self):
+        nodes = node_cache.get_nodes()
+        self.assertEqual(['uuid2', 'uuid1', 'uuid3'],
+                         [node.uuid for node in nodes])
+        self.assertEqual((3.0, 'boom'),
+                         (nodes[0].finished_at, nodes[0].error))
+
+    def test_some(self):
+        self.assertEqual(['uuid2', 'uuid3'],
+                         [node.uuid for node in
+                          node_cache.get_nodes(['uuid3', 'foo', 'uuid2'])])
+
+    @mock.patch.object(node_cache, '_MAX_PARAMETERS', 1)
+    def test_chunks(self):
+        self.assertEqual(['uuid2', 'uuid1'],
+                         [node.uuid for node in
+                          node_cache.get_nodes(['uuid1', 'uuid2'])])
+
 
 @mock.patch.object(time, 'time', lambda: 42.0)
 class TestNodeInfoFinished(test_base.NodeTest):
@@ -250,6 +503,8 @@ class TestNodeInfoFinished(test_base.NodeTest):
 
     def test_success(self):
         self.node_info.finished()
+        self.assertEqual({}, self.node_info.options)
+        self.assertEqual({}, self.node_info.attributes)
 
         self.assertEqual((42.0, None), tuple(self.db.execute(
             'select finished_at, error from nodes').fetchone()))
@@ -273,6 +528,7 @@ class TestInit(unittest.TestCase):
     def setUp(self):
         super(TestInit, self).setUp()
         node_cache._DB_NAME = None
+        node_cache._POOL = None
 
     def test_ok(self):
         with tempfile.NamedTemporaryFile() as db_file:
@@ -280,8 +536,10 @@ class TestInit(unittest.TestCase):
             node_cache.init()
 
             self.assertIsNotNone(node_cache._DB_NAME)
+            self.assertIsNotNone(node_cache._POOL)
             # Verify that table exists
-            node_cache._db().execute("select * from nodes")
+            with node_cache._db() as db:
+                db.execute("select * from nodes")
 
     def test_create_dir(self):
         temp = tempfile.mkdtemp()
@@ -289,11 +547,132 @@ class TestInit(unittest.TestCase):
                           'discoverd')
         node_cache.init()
 
+    def test_pragmas(self):
+        with tempfile.NamedTemporaryFile() as db_file:
+            CONF.set_override('database', db_file.name, 'discoverd')
+            CONF.set_override('database_synchronous', 'full', 'discoverd')
+            CONF.set_override('database_cache_size', 4096, 'discoverd')
+            self.addCleanup(CONF.clear_override, 'database_synchronous',
+                            'discoverd')
+            self.addCleanup(CONF.clear_override, 'database_cache_size',
+                            'discoverd')
+            node_cache.init()
+
+            with node_cache._db() as db:
+                self.assertEqual('wal', db.execute(
+                    'pragma journal_mode').fetchone()[0])
+                # 2 is FULL
+                self.assertEqual(2, db.execute(
+                    'pragma synchronous').fetchone()[0])
+                self.assertEqual(-4096, db.execute(
+                    'pragma cache_size').fetchone()[0])
+
+    def test_journal_mode(self):
+        with tempfile.NamedTemporaryFile() as db_file:
+            CONF.set_override('database', db_file.name, 'discoverd')
+            CONF.set_override('database_journal_mode', 'delete',
+                              'discoverd')
+            self.addCleanup(CONF.clear_override, 'database_journal_mode',
+                            'discoverd')
+            node_cache.init()
+
+            with node_cache._db() as db:
+                self.assertEqual('delete', db.execute(
+                    'pragma journal_mode').fetchone()[0])
+
+    def test_schema_version(self):
+        with tempfile.NamedTemporaryFile() as db_file:
+            CONF.set_override('database', db_file.name, 'discoverd')
+            node_cache.init()
+            # Second call should not apply migrations again
+            node_cache.init()
+
+            with node_cache._db() as db:
+                self.assertEqual(
+                    list(range(1, len(node_cache._MIGRATIONS) + 1)),
+                    [row[0] for row in db.execute(
+                        'select version from schema_version '
+                        'order by version')])
+                indexes = {row[0] for row in db.execute(
+                    "select name from sqlite_master where type='index'")}
+            self.assertTrue({'attributes_uuid_idx', 'nodes_started_at_idx',
+                             'nodes_finished_at_idx'}.issubset(indexes))
+
+    def test_upgrade_unversioned(self):
+        with tempfile.NamedTemporaryFile() as db_file:
+            # Database created by an old version without schema_version
+            conn = sqlite3.connect(db_file.name)
+            conn.executescript(node_cache._SCHEMA)
+            with conn:
+                conn.execute("insert into nodes(uuid) values('uuid')")
+            conn.close()
+
+            CONF.set_override('database', db_file.name, 'discoverd')
+            node_cache.init()
+
+            with node_cache._db() as db:
+                self.assertEqual(len(node_cache._MIGRATIONS), db.execute(
+                    'select max(version) from schema_version').fetchone()[0])
+                self.assertEqual(['uuid'], [row[0] for row in db.execute(
+                    'select uuid from nodes')])
+
     def test_no_database(self):
         CONF.set_override('database', '', 'discoverd')
         self.assertRaises(SystemExit, node_cache.init)
 
 
+class TestConnectionPool(test_base.BaseTest):
+    def test_reuse_connection(self):
+        with node_cache._db() as db1:
+            pass
+        with node_cache._db() as db2:
+            pass
+        self.assertIs(db1, db2)
+
+    def test_concurrent_connections(self):
+        with node_cache._db() as db1:
+            with node_cache._db() as db2:
+                self.assertIsNot(db1, db2)
+
+    def test_pool_size(self):
+        CONF.set_override('database_pool_size', 3, 'discoverd')
+        node_cache.init()
+        self.assertEqual(3, node_cache._POOL.max_size)
+
+    def test_rollback_on_error(self):
+        try:
+            with node_cache._db() as db:
+                db.execute("insert into nodes(uuid) values('uuid')")
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEqual([], self.db.execute(
+            "select * from nodes").fetchall())
+
+    def test_commit(self):
+        with node_cache._db() as db:
+            db.execute("insert into nodes(uuid) values('uuid')")
+        self.assertEqual(1, len(self.db.execute(
+            "select * from nodes").fetchall()))
+
+    @mock.patch.object(eventlet.greenthread, 'sleep', autospec=True)
+    def test_time_out_twice_on_one_connection(self, sleep_mock):
+        CONF.set_override('database_pool_size', 1, 'discoverd')
+        node_cache.init()
+        driver = node_cache.SQLiteDriver()
+        for i in range(2):
+            node_cache.add_node('uuid%d' % i, mac=['00:00:00:00:00:0%d' % i])
+            self.assertEqual(['uuid%d' % i],
+                             driver.time_out(time.time() + 1, time.time(),
+                                             'Timeout'))
+
+        self.assertEqual([('uuid0', 'Timeout'), ('uuid1', 'Timeout')],
+                         [tuple(row) for row in self.db.execute(
+                             'select uuid, error from nodes order by uuid')])
+        self.assertEqual([], self.db.execute(
+            'select * from attributes').fetchall())
+
+
 class TestNodeInfoOptions(test_base.NodeTest):
     def setUp(self):
         super(TestNodeInfoOptions, self).setUp()
@@ -322,3 +701,23 @@ class TestNodeInfoOptions(test_base.NodeTest):
 
         new = node_cache.NodeInfo(uuid=self.uuid, started_at=3.14)
         self.assertEqual(data, new.options['name'])
+
+    def test_set_existing(self):
+        self.node_info.set_option('foo', 42)
+        self.assertEqual({'foo': 42}, self.node_info.options)
+        rows = self.db.execute('select name, value from options').fetchall()
+        self.assertEqual([('foo', '42')], [tuple(row) for row in rows])
+
+    @mock.patch.object(node_cache.SQLiteDriver, 'get_options')
+    def test_set_does_not_load(self, get_mock):
+        self.node_info.set_option('name', 'value')
+        self.assertFalse(get_mock.called)
+
+    @mock.patch.object(node_cache.SQLiteDriver, 'get_options')
+    def test_set_write_through(self, get_mock):
+        get_mock.return_value = {'foo': '"bar"'}
+        self.assertEqual({'foo': 'bar'}, self.node_info.options)
+        self.node_info.set_option('name', 'value')
+        self.assertEqual({'foo': 'bar', 'name': 'value'},
+                         self.node_info.options)
+        get_mock.assert_called_once_with(self.uuid)
@@ -0,0 +1,99 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+from oslo_config import cfg
+
+from ironic_discoverd import firewall
+from ironic_discoverd import node_cache
+from ironic_discoverd.plugins import base as plugins_base
+from ironic_discoverd.plugins import firewall_nftables
+from ironic_discoverd.test import base as test_base
+
+
+CONF = cfg.CONF
+
+
+@mock.patch.object(firewall, 'run_with_input', autospec=True)
+class TestNftablesDriver(test_base.NodeTest):
+    def setUp(self):
+        super(TestNftablesDriver, self).setUp()
+        CONF.set_override('firewall_driver', 'nftables', 'discoverd')
+        CONF.set_override('firewall_update_window', 0, 'discoverd')
+        self.driver = plugins_base.firewall_driver()
+
+    def _commands(self, run_mock):
+        self.assertEqual(1, run_mock.call_count)
+        args = run_mock.call_args[0]
+        self.assertEqual(('nft', '-f', '-'), args[0])
+        return args[1].splitlines()
+
+    def test_type(self, run_mock):
+        self.assertIsInstance(self.driver, firewall_nftables.NftablesDriver)
+
+    def test_init(self, run_mock):
+        self.driver.init()
+
+        commands = self._commands(run_mock)
+        self.assertEqual(['table inet ironic_discoverd',
+                          'delete table inet ironic_discoverd',
+                          'table inet ironic_discoverd {'], commands[:3])
+        self.assertIn('    set blacklist { type ether_addr; }', commands)
+        self.assertIn('        iifname "br-ctlplane" udp dport 67 '
+                      'ether saddr @blacklist drop', commands)
+
+    def test_update(self, run_mock):
+        self.driver.update({'11:22:33:44:55:66', '66:55:44:33:22:11'})
+
+        self.assertEqual(['flush set inet ironic_discoverd blacklist',
+                          'add element inet ironic_discoverd blacklist '
+                          '{ 11:22:33:44:55:66, 66:55:44:33:22:11 }'],
+                         self._commands(run_mock))
+
+    def test_update_empty(self, run_mock):
+        self.driver.update(set())
+
+        self.assertEqual(['flush set inet ironic_discoverd blacklist'],
+                         self._commands(run_mock))
+
+    def test_update_delta(self, run_mock):
+        self.driver.update({'11:22:33:44:55:66', 'AA:BB:CC:DD:EE:FF'},
+                           {'11:22:33:44:55:66', '66:55:44:33:22:11'})
+
+        self.assertEqual(['delete element inet ironic_discoverd blacklist '
+                          '{ 66:55:44:33:22:11 }',
+                          'add element inet ironic_discoverd blacklist '
+                          '{ AA:BB:CC:DD:EE:FF }'],
+                         self._commands(run_mock))
+
+    def test_clean_up(self, run_mock):
+        self.driver.clean_up()
+
+        self.assertEqual(['table inet ironic_discoverd',
+                          'delete table inet ironic_discoverd'],
+                         self._commands(run_mock))
+
+    def test_firewall(self, run_mock):
+        ironic = mock.Mock()
+        ironic.port.list.return_value = [mock.Mock(address=mac)
+                                         for mac in self.macs]
+        node_cache.add_node(self.uuid, mac=self.macs[:1])
+
+        firewall.init()
+        run_mock.reset_mock()
+        firewall.update_filters(ironic)
+
+        self.assertEqual(['flush set inet ironic_discoverd blacklist',
+                          'add element inet ironic_discoverd blacklist '
+                          '{ 66:55:44:33:22:11 }'],
+                         self._commands(run_mock))
@@ -0,0 +1,343 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import tempfile
+
+import eventlet
+import mock
+from oslo_config import cfg
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+from sqlalchemy import exc as sa_exc
+
+from ironic_discoverd import node_cache
+from ironic_discoverd.plugins import base as plugins_base
+from ironic_discoverd.plugins import node_cache_memory
+from ironic_discoverd.plugins import node_cache_sqlalchemy
+from ironic_discoverd.test import base as test_base
+from ironic_discoverd import utils
+
+
+CONF = cfg.CONF
+
+
+@mock.patch.object(eventlet.greenthread, 'sleep', lambda _: None)
+class DriverTestMixin(object):
+    """Tests every node cache driver should pass."""
+
+    driver_name = None
+
+    def setUp(self):
+        super(DriverTestMixin, self).setUp()
+        CONF.set_override('node_cache_driver', self.driver_name, 'discoverd')
+        self.configure()
+        self.driver = plugins_base.node_cache_driver()
+        self.driver.init()
+        self.driver.add_node(self.uuid, 100.0,
+                             {'mac': self.macs, 'bmc_address': ['1.2.3.4']})
+
+    def configure(self):
+        pass
+
+    def test_get_node(self):
+        self.assertEqual({'uuid': self.uuid, 'started_at': 100.0,
+                          'finished_at': None, 'error': None},
+                         dict(self.driver.get_node(self.uuid)))
+        self.assertIsNone(self.driver.get_node('foo'))
+
+    def test_get_nodes(self):
+        self.driver.add_node('uuid2', 200.0, {})
+        self.assertEqual({self.uuid, 'uuid2'},
+                         {node['uuid'] for node in self.driver.get_nodes()})
+        nodes = self.driver.get_nodes(['uuid2', 'foo'])
+        self.assertEqual([{'uuid': 'uuid2', 'started_at': 200.0,
+                           'finished_at': None, 'error': None}],
+                         [dict(node) for node in nodes])
+        self.assertEqual([], list(self.driver.get_nodes([])))
+
+    def test_get_attributes(self):
+        attributes = self.driver.get_attributes(self.uuid)
+        self.assertEqual({'mac', 'bmc_address'}, set(attributes))
+        self.assertEqual(sorted(self.macs), sorted(attributes['mac']))
+        self.assertEqual(['1.2.3.4'], attributes['bmc_address'])
+        self.assertEqual({}, self.driver.get_attributes('foo'))
+
+    def test_lookup(self):
+        self.assertEqual({self.uuid}, self.driver.lookup(
+            {'mac': ['00:00:00:00:00:00', self.macs[1]]}))
+        self.assertEqual({self.uuid}, self.driver.lookup(
+            {'mac': self.macs, 'bmc_address': ['1.2.3.4']}))
+        self.assertEqual(set(), self.driver.lookup(
+            {'mac': ['00:00:00:00:00:00']}))
+
+    def test_lookup_multiple(self):
+        self.driver.add_node('uuid2', 100.0, {'mac': ['00:00:00:00:00:00']})
+        self.assertEqual({self.uuid, 'uuid2'}, self.driver.lookup(
+            {'mac': ['00:00:00:00:00:00', self.macs[1]]}))
+
+    def test_attribute_values(self):
+        self.assertEqual(set(self.macs), self.driver.attribute_values('mac'))
+        self.assertEqual(set(), self.driver.attribute_values('foo'))
+
+    def test_add_node_replaces(self):
+        self.driver.set_option(self.uuid, 'foo', '"bar"')
+        self.driver.add_node(self.uuid, 200.0, {'mac': self.macs[:1]})
+
+        self.assertEqual(200.0, self.driver.get_node(self.uuid)['started_at'])
+        self.assertEqual({self.macs[0]}, self.driver.attribute_values('mac'))
+        self.assertEqual(set(), self.driver.lookup(
+            {'bmc_address': ['1.2.3.4']}))
+        self.assertEqual({}, self.driver.get_options(self.uuid))
+
+    def test_add_node_options(self):
+        self.driver.set_option(self.uuid, 'foo', '"bar"')
+        self.driver.add_node(self.uuid, 200.0, {'mac': self.macs},
+                             {'answer': '42'})
+        self.assertEqual({'answer': '42'}, self.driver.get_options(self.uuid))
+
+    def test_add_node_conflict(self):
+        self.assertRaises(utils.Error, self.driver.add_node, 'uuid2', 100.0,
+                          {'mac': ['00:00:00:00:00:00', self.macs[0]]},
+                          {'foo': '"bar"'})
+        self.assertEqual({}, self.driver.get_options('uuid2'))
+        self.assertIsNone(self.driver.get_node('uuid2'))
+        self.assertEqual(set(), self.driver.lookup(
+            {'mac': ['00:00:00:00:00:00']}))
+        self.assertEqual({self.uuid}, self.driver.lookup(
+            {'mac': [self.macs[0]]}))
+
+    def test_add_nodes(self):
+        failed = self.driver.add_nodes(200.0, {
+            self.uuid: ({'mac': self.macs[:1]}, {'foo': '"bar"'}),
+            'uuid2': ({'mac': ['00:00:00:00:00:00']}, {}),
+            'uuid3': ({'mac': [self.macs[0]]}, {}),
+            'uuid4': ({'bmc_address': ['1.2.3.4']}, {}),
+        })
+
+        self.assertEqual({'uuid3', 'uuid4'}, set(failed))
+        self.assertIsNone(self.driver.get_node('uuid3'))
+        self.assertEqual(200.0, self.driver.get_node('uuid2')['started_at'])
+        self.assertEqual({self.macs[0], '00:00:00:00:00:00'},
+                         self.driver.attribute_values('mac'))
+        self.assertEqual({'foo': '"bar"'}, self.driver.get_options(self.uuid))
+        self.assertEqual(set(), self.driver.lookup(
+            {'bmc_address': ['1.2.3.4']}))
+
+    def test_add_attribute(self):
+        self.driver.add_attribute(self.uuid, 'foo', ['bar', 'baz'])
+        self.assertEqual({self.uuid}, self.driver.lookup({'foo': ['baz']}))
+        self.assertRaises(utils.Error, self.driver.add_attribute,
+                          self.uuid, 'foo', ['bar'])
+
+    def test_options(self):
+        self.assertEqual({}, self.driver.get_options(self.uuid))
+        self.driver.set_option(self.uuid, 'foo', '"bar"')
+        self.driver.set_option(self.uuid, 'foo', '42')
+        self.driver.set_option(self.uuid, 'answer', 'null')
+        self.assertEqual({'foo': '42', 'answer': 'null'},
+                         self.driver.get_options(self.uuid))
+
+    def test_finished(self):
+        self.driver.set_option(self.uuid, 'foo', '"bar"')
+        self.driver.finished(self.uuid, 200.0, 'boom')
+
+        node = self.driver.get_node(self.uuid)
+        self.assertEqual((200.0, 'boom'),
+                         (node['finished_at'], node['error']))
+        self.assertEqual(set(), self.driver.attribute_values('mac'))
+        self.assertEqual({}, self.driver.get_options(self.uuid))
+
+    def test_delete_finished(self):
+        CONF.set_override('clean_up_batch_size', 2, 'discoverd')
+        for i in range(5):
+            self.driver.add_node('uuid%d' % i, 100.0, {})
+            self.driver.finished('uuid%d' % i, 150.0 + i, None)
+
+        self.assertEqual(3, self.driver.delete_finished(153.0))
+
+        self.assertIsNone(self.driver.get_node('uuid2'))
+        self.assertIsNotNone(self.driver.get_node('uuid3'))
+        self.assertIsNotNone(self.driver.get_node(self.uuid))
+
+    def test_time_out(self):
+        CONF.set_override('clean_up_batch_size', 2, 'discoverd')
+        for i in range(3):
+            self.driver.add_node('uuid%d' % i, 90.0 + 10 * i, {})
+        self.driver.finished('uuid0', 95.0, None)
+
+        self.assertEqual({'uuid1', self.uuid},
+                         set(self.driver.time_out(105.0, 200.0, 'timeout')))
+
+        node = self.driver.get_node(self.uuid)
+        self.assertEqual((200.0, 'timeout'),
+                         (node['finished_at'], node['error']))
+        self.assertEqual(95.0, self.driver.get_node('uuid0')['finished_at'])
+        self.assertIsNone(self.driver.get_node('uuid2')['finished_at'])
+        self.assertEqual(set(), self.driver.attribute_values('mac'))
+
+
+class BatchedTimeOutMixin(object):
+    """Tests for drivers timing out nodes in several transactions."""
+
+    def test_time_out_node_restarted(self):
+        CONF.set_override('clean_up_batch_size', 1, 'discoverd')
+        self.driver.add_node('uuid1', 90.0, {'mac': ['aa:bb:cc:dd:ee:ff']},
+                             {'foo': '"bar"'})
+        restarted = []
+
+        def _restart(_delay):
+            # Restart introspection for the node from the next batch
+            if not restarted:
+                uuid = [node['uuid'] for node in self.driver.get_nodes()
+                        if node['finished_at'] is None][0]
+                self.driver.add_node(uuid, 300.0,
+                                     {'mac': ['11:11:11:11:11:11']},
+                                     {'foo': '"baz"'})
+                restarted.append(uuid)
+
+        with mock.patch.object(eventlet.greenthread, 'sleep',
+                               side_effect=_restart):
+            timed_out = self.driver.time_out(105.0, 200.0, 'timeout')
+
+        self.assertEqual(1, len(timed_out))
+        self.assertNotIn(restarted[0], timed_out)
+        node = self.driver.get_node(restarted[0])
+        self.assertEqual((300.0, None, None),
+                         (node['started_at'], node['finished_at'],
+                          node['error']))
+        self.assertEqual({'mac': ['11:11:11:11:11:11']},
+                         self.driver.get_attributes(restarted[0]))
+        self.assertEqual({'foo': '"baz"'},
+                         self.driver.get_options(restarted[0]))
+        self.assertEqual({'11:11:11:11:11:11'},
+                         self.driver.attribute_values('mac'))
+
+
+class TestSQLiteDriver(BatchedTimeOutMixin, DriverTestMixin,
+                       test_base.NodeTest):
+    driver_name = 'sqlite'
+
+    def test_type(self):
+        self.assertIsInstance(self.driver, node_cache.SQLiteDriver)
+
+    def test_add_nodes_concurrent_conflict(self):
+        # Conflict not yet visible in the index when it is checked
+        with mock.patch.object(node_cache, 'find_conflicts',
+                               autospec=True) as find_mock:
+            find_mock.return_value = {}
+            failed = self.driver.add_nodes(200.0, {
+                'uuid2': ({'mac': ['00:00:00:00:00:00']}, {}),
+                'uuid3': ({'mac': [self.macs[0]]}, {}),
+            })
+
+        self.assertEqual({'uuid3'}, set(failed))
+        self.assertIsInstance(failed['uuid3'], utils.Error)
+        self.assertEqual(200.0, self.driver.get_node('uuid2')['started_at'])
+        self.assertIsNone(self.driver.get_node('uuid3'))
+        self.assertEqual({'uuid2'},
+                         self.driver.lookup({'mac': ['00:00:00:00:00:00']}))
+
+
+class TestMemoryDriver(DriverTestMixin, test_base.NodeTest):
+    driver_name = 'memory'
+
+    def test_type(self):
+        self.assertIsInstance(self.driver, node_cache_memory.MemoryDriver)
+
+
+class TestSQLAlchemyDriver(BatchedTimeOutMixin, DriverTestMixin,
+                           test_base.NodeTest):
+    driver_name = 'sqlalchemy'
+
+    def configure(self):
+        # SQLite file is used as a stand-in for a shared
+        # database server
+        db_file = tempfile.NamedTemporaryFile()
+        self.addCleanup(db_file.close)
+        CONF.set_override('database_connection',
+                          'sqlite:///%s' % db_file.name, 'discoverd')
+
+    def tearDown(self):
+        self.driver.engine.dispose()
+        super(TestSQLAlchemyDriver, self).tearDown()
+
+    def test_type(self):
+        self.assertIsInstance(self.driver,
+                              node_cache_sqlalchemy.SQLAlchemyDriver)
+
+    def test_add_nodes_concurrent_conflict(self):
+        with mock.patch.object(self.driver, '_add_nodes',
+                               autospec=True) as add_mock:
+            add_mock.side_effect = sa_exc.IntegrityError('insert', {}, None)
+            failed = self.driver.add_nodes(200.0, {
+                'uuid2': ({'mac': ['00:00:00:00:00:00']}, {}),
+                'uuid3': ({'mac': [self.macs[0]]}, {}),
+            })
+
+        self.assertEqual({'uuid3'}, set(failed))
+        self.assertEqual(200.0, self.driver.get_node('uuid2')['started_at'])
+
+    def test_time_stamps_double_precision(self):
+        dialect = mysql.dialect()
+        for column in ('started_at', 'finished_at'):
+            column_type = node_cache_sqlalchemy.NODES.c[column].type
+            self.assertEqual('FLOAT(53)',
+                             column_type.compile(dialect=dialect))
+
+    def test_time_out_lossy_time_stamps(self):
+        # Simulate a database that does not store time stamps exactly
+        with self.driver.engine.begin() as conn:
+            conn.execute(sa.text(
+                'CREATE TRIGGER round_finished_at AFTER UPDATE OF '
+                'finished_at ON nodes BEGIN UPDATE nodes SET finished_at = '
+                'CAST(NEW.finished_at AS INTEGER) WHERE uuid = NEW.uuid; '
+                'END'))
+
+        self.assertEqual([self.uuid],
+                         self.driver.time_out(105.0, 200.5, 'timeout'))
+
+        node = self.driver.get_node(self.uuid)
+        self.assertEqual((200.0, 'timeout'),
+                         (node['finished_at'], node['error']))
+        self.assertEqual({}, self.driver.get_attributes(self.uuid))
+        self.assertEqual(set(), self.driver.attribute_values('mac'))
+
+    def test_no_connection(self):
+        CONF.set_override('database_connection', '', 'discoverd')
+        self.assertRaises(SystemExit, self.driver.init)
+
+
+class TestNodeCacheWithMemoryDriver(test_base.NodeTest):
+    def setUp(self):
+        super(TestNodeCacheWithMemoryDriver, self).setUp()
+        CONF.set_override('node_cache_driver', 'memory', 'discoverd')
+        node_cache.init()
+
+    def test_node_life_cycle(self):
+        node_info = node_cache.add_node(self.uuid, bmc_address='1.2.3.4',
+                                        mac=self.macs, foo=None)
+        node_info.set_option('foo', {'bar': 42})
+        self.assertEqual(set(self.macs), node_cache.active_macs())
+
+        found = node_cache.find_node(mac=[self.macs[0]])
+        self.assertEqual(self.uuid, found.uuid)
+        self.assertEqual({'foo': {'bar': 42}}, found.options)
+
+        found.finished(error='boom')
+        self.assertRaises(utils.Error, node_cache.find_node,
+                          bmc_address='1.2.3.4')
+        status = node_cache.get_node(self.uuid)
+        self.assertEqual('boom', status.error)
+        # Nothing went to the SQLite database
+        self.assertEqual([], self.db.execute(
+            'select * from nodes').fetchall())
@@ -0,0 +1,198 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+from ironicclient import exceptions
+import mock
+from oslo_config import cfg
+
+from ironic_discoverd import port_cache
+from ironic_discoverd.test import base as test_base
+from ironic_discoverd import utils
+
+
+CONF = cfg.CONF
+
+
+def _port(uuid, address):
+    return mock.Mock(uuid=uuid, address=address)
+
+
+@mock.patch.object(utils, 'get_client')
+class TestPortCache(test_base.BaseTest):
+    def setUp(self):
+        super(TestPortCache, self).setUp()
+        self.ports = [_port('uuid1', '11:22:33:44:55:66'),
+                      _port('uuid2', '66:55:44:33:22:11')]
+
+    def test_addresses(self, client_mock):
+        cli = client_mock.return_value
+        cli.port.list.return_value = self.ports
+
+        self.assertEqual({'11:22:33:44:55:66', '66:55:44:33:22:11'},
+                         port_cache.addresses())
+        self.assertEqual({'11:22:33:44:55:66', '66:55:44:33:22:11'},
+                         port_cache.addresses())
+
+        cli.port.list.assert_called_once_with(limit=0, sort_key='created_at',
+                                              sort_dir='asc')
+
+    def test_addresses_with_client(self, client_mock):
+        cli = mock.Mock()
+        cli.port.list.return_value = self.ports
+
+        self.assertEqual({'11:22:33:44:55:66', '66:55:44:33:22:11'},
+                         port_cache.addresses(cli))
+        self.assertFalse(client_mock.called)
+
+    def test_update_new_ports(self, client_mock):
+        cli = client_mock.return_value
+        cli.port.list.return_value = self.ports
+        port_cache.update()
+
+        cli.port.list.reset_mock()
+        cli.port.list.return_value = [_port('uuid3', 'AA:BB:CC:DD:EE:FF')]
+        port_cache.update()
+        cli.port.list.assert_called_once_with(limit=0, sort_key='created_at',
+                                              sort_dir='asc', marker='uuid2')
+
+        cli.port.list.reset_mock()
+        cli.port.list.return_value = []
+        port_cache.update()
+        cli.port.list.assert_called_once_with(limit=0, sort_key='created_at',
+                                              sort_dir='asc', marker='uuid3')
+
+        self.assertEqual({'11:22:33:44:55:66', '66:55:44:33:22:11',
+                          'AA:BB:CC:DD:EE:FF'}, port_cache.addresses())
+
+    def test_update_no_marker(self, client_mock):
+        cli = client_mock.return_value
+        cli.port.list.return_value = []
+        port_cache.update()
+        cli.port.list.return_value = self.ports
+        port_cache.update()
+
+        self.assertEqual(2, cli.port.list.call_count)
+        cli.port.list.assert_called_with(limit=0, sort_key='created_at',
+                                         sort_dir='asc')
+        self.assertEqual({'11:22:33:44:55:66', '66:55:44:33:22:11'},
+                         port_cache.addresses())
+
+    def test_update_marker_deleted(self, client_mock):
+        cli = client_mock.return_value
+        cli.port.list.return_value = self.ports
+        port_cache.update()
+
+        cli.port.list.side_effect = [exceptions.BadRequest(),
+                                     self.ports[:1]]
+        port_cache.update()
+
+        self.assertEqual({'11:22:33:44:55:66'}, port_cache.addresses())
+
+    def test_resync(self, client_mock):
+        CONF.set_override('port_cache_resync_period', 10, 'discoverd')
+        cli = client_mock.return_value
+        cli.port.list.return_value = self.ports
+        port_cache.update()
+        port_cache._LAST_RESYNC = time.time() - 11
+
+        cli.port.list.return_value = self.ports[1:]
+        port_cache.update()
+
+        cli.port.list.assert_called_with(limit=0, sort_key='created_at',
+                                         sort_dir='asc')
+        self.assertEqual({'66:55:44:33:22:11'}, port_cache.addresses())
+
+    def test_resync_changed_address(self, client_mock):
+        cli = client_mock.return_value
+        cli.port.list.return_value = self.ports
+        port_cache.update()
+
+        # No new ports after the marker
+        cli.port.list.return_value = []
+        port_cache.update()
+        self.assertEqual({'11:22:33:44:55:66', '66:55:44:33:22:11'},
+                         port_cache.addresses())
+
+        port_cache._LAST_RESYNC = (
+            time.time() - CONF.discoverd.port_cache_resync_period)
+        cli.port.list.return_value = [self.ports[0],
+                                      _port('uuid2', 'AA:BB:CC:DD:EE:FF')]
+        port_cache.update()
+        self.assertEqual({'11:22:33:44:55:66', 'AA:BB:CC:DD:EE:FF'},
+                         port_cache.addresses())
+
+    def test_add_remove(self, client_mock):
+        port_cache.add(self.ports)
+        port_cache.remove('uuid1')
+
+        cli = client_mock.return_value
+        cli.port.list.return_value = self.ports
+        self.assertEqual({'11:22:33:44:55:66', '66:55:44:33:22:11'},
+                         port_cache.addresses())
+
+        port_cache.add([_port('uuid3', 'AA:BB:CC:DD:EE:FF')])
+        port_cache.remove('uuid1')
+        self.assertEqual({'66:55:44:33:22:11', 'AA:BB:CC:DD:EE:FF'},
+                         port_cache.addresses())
+        cli.port.list.assert_called_once_with(limit=0, sort_key='created_at',
+                                              sort_dir='asc')
+
+    def test_resync_keeps_old_ports(self, client_mock):
+        CONF.set_override('port_cache_resync_period', 10, 'discoverd')
+        cli = client_mock.return_value
+        cli.port.list.return_value = self.ports
+        port_cache.update()
+        port_cache._LAST_RESYNC = time.time() - 11
+        seen = []
+
+        def _list(**kwargs):
+            seen.append(port_cache.addresses())
+            return self.ports[1:]
+
+        cli.port.list.side_effect = _list
+        port_cache.update()
+
+        self.assertEqual([{'11:22:33:44:55:66', '66:55:44:33:22:11'}], seen)
+        self.assertEqual(2, cli.port.list.call_count)
+        self.assertEqual({'66:55:44:33:22:11'}, port_cache.addresses())
+
+    def test_add_remove_during_fetch(self, client_mock):
+        def _list(**kwargs):
+            port_cache.add([_port('uuid3', 'AA:BB:CC:DD:EE:FF')])
+            port_cache.remove('uuid1')
+            return self.ports
+
+        cli = client_mock.return_value
+        cli.port.list.side_effect = _list
+        port_cache.update()
+
+        self.assertEqual({'66:55:44:33:22:11', 'AA:BB:CC:DD:EE:FF'},
+                         port_cache.addresses())
+        self.assertIsNone(port_cache._PENDING)
+
+    def test_add_remove_during_update(self, client_mock):
+        cli = client_mock.return_value
+        cli.port.list.return_value = self.ports
+        port_cache.update()
+
+        def _list(**kwargs):
+            port_cache.remove('uuid3')
+            return [_port('uuid3', 'AA:BB:CC:DD:EE:FF')]
+
+        cli.port.list.side_effect = _list
+        port_cache.update()
+
+        self.assertEqual({'11:22:33:44:55:66', '66:55:44:33:22:11'},
+                         port_cache.addresses())
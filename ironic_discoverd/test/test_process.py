@@ -72,11 +72,12 @@ class TestProcess(BaseTest):
             pop_mock.return_value = node_cache.NodeInfo(
                 uuid=self.node.uuid,
                 started_at=self.started_at)
-            pop_mock.return_value.finished = mock.Mock()
             cli.node.get.return_value = self.node
             process_mock.return_value = self.fake_result_json
 
-            return func(self, cli, pop_mock, process_mock, *args, **kw)
+            # NodeInfo has __slots__, so patch the class
+            with mock.patch.object(node_cache.NodeInfo, 'finished'):
+                return func(self, cli, pop_mock, process_mock, *args, **kw)
 
         return wrapper
 
@@ -322,11 +323,108 @@ class TestProcess(BaseTest):
         self.assertFalse(pop_mock.return_value.finished.called)
 
 
+@mock.patch.object(process, '_process_node', autospec=True)
+@mock.patch.object(node_cache, 'find_node', autospec=True)
+@mock.patch.object(utils, 'get_client', autospec=True)
+class TestProcessAsync(BaseTest):
+    def setUp(self):
+        super(TestProcessAsync, self).setUp()
+        self.cached_node = node_cache.NodeInfo(uuid=self.uuid,
+                                               started_at=self.started_at)
+
+    def test_ok(self, client_mock, pop_mock, process_mock):
+        cli = client_mock.return_value
+        cli.node.get.return_value = self.node
+        pop_mock.return_value = self.cached_node
+
+        res = process.process_async(self.data)
+
+        self.assertEqual({}, res)
+        self.assertFalse(process_mock.called)
+        process._QUEUE.join()
+        process_mock.assert_called_once_with(cli, self.node, self.data,
+                                             self.cached_node)
+
+    def test_set_ipmi_credentials(self, client_mock, pop_mock, process_mock):
+        client_mock.return_value.node.get.return_value = self.node
+        pop_mock.return_value = node_cache.NodeInfo(
+            uuid=self.uuid, started_at=self.started_at,
+            options={'new_ipmi_credentials': ('user', 'password')})
+
+        res = process.process_async(self.data)
+
+        self.assertEqual({'ipmi_setup_credentials': True,
+                          'ipmi_username': 'user',
+                          'ipmi_password': 'password'}, res)
+        process._QUEUE.join()
+        self.assertTrue(process_mock.called)
+
+    def test_not_found_in_cache(self, client_mock, pop_mock, process_mock):
+        pop_mock.side_effect = utils.Error('not found')
+
+        self.assertRaisesRegexp(utils.Error, 'not found',
+                                process.process_async, self.data)
+
+        self.assertIsNone(process._QUEUE)
+        self.assertFalse(process_mock.called)
+
+    def test_does_not_wait_for_worker(self, client_mock, pop_mock,
+                                      process_mock):
+        CONF.set_override('processing_workers', 1, 'discoverd')
+        client_mock.return_value.node.get.return_value = self.node
+        pop_mock.return_value = self.cached_node
+        stuck = eventlet.event.Event()
+        process_mock.side_effect = lambda *args: stuck.wait()
+
+        process.process_async(self.data)
+        # Let the only worker pick up the first request and get stuck
+        eventlet.greenthread.sleep(0)
+        self.assertEqual(1, process_mock.call_count)
+
+        with eventlet.Timeout(1):
+            self.assertEqual({}, process.process_async(self.data))
+        self.assertEqual(1, process_mock.call_count)
+
+        stuck.send()
+        process._QUEUE.join()
+        self.assertEqual(2, process_mock.call_count)
+
+    def test_unexpected_failure(self, client_mock, pop_mock, process_mock):
+        CONF.set_override('processing_workers', 1, 'discoverd')
+        client_mock.return_value.node.get.return_value = self.node
+        pop_mock.return_value = self.cached_node
+
+        with mock.patch.object(process, '_background_process',
+                               autospec=True) as background_mock:
+            background_mock.side_effect = [RuntimeError('boom'), None]
+            process.process_async(self.data)
+            process.process_async(self.data)
+            process._QUEUE.join()
+
+        # The worker survives unexpected exceptions
+        self.assertEqual(2, background_mock.call_count)
+
+    @mock.patch.object(node_cache.NodeInfo, 'finished', autospec=True)
+    def test_failure(self, finished_mock, client_mock, pop_mock,
+                     process_mock):
+        client_mock.return_value.node.get.return_value = self.node
+        pop_mock.return_value = self.cached_node
+        process_mock.side_effect = utils.Error('boom')
+
+        self.assertEqual({}, process.process_async(self.data))
+
+        process._QUEUE.join()
+        finished_mock.assert_called_once_with(self.cached_node, error='boom')
+
+
+_SLEEP = eventlet.greenthread.sleep
+
+
 @mock.patch.object(eventlet.greenthread, 'spawn_n',
                    lambda f, *a: f(*a) and None)
 @mock.patch.object(eventlet.greenthread, 'sleep', lambda _: None)
 @mock.patch.object(example_plugin.ExampleProcessingHook, 'before_update')
-@mock.patch.object(firewall, 'update_filters', autospec=True)
+@mock.patch.object(firewall, 'request_update', autospec=True)
 class TestProcessNode(BaseTest):
     def setUp(self):
         super(TestProcessNode, self).setUp()
@@ -392,6 +490,7 @@ class TestProcessNode(BaseTest):
         self.assertEqual(self.ports, sorted(post_hook_mock.call_args[0][1],
                                             key=lambda p: p.address))
         finished_mock.assert_called_once_with(mock.ANY)
+        filters_mock.assert_called_once_with(self.cli)
 
     def test_overwrite_disabled(self, filters_mock, post_hook_mock):
         CONF.set_override('overwrite_existing', False, 'discoverd')
@@ -449,9 +548,46 @@ class TestProcessNode(BaseTest):
         post_hook_mock.assert_called_once_with(self.node, self.ports[1:],
                                                self.data)
 
+    def test_ports_created_concurrently(self, filters_mock, post_hook_mock):
+        CONF.set_override('port_update_concurrency', 2, 'discoverd')
+        self.data['macs'] = self.macs + ['aa:bb:cc:dd:ee:ff']
+        running = []
+        max_running = []
+
+        def _create(node_uuid, address):
+            running.append(address)
+            max_running.append(len(running))
+            eventlet.greenthread.sleep(0.01)
+            running.remove(address)
+            if address == self.macs[0]:
+                raise exceptions.Conflict()
+            return mock.Mock(address=address)
+
+        self.cli.port.create.side_effect = _create
+        # The real sleep is required for green threads to switch
+        with mock.patch.object(eventlet.greenthread, 'sleep', _SLEEP):
+            self.call()
+
+        self.assertEqual(3, self.cli.port.create.call_count)
+        self.assertEqual(2, max(max_running))
+        ports = post_hook_mock.call_args[0][1]
+        self.assertEqual([self.macs[1], 'aa:bb:cc:dd:ee:ff'],
+                         sorted(port.address for port in ports))
+
+    def test_port_update_failed(self, filters_mock, post_hook_mock):
+        patch = [{'op': 'add', 'path': '/extra/foo', 'value': 'bar'}]
+        post_hook_mock.return_value = ([], {self.macs[0]: patch,
+                                            self.macs[1]: patch})
+        self.cli.port.update.side_effect = [RuntimeError('boom'), None]
+
+        self.assertRaisesRegexp(RuntimeError, 'boom', self.call)
+
+        self.assertEqual(2, self.cli.port.update.call_count)
+
     def test_hook_patches(self, filters_mock, post_hook_mock):
-        node_patches = ['node patch1', 'node patch2']
-        port_patch = ['port patch']
+        node_patches = [{'op': 'add', 'path': '/extra/foo', 'value': 'bar'},
+                        {'op': 'add', 'path': '/extra/answer', 'value': 42}]
+        port_patch = [{'op': 'add', 'path': '/extra/foo', 'value': 'bar'}]
         post_hook_mock.return_value = (node_patches,
                                        {self.macs[1]: port_patch})
 
@@ -463,12 +599,39 @@ class TestProcessNode(BaseTest):
         self.cli.port.update.assert_called_once_with(self.ports[1].uuid,
                                                      port_patch)
 
+    def test_hook_patches_merged(self, filters_mock, post_hook_mock):
+        node_patches = [{'op': 'replace', 'path': '/properties/cpus',
+                         'value': '4'},
+                        {'op': 'remove', 'path': '/extra/foo'}]
+        post_hook_mock.return_value = (node_patches, {})
+
+        self.call()
+
+        self.cli.node.update.assert_any_call(
+            self.uuid,
+            self.patch_before[1:] +
+            [{'op': 'add', 'path': '/properties/cpus', 'value': '4'},
+             {'op': 'remove', 'path': '/extra/foo'}])
+        self.assertEqual(2, self.cli.node.update.call_count)
+
+    def test_no_patches(self, filters_mock, post_hook_mock):
+        CONF.set_override('processing_hooks', 'validate_interfaces',
+                          'discoverd')
+
+        self.call()
+
+        self.cli.node.update.assert_called_once_with(self.uuid,
+                                                     self.patch_after)
+
     def test_set_ipmi_credentials(self, filters_mock, post_hook_mock):
         self.cached_node.set_option('new_ipmi_credentials', self.new_creds)
 
         self.call()
 
-        self.cli.node.update.assert_any_call(self.uuid, self.patch_credentials)
+        self.cli.node.update.assert_any_call(
+            self.uuid, self.patch_before + self.patch_credentials)
+        self.cli.node.update.assert_any_call(self.uuid, self.patch_after)
+        self.assertEqual(2, self.cli.node.update.call_count)
         self.cli.node.set_power_state.assert_called_once_with(self.uuid, 'off')
         self.cli.node.get_boot_device.assert_called_with(self.uuid)
         self.assertEqual(self.validate_attempts + 1,
@@ -484,7 +647,10 @@ class TestProcessNode(BaseTest):
 
         self.call()
 
-        self.cli.node.update.assert_any_call(self.uuid, self.patch_credentials)
+        self.cli.node.update.assert_any_call(
+            self.uuid, self.patch_before + self.patch_credentials)
+        self.cli.node.update.assert_any_call(self.uuid, self.patch_after)
+        self.assertEqual(2, self.cli.node.update.call_count)
         self.cli.node.set_power_state.assert_called_once_with(self.uuid, 'off')
         self.cli.node.get_boot_device.assert_called_with(self.uuid)
         self.assertEqual(self.validate_attempts + 1,
@@ -499,9 +665,8 @@ class TestProcessNode(BaseTest):
         self.assertRaisesRegexp(utils.Error, 'Failed to validate',
                                 self.call)
 
-        self.cli.node.update.assert_any_call(self.uuid, self.patch_before)
-        self.cli.node.update.assert_any_call(self.uuid, self.patch_credentials)
-        self.assertEqual(2, self.cli.node.update.call_count)
+        self.cli.node.update.assert_called_once_with(
+            self.uuid, self.patch_before + self.patch_credentials)
         self.assertEqual(process._CREDENTIALS_WAIT_RETRIES,
                          self.cli.node.get_boot_device.call_count)
         self.assertFalse(self.cli.node.set_power_state.called)
@@ -11,14 +11,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import random
+import socket
+import time
 import unittest
 
 import eventlet
+from ironicclient import client
 from ironicclient import exceptions
+from keystoneclient.auth.identity import v2
+from keystoneclient import session
 from keystonemiddleware import auth_token
 import mock
 from oslo_config import cfg
 
+from ironic_discoverd import http_pool
+from ironic_discoverd import metrics
 from ironic_discoverd.test import base
 from ironic_discoverd import utils
 
@@ -67,6 +75,100 @@ class TestCheckAuth(base.BaseTest):
         utils.check_auth(request)
 
 
+@mock.patch.object(client, 'Client', autospec=True)
+@mock.patch.object(session, 'Session')
+@mock.patch.object(v2, 'Password', autospec=True)
+class TestGetClient(base.BaseTest):
+    def setUp(self):
+        super(TestGetClient, self).setUp()
+        CONF.set_override('os_auth_url', 'http://127.0.0.1:5000/v2.0',
+                          'discoverd')
+
+    def _prepare(self, session_mock):
+        sess = session_mock.return_value
+        sess.get_token.return_value = 'token1'
+        sess.get_endpoint.return_value = 'http://127.0.0.1:6385'
+        sess.auth.auth_ref.will_expire_soon.return_value = False
+        return sess
+
+    def test_cached(self, auth_mock, session_mock, client_mock):
+        sess = self._prepare(session_mock)
+
+        cli = utils.get_client()
+        self.assertIs(cli, utils.get_client())
+
+        self.assertIs(client_mock.return_value, cli)
+        auth_mock.assert_called_once_with(
+            auth_url='http://127.0.0.1:5000/v2.0', username='',
+            password='', tenant_name='')
+        session_mock.assert_called_once_with(
+            auth=auth_mock.return_value, session=http_pool.get_session())
+        client_mock.assert_called_once_with(
+            1, 'http://127.0.0.1:6385', session=sess)
+        self.assertFalse(sess.auth.invalidate.called)
+
+    def test_token_expires(self, auth_mock, session_mock, client_mock):
+        sess = self._prepare(session_mock)
+        utils.get_client()
+
+        sess.auth.auth_ref.will_expire_soon.return_value = True
+        sess.get_token.return_value = 'token2'
+        utils.get_client()
+
+        sess.auth.auth_ref.will_expire_soon.assert_called_with(
+            utils.TOKEN_EXPIRY_MARGIN)
+        sess.auth.invalidate.assert_called_once_with()
+        self.assertEqual(1, session_mock.call_count)
+        client_mock.assert_called_with(
+            1, 'http://127.0.0.1:6385', session=sess)
+        self.assertEqual(2, client_mock.call_count)
+
+    def test_cached_does_not_wait(self, auth_mock, session_mock,
+                                  client_mock):
+        sess = self._prepare(session_mock)
+        cli = utils.get_client()
+
+        # Another green thread is talking to Keystone
+        with utils._CLIENT_LOCK:
+            self.assertIs(cli, utils.get_client())
+            sess.auth.auth_ref.will_expire_soon.return_value = True
+            self.assertIs(cli, utils.get_client())
+
+        self.assertEqual(1, sess.get_token.call_count)
+        self.assertFalse(sess.auth.invalidate.called)
+        self.assertEqual(1, client_mock.call_count)
+
+    def test_concurrent_refresh(self, auth_mock, session_mock, client_mock):
+        sess = self._prepare(session_mock)
+        old_cli = utils.get_client()
+        sess.auth.auth_ref.will_expire_soon.return_value = True
+        results = []
+
+        def _get_token():
+            # Slow Keystone, other callers get the cached client meanwhile
+            results.append(utils.get_client())
+            sess.auth.auth_ref.will_expire_soon.return_value = False
+            return 'token2'
+
+        sess.get_token.side_effect = _get_token
+        client_mock.return_value = mock.sentinel.new_client
+
+        self.assertIs(mock.sentinel.new_client, utils.get_client())
+        self.assertEqual([old_cli], results)
+        self.assertIs(mock.sentinel.new_client, utils.get_client())
+        sess.auth.invalidate.assert_called_once_with()
+        self.assertEqual(2, client_mock.call_count)
+
+    def test_reset(self, auth_mock, session_mock, client_mock):
+        self._prepare(session_mock)
+        utils.get_client()
+        utils.reset_client()
+        utils.get_client()
+
+        self.assertEqual(2, session_mock.call_count)
+        self.assertEqual(2, client_mock.call_count)
+
+
 @mock.patch('ironic_discoverd.node_cache.NodeInfo')
 class TestGetIpmiAddress(base.BaseTest):
     def test_ipv4_in_resolves(self, mock_node):
@@ -90,25 +192,236 @@ class TestGetIpmiAddress(base.BaseTest):
         self.assertRaises(utils.Error, utils.get_ipmi_address, node)
 
 
-@mock.patch.object(eventlet.greenthread, 'sleep', lambda _: None)
-class TestRetryOnConflict(unittest.TestCase):
-    def test_retry_on_conflict(self):
+@mock.patch.object(socket, 'gethostbyname', autospec=True)
+class TestResolve(base.BaseTest):
+    def test_cached(self, resolve_mock):
+        resolve_mock.return_value = '1.2.3.4'
+
+        self.assertEqual('1.2.3.4', utils.resolve('bmc.example.com'))
+        self.assertEqual('1.2.3.4', utils.resolve('bmc.example.com'))
+
+        resolve_mock.assert_called_once_with('bmc.example.com')
+
+    def test_expired(self, resolve_mock):
+        CONF.set_override('dns_cache_ttl', 10, 'discoverd')
+        resolve_mock.side_effect = ['1.2.3.4', '1.2.3.5']
+
+        with mock.patch.object(time, 'time', return_value=1000.0):
+            self.assertEqual('1.2.3.4', utils.resolve('bmc.example.com'))
+        with mock.patch.object(time, 'time', return_value=1009.0):
+            self.assertEqual('1.2.3.4', utils.resolve('bmc.example.com'))
+        with mock.patch.object(time, 'time', return_value=1010.0):
+            self.assertEqual('1.2.3.5', utils.resolve('bmc.example.com'))
+
+        self.assertEqual(2, resolve_mock.call_count)
+
+    def test_negative(self, resolve_mock):
+        CONF.set_override('dns_negative_cache_ttl', 10, 'discoverd')
+        resolve_mock.side_effect = [socket.gaierror(), '1.2.3.4']
+
+        with mock.patch.object(time, 'time', return_value=1000.0):
+            self.assertIsNone(utils.resolve('bmc.example.com'))
+            self.assertIsNone(utils.resolve('bmc.example.com'))
+        with mock.patch.object(time, 'time', return_value=1010.0):
+            self.assertEqual('1.2.3.4', utils.resolve('bmc.example.com'))
+
+        self.assertEqual(2, resolve_mock.call_count)
+
+    def test_disabled(self, resolve_mock):
+        CONF.set_override('dns_cache_ttl', 0, 'discoverd')
+        resolve_mock.return_value = '1.2.3.4'
+
+        utils.resolve('bmc.example.com')
+        utils.resolve('bmc.example.com')
+
+        self.assertEqual(2, resolve_mock.call_count)
+
+    def test_resolve_ipmi_addresses(self, resolve_mock):
+        resolve_mock.side_effect = lambda host: {'bmc1': '1.2.3.4',
+                                                 'bmc2': '1.2.3.5'}[host]
+        nodes = [mock.Mock(driver_info={'ipmi_address': 'bmc1'}),
+                 mock.Mock(driver_info={'ilo_address': 'bmc2'}),
+                 mock.Mock(driver_info={'drac_host': 'bmc1'}),
+                 mock.Mock(driver_info={})]
+
+        utils.resolve_ipmi_addresses(nodes)
+
+        self.assertEqual(2, resolve_mock.call_count)
+        self.assertEqual(['1.2.3.4', '1.2.3.5', '1.2.3.4', None],
+                         [utils.get_ipmi_address(node) for node in nodes])
+        self.assertEqual(2, resolve_mock.call_count)
+
+
+@mock.patch.object(random, 'uniform', autospec=True,
+                   side_effect=lambda low, high: high)
+@mock.patch.object(eventlet.greenthread, 'sleep', autospec=True)
+class TestRetryOnConflict(base.BaseTest):
+    def test_retry_on_conflict(self, sleep_mock, uniform_mock):
         call = mock.Mock()
-        call.side_effect = ([exceptions.Conflict()] * (utils.RETRY_COUNT - 1)
+        call.side_effect = ([exceptions.Conflict()] * 4
                             + [mock.sentinel.result])
         res = utils.retry_on_conflict(call, 1, 2, x=3)
         self.assertEqual(mock.sentinel.result, res)
         call.assert_called_with(1, 2, x=3)
-        self.assertEqual(utils.RETRY_COUNT, call.call_count)
+        self.assertEqual(5, call.call_count)
+        self.assertEqual([mock.call(0.5), mock.call(1.0), mock.call(2.0),
+                          mock.call(4.0)], sleep_mock.call_args_list)
+        uniform_mock.assert_called_with(0, 4.0)
 
-    def test_retry_on_conflict_fail(self):
+    def test_retry_on_conflict_fail(self, sleep_mock, uniform_mock):
+        CONF.set_override('conflict_retry_timeout', 1000, 'discoverd')
         call = mock.Mock()
-        call.side_effect = ([exceptions.Conflict()] * (utils.RETRY_COUNT + 1)
+        call.side_effect = ([exceptions.Conflict()] * 13
                             + [mock.sentinel.result])
         self.assertRaises(exceptions.Conflict, utils.retry_on_conflict,
                           call, 1, 2, x=3)
         call.assert_called_with(1, 2, x=3)
-        self.assertEqual(utils.RETRY_COUNT, call.call_count)
+        self.assertEqual(12, call.call_count)
+        self.assertEqual(11, sleep_mock.call_count)
+        # Delay is limited by conflict_retry_max_delay
+        sleep_mock.assert_called_with(10.0)
+
+    def test_no_attempts(self, sleep_mock, uniform_mock):
+        for attempts in (0, -1):
+            CONF.set_override('conflict_retry_attempts', attempts,
+                              'discoverd')
+            call = mock.Mock(return_value=mock.sentinel.result)
+            self.assertEqual(mock.sentinel.result,
+                             utils.retry_on_conflict(call))
+            call.side_effect = exceptions.Conflict()
+            self.assertRaises(exceptions.Conflict, utils.retry_on_conflict,
+                              call)
+            self.assertEqual(2, call.call_count)
+        self.assertFalse(sleep_mock.called)
+
+    def test_deadline(self, sleep_mock, uniform_mock):
+        CONF.set_override('conflict_retry_timeout', 3, 'discoverd')
+        now = [1000.0]
+        sleep_mock.side_effect = lambda delay: now.__setitem__(
+            0, now[0] + delay)
+        call = mock.Mock(side_effect=exceptions.Conflict())
+
+        with mock.patch.object(time, 'time', lambda: now[0]):
+            self.assertRaises(exceptions.Conflict, utils.retry_on_conflict,
+                              call)
+
+        # 0.5 + 1 + 2 > 3
+        self.assertEqual(3, call.call_count)
+        self.assertEqual(2, sleep_mock.call_count)
+
+    def test_metrics(self, sleep_mock, uniform_mock):
+        CONF.set_override('conflict_retry_attempts', 2, 'discoverd')
+
+        class NodeManager(object):
+            def update(self):
+                raise exceptions.Conflict()
+
+        self.assertRaises(exceptions.Conflict, utils.retry_on_conflict,
+                          NodeManager().update)
+
+        self.assertEqual({'conflicts.node.update': 2,
+                          'conflicts.node.update.failed': 1},
+                         metrics.snapshot()['counters'])
+
+
+def _add(path, value):
+    return {'op': 'add', 'path': path, 'value': value}
+
+
+def _remove(path):
+    return {'op': 'remove', 'path': path}
+
+
+class TestPatchAccumulator(unittest.TestCase):
+    def test_no_duplicates(self):
+        patches = utils.PatchAccumulator([_add('/extra/foo', 1),
+                                          _add('/extra/bar', 2)])
+        patches.add([_add('/extra/foo', 1)])
+        self.assertEqual([_add('/extra/bar', 2), _add('/extra/foo', 1)],
+                         patches.patches())
+        self.assertEqual(2, len(patches))
+
+    def test_last_wins(self):
+        patches = utils.PatchAccumulator([
+            _add('/extra/foo', 1),
+            {'op': 'replace', 'path': '/extra/foo', 'value': 2},
+            _remove('/extra/bar'),
+            _add('/extra/bar', 3)])
+        self.assertEqual([_add('/extra/foo', 2), _add('/extra/bar', 3)],
+                         patches.patches())
+
+    def test_add_remove(self):
+        patches = utils.PatchAccumulator([_add('/extra/foo', 1),
+                                          _remove('/extra/foo'),
+                                          _remove('/extra/foo'),
+                                          _remove('/extra/bar')])
+        self.assertEqual([_add('/extra/foo', 1), _remove('/extra/foo'),
+                          _remove('/extra/bar')],
+                         patches.patches())
+
+    def test_parent_overrides_children(self):
+        patches = utils.PatchAccumulator([_add('/extra/foo', 1),
+                                          _add('/extras', 1),
+                                          _add('/extra', {}),
+                                          _add('/extra/bar', 2)])
+        self.assertEqual([_add('/extras', 1), _add('/extra', {}),
+                          _add('/extra/bar', 2)],
+                         patches.patches())
+
+    def test_replace_kept(self):
+        replace = {'op': 'replace', 'path': '/extra/foo', 'value': 2}
+        patches = utils.PatchAccumulator([
+            {'op': 'replace', 'path': '/extra/foo', 'value': 1},
+            replace])
+        self.assertEqual([replace], patches.patches())
+
+    def test_remove_after_replace(self):
+        patches = utils.PatchAccumulator([
+            {'op': 'replace', 'path': '/extra/foo', 'value': 1},
+            _remove('/extra/foo')])
+        self.assertEqual([_remove('/extra/foo')], patches.patches())
+
+    def test_array_paths_untouched(self):
+        replace = {'op': 'replace', 'path': '/extra/l/0', 'value': 1}
+        ops = [replace,
+               _remove('/extra/l/0'),
+               _remove('/extra/l/0'),
+               _add('/extra/l/-', 2),
+               _add('/extra/l/-', 2)]
+        patches = utils.PatchAccumulator(ops)
+        self.assertEqual(ops, patches.patches())
+
+    def test_parent_overrides_array_children(self):
+        patches = utils.PatchAccumulator([_add('/extra/l/-', 1),
+                                          _remove('/extra/l/0'),
+                                          _add('/extra/l', [])])
+        self.assertEqual([_add('/extra/l', [])], patches.patches())
+
+    def test_other_operations(self):
+        test = {'op': 'test', 'path': '/extra/foo', 'value': 1}
+        patches = utils.PatchAccumulator([test, _add('/extra/foo', 2), test])
+        self.assertEqual([test, _add('/extra/foo', 2), test],
+                         patches.patches())
+
+    def test_other_operations_are_barriers(self):
+        test = {'op': 'test', 'path': '/extra/foo', 'value': 1}
+        patches = utils.PatchAccumulator([_add('/extra/foo', 1),
+                                          test,
+                                          _add('/extra/foo', 2)])
+        self.assertEqual([_add('/extra/foo', 1), test, _add('/extra/foo', 2)],
+                         patches.patches())
+
+    @mock.patch.object(eventlet.greenthread, 'sleep', autospec=True)
+    def test_flush(self, sleep_mock):
+        call = mock.Mock(side_effect=[exceptions.Conflict(), 'node'])
+        patches = utils.PatchAccumulator([_add('/extra/foo', 1)])
+
+        self.assertEqual('node', patches.flush(call, 'uuid'))
+        self.assertIsNone(patches.flush(call, 'uuid'))
+
+        call.assert_called_with('uuid', [_add('/extra/foo', 1)])
+        self.assertEqual(2, call.call_count)
+        self.assertEqual([], patches.patches())
 
 
 class TestCapabilities(unittest.TestCase):
@@ -11,18 +11,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import logging
+import random
 import re
 import socket
+import time
 
 import eventlet
+from eventlet import semaphore
 from ironicclient import client
 from ironicclient import exceptions
+from keystoneclient.auth.identity import v2
+from keystoneclient import session
 from keystonemiddleware import auth_token
 from oslo_config import cfg
 import six
 
 from ironic_discoverd.common.i18n import _, _LE, _LI, _LW
+from ironic_discoverd import http_pool
+from ironic_discoverd import metrics
 
 CONF = cfg.CONF
 
@@ -31,8 +39,19 @@ VALID_STATES = {'enroll', 'manageable', 'inspecting', 'inspectfail'}
 
 
 LOG = logging.getLogger('ironic_discoverd.utils')
-RETRY_COUNT = 12
-RETRY_DELAY = 5
+# Re-authenticate if the token expires in less than this number of seconds
+TOKEN_EXPIRY_MARGIN = 60
+
+# Keystone session and Ironic client shared by all green threads
+_SESSION = None
+_CLIENT = None
+_CLIENT_TOKEN = None
+_CLIENT_LOCK = semaphore.BoundedSemaphore()
+
+# Host name -> (expiration time, IP address or None)
+_DNS_CACHE = {}
+# Maximum number of host names resolved at the same time
+_RESOLVE_CONCURRENCY = 10
 
 
 class Error(Exception):
@@ -44,13 +63,65 @@ class Error(Exception):
         self.http_code = code
 
 
-def get_client():  # pragma: no cover
-    """Get Ironic client instance."""
-    args = dict({'os_password': CONF.discoverd.os_password,
-                 'os_username': CONF.discoverd.os_username,
-                 'os_auth_url': CONF.discoverd.os_auth_url,
-                 'os_tenant_name': CONF.discoverd.os_tenant_name})
-    return client.get_client(1, **args)
+def get_client():
+    """Get Ironic client instance.
+
+    The client is cached and shared between all callers. Keystone is only
+    contacted when the cached token is about to expire, in which case a new
+    client with the new token is created by one green thread, while others
+    keep using the cached client. All requests use connections from
+    ``http_pool``, which requires python-ironicclient honouring the
+    ``session`` argument.
+    """
+    cached = _CLIENT
+    if cached is not None and not _token_expires_soon():
+        return cached
+
+    # Only wait for another green thread talking to Keystone
+    # if there is no client at all, the cached token is still valid for at
+    # least TOKEN_EXPIRY_MARGIN seconds
+    if not _CLIENT_LOCK.acquire(blocking=cached is None):
+        return cached
+    try:
+        return _refresh_client()
+    finally:
+        _CLIENT_LOCK.release()
+
+
+def _token_expires_soon():
+    auth_ref = _SESSION.auth.auth_ref
+    return auth_ref is None or auth_ref.will_expire_soon(TOKEN_EXPIRY_MARGIN)
+
+
+def _refresh_client():
+    global _SESSION, _CLIENT, _CLIENT_TOKEN
+    if _SESSION is None:
+        auth = v2.Password(auth_url=CONF.discoverd.os_auth_url,
+                           username=CONF.discoverd.os_username,
+                           password=CONF.discoverd.os_password,
+                           tenant_name=CONF.discoverd.os_tenant_name)
+        _SESSION = session.Session(auth=auth,
+                                   session=http_pool.get_session())
+    elif (_SESSION.auth.auth_ref is not None and
+          _SESSION.auth.auth_ref.will_expire_soon(TOKEN_EXPIRY_MARGIN)):
+        LOG.debug('Keystone token is about to expire, re-authenticating')
+        _SESSION.auth.invalidate()
+
+    token = _SESSION.get_token()
+    if _CLIENT is None or token != _CLIENT_TOKEN:
+        endpoint = _SESSION.get_endpoint(service_type='baremetal',
+                                         interface='public')
+        # client.get_client drops the session in python-ironicclient
+        # before 1.2.0, the session also provides the token
+        _CLIENT = client.Client(1, endpoint, session=_SESSION)
+        _CLIENT_TOKEN = token
+    return _CLIENT
+
+
+def reset_client():
+    """Drop the cached Keystone session and Ironic client."""
+    global _SESSION, _CLIENT, _CLIENT_TOKEN
+    _SESSION = _CLIENT = _CLIENT_TOKEN = None
 
 
 def add_auth_middleware(app):
@@ -91,36 +162,222 @@ def is_valid_mac(address):
 
 
 def get_ipmi_address(node):
+    """Get IP address of the BMC of a node.
+
+    Host names are resolved using a cache, see ``resolve``.
+
+    :raises: Error if the host name cannot be resolved
+    """
+    value = _ipmi_host(node)
+    if value:
+        ip = resolve(value)
+        if ip is None:
+            msg = ('Failed to resolve the hostname (%s) for node %s')
+            raise Error(msg % (value, node.uuid))
+        return ip
+
+
+def resolve_ipmi_addresses(nodes):
+    """Resolve BMC host names of several nodes at once.
+
+    Every host name is resolved only once, concurrently with other host
+    names. Results are put into the cache for ``get_ipmi_address``.
+
+    :param nodes: list of Ironic nodes
+    """
+    hosts = {_ipmi_host(node) for node in nodes} - {None}
+    pool = eventlet.greenpool.GreenPool(_RESOLVE_CONCURRENCY)
+    list(pool.imap(resolve, hosts))
+
+
+def _ipmi_host(node):
     # All these are kind-of-ipmi
     for name in ('ipmi_address', 'ilo_address', 'drac_host'):
         value = node.driver_info.get(name)
         if value:
-            try:
-                ip = socket.gethostbyname(value)
-                return ip
-            except socket.gaierror:
-                msg = ('Failed to resolve the hostname (%s) for node %s')
-                raise Error(msg % (value, node.uuid))
+            return value
+
+
+def resolve(host):
+    """Resolve a host name to an IPv4 address using a cache.
+
+    Successful results are cached for ``dns_cache_ttl`` seconds, failures
+    for ``dns_negative_cache_ttl`` seconds.
+
+    :returns: IP address or None if the host name cannot be resolved
+    """
+    cached = _DNS_CACHE.get(host)
+    if cached is not None and cached[0] > time.time():
+        return cached[1]
+
+    try:
+        ip = socket.gethostbyname(host)
+    except socket.gaierror as exc:
+        LOG.debug('Failed to resolve %(host)s: %(exc)s',
+                  {'host': host, 'exc': exc})
+        ip = None
+        ttl = CONF.discoverd.dns_negative_cache_ttl
+    else:
+        ttl = CONF.discoverd.dns_cache_ttl
+
+    if ttl > 0:
+        _DNS_CACHE[host] = (time.time() + ttl, ip)
+    return ip
+
+
+def reset_dns_cache():
+    """Drop all cached host name resolution results."""
+    _DNS_CACHE.clear()
 
 
 def retry_on_conflict(call, *args, **kwargs):
-    """Wrapper to retry 409 CONFLICT exceptions."""
-    for i in range(RETRY_COUNT):
+    """Wrapper to retry 409 CONFLICT exceptions.
+
+    Retries use exponential backoff with full jitter, so that conflicting
+    green threads do not wake up at the same time. Gives up after
+    ``conflict_retry_attempts`` attempts or when the next attempt would
+    start after ``conflict_retry_timeout`` seconds. Conflicts are counted
+    per called method in ``conflicts.<name>`` metrics.
+    """
+    name = _call_name(call)
+    deadline = time.time() + CONF.discoverd.conflict_retry_timeout
+    # Always make at least one attempt
+    attempts = max(1, CONF.discoverd.conflict_retry_attempts)
+    for i in range(attempts):
         try:
             return call(*args, **kwargs)
         except exceptions.Conflict as exc:
+            metrics.increment('conflicts.%s' % name)
             LOG.warning(_LW('Conflict on calling %(call)s: %(exc)s,'
                             ' retry attempt %(count)d') %
-                        {'call': getattr(call, '__name__', repr(call)),
+                        {'call': name,
                          'exc': exc,
                          'count': i + 1})
-            if i == RETRY_COUNT - 1:
+            delay = random.uniform(
+                0, min(CONF.discoverd.conflict_retry_max_delay,
+                       CONF.discoverd.conflict_retry_initial_delay * 2 ** i))
+            if i == attempts - 1 or time.time() + delay > deadline:
+                metrics.increment('conflicts.%s.failed' % name)
                 raise
-            eventlet.greenthread.sleep(RETRY_DELAY)
+            eventlet.greenthread.sleep(delay)
 
     raise RuntimeError('unreachable code')  # pragma: no cover
 
 
+class PatchAccumulator(object):
+    """Accumulates JSON patches for one Ironic resource.
+
+    Operations on object members are merged per path, so that only the
+    operations required for the final state are sent:
+
+    * an operation overrides all previous operations on the same path and
+      its children;
+    * a replace of a path added before is sent as add, otherwise it is kept;
+    * a remove of a path that existed before the first operation on it is sent
+      as a single remove;
+    * a remove of a path added before is sent as add followed by remove: it
+      is not known whether the path existed before the add, so both a remove
+      alone and no operations at all could lead to a different result.
+
+    Operations on array elements (paths with a numeric or ``-`` component)
+    depend on their order, so they are passed through unchanged. Other
+    operations (e.g. test) are passed through as well, and operations are
+    never merged across them.
+    """
+
+    def __init__(self, patches=()):
+        # Operations which are not merged with the following ones
+        self._frozen = []
+        # path -> list of operations, in order of the last modification
+        self._ops = collections.OrderedDict()
+        self._count = 0
+        self.add(patches)
+
+    def add(self, patches):
+        """Merge a list of JSON patch operations."""
+        for patch in patches:
+            path = patch['path']
+            op = patch['op']
+            if op not in ('add', 'replace', 'remove'):
+                self._frozen.extend(patch for ops in self._ops.values()
+                                    for patch in ops)
+                self._frozen.append(patch)
+                self._ops.clear()
+                continue
+
+            self._drop(path)
+            if _is_array_path(path):
+                # Use a unique key to keep all of them
+                self._count += 1
+                self._ops[(self._count, path)] = [patch]
+                continue
+
+            previous = self._ops.pop(path, None)
+            if op == 'add':
+                ops = [{'op': 'add', 'path': path, 'value': patch['value']}]
+            elif op == 'replace':
+                existed = (previous is None or
+                           previous[0]['op'] in ('replace', 'remove'))
+                ops = [{'op': 'replace' if existed else 'add', 'path': path,
+                        'value': patch['value']}]
+            elif previous is None or previous[0]['op'] != 'add':
+                ops = [{'op': 'remove', 'path': path}]
+            else:
+                ops = [previous[0], {'op': 'remove', 'path': path}]
+            self._ops[path] = ops
+
+    def _drop(self, path):
+        """Drop operations on children of the path."""
+        prefix = path.rstrip('/') + '/'
+        for key in list(self._ops):
+            key_path = key[1] if isinstance(key, tuple) else key
+            if key_path.startswith(prefix):
+                del self._ops[key]
+
+    def patches(self):
+        """Get the merged list of operations."""
+        return self._frozen + [patch for ops in self._ops.values()
+                               for patch in ops]
+
+    def __len__(self):
+        return len(self.patches())
+
+    def flush(self, call, uuid):
+        """Send the merged operations via call, retrying on conflicts.
+
+        Nothing is sent if there are no operations.
+
+        :param call: Ironic client method, e.g. ``ironic.node.update``
+        :param uuid: UUID of the resource
+        :returns: result of the call or None if nothing was sent
+        """
+        patches = self.patches()
+        if not patches:
+            return
+        result = retry_on_conflict(call, uuid, patches)
+        self._frozen = []
+        self._ops.clear()
+        return result
+
+
+def _is_array_path(path):
+    return any(part.isdigit() or part == '-' for part in path.split('/'))
+
+
+def _call_name(call):
+    """Get a name like node.update for a method of an Ironic client."""
+    name = getattr(call, '__name__', None)
+    if name is None:
+        return repr(call)
+    manager = getattr(call, '__self__', None)
+    if manager is None:
+        return name
+    prefix = type(manager).__name__
+    if prefix.endswith('Manager'):
+        prefix = prefix[:-len('Manager')]
+    return '%s.%s' % (prefix.lower(), name)
+
+
 def check_provision_state(node):
     if not node.maintenance:
         provision_state = node.provision_state
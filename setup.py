@@ -42,6 +42,15 @@ setup(
             "edeploy = ironic_discoverd.plugins.edeploy:eDeployHook",
             "root_device_hint = ironic_discoverd.plugins.root_device_hint:RootDeviceHintHook",
         ],
+        'ironic_discoverd.node_cache': [
+            "sqlite = ironic_discoverd.node_cache:SQLiteDriver",
+            "sqlalchemy = ironic_discoverd.plugins.node_cache_sqlalchemy:SQLAlchemyDriver",
+            "memory = ironic_discoverd.plugins.node_cache_memory:MemoryDriver",
+        ],
+        'ironic_discoverd.firewall': [
+            "iptables = ironic_discoverd.firewall:IptablesDriver",
+            "nftables = ironic_discoverd.plugins.firewall_nftables:NftablesDriver",
+        ],
         'openstack.cli.extension': [
             'baremetal-introspection = ironic_discoverd.shell',
         ],